@@ -0,0 +1,186 @@
+######################
+# Pipeline benchmark #
+######################
+
+# Runs the product pipelines end to end, through export and upload, on synthetic input and
+# reports throughput, peak memory and per-stage times for each chunk size. Each configuration
+# runs in a fresh process so that peak memory is measured per run.
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'scripts'))
+sys.path.insert(0, BENCHMARKS)
+
+# Source product of each pipeline, per sensor
+PRODUCTS = {
+    ('geomedian', 's2'): 's2_esa_sr_granule',
+    ('geomedian', 'ls'): 'ls8_usgs_sr_scene',
+    ('fractional_cover', 's2'): 's2_geomedian_annual',
+    ('fractional_cover', 'ls'): 'ls8_geomedian_annual',
+    ('shoreline', 'ls'): 'ls8_water_classification',
+}
+
+# Chunk size parameters of each pipeline
+CHUNK_PARAMETERS = {
+    'geomedian': ['dask_chunk_size'],
+    'fractional_cover': ['dask_x_chunk_size', 'dask_y_chunk_size'],
+    'shoreline': ['dask_x_chunk_size', 'dask_y_chunk_size'],
+}
+
+
+def make_job(pipeline, sensor, tile_size, years, chunk_size):
+    """Return the job document for a benchmark configuration."""
+    x_from, y_from = 2200000.0, 3550000.0
+
+    job = {
+        "job_code": pipeline,
+        "product": PRODUCTS[(pipeline, sensor)],
+        "query_x_from": str(x_from),
+        "query_y_from": str(y_from),
+        "query_x_to": str(x_from + tile_size),
+        "query_y_to": str(y_from + tile_size),
+        "query_crs": "EPSG:3460",
+        "output_crs": "EPSG:3460",
+        "time_from": "2018-01-01",
+        "time_to": f"{2018 + years - 1}-12-31",
+        "prefix": "benchmark",
+        "skip_existing": "False",
+    }
+
+    for parameter in CHUNK_PARAMETERS[pipeline]:
+        job[parameter] = str(chunk_size)
+
+    if pipeline == 'shoreline':
+        job["tide_range_from"] = 1.0
+        job["tide_range_to"] = 2.5
+
+    return job
+
+
+def run_one(config):
+    """Run a single configuration and return its results."""
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.WARNING)
+
+    from dask.distributed import Client
+    import metrics
+    import shoreline
+    import worker
+    from synthetic import SyntheticDatacube, LocalS3Client, synthetic_tide_data
+
+    job = config['job']
+    dc = SyntheticDatacube()
+
+    shoreline.load_tide_data = lambda *args: synthetic_tide_data(job['time_from'], job['time_to'])
+
+    with tempfile.TemporaryDirectory() as root, \
+            Client(processes=False, n_workers=1, threads_per_worker=config['threads']):
+        # Band files are written to the working directory before upload
+        os.chdir(root)
+
+        start = time.monotonic()
+        worker.process_request(dc, LocalS3Client(root), **job)
+        wall_secs = time.monotonic() - start
+
+    job_metrics = metrics.REGISTRY.last_job or {}
+
+    return {
+        "pipeline": job['job_code'],
+        "sensor": config['sensor'],
+        "chunk_size": config['chunk_size'],
+        "tile_size": config['tile_size'],
+        "years": config['years'],
+        "status": job_metrics.get('status'),
+        "wall_secs": wall_secs,
+        "input_pixels": dc.loaded_pixels,
+        "pixels_per_sec": dc.loaded_pixels / wall_secs if wall_secs else None,
+        "max_rss_bytes": job_metrics.get('max_rss_bytes'),
+        "stages": {name: stage['wall_secs'] for name, stage in job_metrics.get('stages', {}).items()},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_results(results, baseline=None):
+    def key(result):
+        return (result['pipeline'], result['sensor'], result['tile_size'], result['years'], result['chunk_size'])
+
+    baseline = {key(result): result for result in (baseline or [])}
+
+    print(f"{'pipeline':<18}{'sensor':<8}{'chunk':>7}{'status':>9}{'wall s':>10}{'Mpix/s':>10}{'peak MB':>10}  stages")
+    for result in results:
+        mpix = (result['pixels_per_sec'] or 0) / 1e6
+        peak = (result['max_rss_bytes'] or 0) / 1024 ** 2
+        stages = ", ".join(f"{name} {secs:.1f}" for name, secs in result['stages'].items())
+        line = (f"{result['pipeline']:<18}{result['sensor']:<8}{result['chunk_size']:>7}{str(result['status']):>9}"
+                f"{result['wall_secs']:>10.1f}{mpix:>10.2f}{peak:>10.0f}  {stages}")
+
+        previous = baseline.get(key(result))
+        if previous and previous['wall_secs']:
+            line += f"  ({result['wall_secs'] / previous['wall_secs']:.2f}x baseline time)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the product pipelines on synthetic input.")
+    parser.add_argument("--pipelines", nargs="+", default=["geomedian", "fractional_cover", "shoreline"])
+    parser.add_argument("--sensors", nargs="+", default=["s2", "ls"], choices=["s2", "ls"])
+    parser.add_argument("--chunk-sizes", nargs="+", type=int, default=[500, 1000, 2000])
+    parser.add_argument("--tile-size", type=float, default=10000, help="tile size in metres")
+    parser.add_argument("--years", type=int, default=1, choices=[1, 2, 3])
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    parser.add_argument("--output", help="results file, defaults to results/<commit>.json")
+    parser.add_argument("--compare", help="results file of a previous run to compare with")
+    args = parser.parse_args()
+
+    configs = [
+        {
+            "job": make_job(pipeline, sensor, args.tile_size, args.years, chunk_size),
+            "sensor": sensor,
+            "chunk_size": chunk_size,
+            "tile_size": args.tile_size,
+            "years": args.years,
+            "threads": args.threads,
+        }
+        for pipeline in args.pipelines
+        for sensor in args.sensors
+        if (pipeline, sensor) in PRODUCTS
+        for chunk_size in args.chunk_sizes
+    ]
+
+    results = []
+    for config in configs:
+        # A fresh process per run, so that its peak memory is its own
+        with get_context('spawn').Pool(1) as pool:
+            results.append(pool.apply(run_one, (config,)))
+
+    commit = git_commit()
+    output = args.output or os.path.join(BENCHMARKS, 'results', f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as outfile:
+        json.dump({"commit": commit, "results": results}, outfile, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)['results']
+
+    print_results(results, baseline)
+    print(f"Results saved to {output}.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+######################
+# Synthetic datacube #
+######################
+
+# Stand-ins for the Open Data Cube and S3 used to run the product pipelines offline, with
+# dask-backed inputs shaped like the real products.
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array as da
+from concurrent.futures import Future
+from types import SimpleNamespace
+from datacube.utils.geometry import CRS
+
+# Days between scenes, per sensor
+REVISIT_DAYS = {
+    'ls': 16,
+    's2': 5,
+}
+
+# Quality values and their frequencies: mostly clear or water, the rest cloud, shadow or no data
+S2_SCENE_CLASSIFICATION = ([4, 5, 6, 7, 2, 3, 8, 9, 0], [0.3, 0.15, 0.1, 0.05, 0.05, 0.05, 0.15, 0.1, 0.05])
+LS8_PIXEL_QA = ([322, 386, 324, 388, 480, 352, 1], [0.45, 0.1, 0.1, 0.05, 0.15, 0.1, 0.05])
+LS_PIXEL_QA = ([66, 130, 68, 132, 224, 96, 1], [0.45, 0.1, 0.1, 0.05, 0.15, 0.1, 0.05])
+
+DATA_BANDS = ['red', 'green', 'blue', 'nir', 'swir1', 'swir2']
+
+
+class SyntheticDatacube:
+    """
+    Implements the parts of `datacube.Datacube` used by the pipelines. `load` returns lazily
+    generated random data covering the query extents, with one scene every revisit period for
+    surface reflectance and water classification products, and a single time step otherwise.
+    `find_datasets` returns stand-ins for the datasets of those scenes.
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        # Pixels loaded so far, counted over all bands and time steps
+        self.loaded_pixels = 0
+
+    def _times(self, product, time):
+        if 'usgs_sr' in product or 'esa_sr' in product or 'water' in product:
+            revisit = REVISIT_DAYS['ls' if product.startswith('ls') else 's2']
+            return pd.date_range(time[0], time[1], freq=f"{revisit}D") + pd.Timedelta(hours=22)
+        return pd.DatetimeIndex([time[0]])
+
+    def find_datasets(self, product=None, time=None, **query):
+        return [SimpleNamespace(type=SimpleNamespace(name=product), center_time=t.to_pydatetime())
+                for t in self._times(product, time)]
+
+    def load(self, product=None, measurements=None, x=None, y=None, time=None, resolution=None,
+             dask_chunks=None, output_crs=None, group_by=None, datasets=None, **kwargs):
+        if product is None and datasets:
+            product = datasets[0].type.name
+
+        if measurements is None:
+            measurements = ['water_classification'] if 'water' in product else DATA_BANDS
+
+        res = abs(resolution[1]) if resolution else (30 if product.startswith('ls') else 10)
+        x_from, x_to = sorted(x)
+        y_from, y_to = sorted(y)
+        xs = np.arange(np.floor(x_from / res) * res, np.ceil(x_to / res) * res, res) + res / 2
+        ys = np.arange(np.ceil(y_to / res) * res, np.floor(y_from / res) * res, -res) - res / 2
+
+        if datasets:
+            times = pd.DatetimeIndex(sorted({pd.Timestamp(ds.center_time) for ds in datasets}))
+        else:
+            times = self._times(product, time)
+
+        dask_chunks = dask_chunks or {}
+        chunks = (int(dask_chunks.get('time', 1)),
+                  int(dask_chunks.get('y', len(ys))),
+                  int(dask_chunks.get('x', len(xs))))
+        shape = (len(times), len(ys), len(xs))
+        self.loaded_pixels += len(measurements) * int(np.prod(shape))
+
+        rs = da.random.RandomState(self.seed)
+        nodata = -9999 if product.startswith('ls') else 0
+
+        data_vars = {}
+        for name in measurements:
+            if name == 'scene_classification':
+                values, p = S2_SCENE_CLASSIFICATION
+                data = rs.choice(np.array(values, dtype='uint8'), size=shape, p=p, chunks=chunks)
+                attrs = {'nodata': 0}
+            elif name == 'pixel_qa':
+                values, p = LS8_PIXEL_QA if product.startswith('ls8') else LS_PIXEL_QA
+                data = rs.choice(np.array(values, dtype='uint16'), size=shape, p=p, chunks=chunks)
+                attrs = {'nodata': 1}
+            elif name in ('water', 'water_classification'):
+                data = rs.choice(np.array([0, 1, -9999], dtype='int16'), size=shape, p=[0.7, 0.25, 0.05], chunks=chunks)
+                attrs = {'nodata': -9999}
+            else:
+                data = rs.randint(0, 5000, size=shape, chunks=chunks, dtype='int16')
+                attrs = {'nodata': nodata}
+            data_vars[name] = (('time', 'y', 'x'), data, attrs)
+
+        crs = CRS(output_crs)
+
+        return xr.Dataset(data_vars,
+                          coords={'time': times, 'y': ys, 'x': xs},
+                          attrs={'crs': crs})
+
+
+class LocalS3Client:
+    """
+    Implements the interface of `s3.S3Client` on top of a local directory, with uploads run
+    synchronously so that their cost is part of the job.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, destination):
+        path = os.path.join(self.root, bucket, destination)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _done(self, exception=None):
+        future = Future()
+        if exception is None:
+            future.set_result(None)
+        else:
+            future.set_exception(exception)
+        return future
+
+    def upload_file(self, source, bucket, destination):
+        shutil.copyfile(source, self._path(bucket, destination))
+
+    def upload_file_async(self, source, bucket, destination, remove=False):
+        try:
+            self.upload_file(source, bucket, destination)
+            return self._done()
+        except Exception as e:
+            return self._done(e)
+        finally:
+            if remove:
+                os.remove(source)
+
+    def upload_fileobj_async(self, fileobj, bucket, destination):
+        try:
+            with open(self._path(bucket, destination), 'wb') as dst:
+                dst.write(fileobj.getvalue())
+            return self._done()
+        finally:
+            fileobj.close()
+
+    def list_keys(self, bucket, prefix):
+        keys = set()
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, bucket)):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), os.path.join(self.root, bucket))
+                if key.startswith(prefix):
+                    keys.add(key)
+        return keys
+
+    def wait(self, futures):
+        return sum(1 for future in futures if future.exception() is not None)
+
+
+def synthetic_tide_data(time_from, time_to):
+    """Return hourly tide heights in the format of `shoreline.load_tide_data`."""
+    times = pd.date_range(time_from, time_to, freq='1H')
+    hours = np.arange(len(times))
+    tides = 1.5 + np.sin(2 * np.pi * hours / 12.42)
+    return pd.DataFrame({'tides': tides, 'tide_height': tides}, index=pd.Index(times, name='time'))
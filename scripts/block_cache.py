@@ -0,0 +1,263 @@
+###############
+# Block cache #
+###############
+
+# A read-through cache of the blocks of source rasters read by the datacube loader, kept on the
+# local disk of the dask worker nodes. Blocks are the internal tiles of the files, e.g. of COGs,
+# keyed by the URL and ETag of their file, the band and the position of the tile, so that the
+# windows of overlapping jobs share their tiles and a rewritten file is never served from the
+# cache. The windows read are assembled from their tiles. The cache directory can be shared by
+# every dask worker on a node: the least recently used blocks, across all of them, are evicted
+# once the cache exceeds its byte budget.
+
+import hashlib
+import logging
+import os
+import threading
+import time
+import urllib.request
+import numpy as np
+from rasterio.windows import Window
+from distributed.diagnostics.plugin import WorkerPlugin
+
+# Seconds the ETag of a file is trusted for before it is looked up again
+ETAG_TTL = 600
+
+# Fraction of the byte budget the cache is trimmed down to when it is exceeded
+EVICT_TO = 0.9
+
+# The cache of this process, set up by BlockCachePlugin
+_cache = None
+_original_reads = {}
+
+
+class BlockCache:
+    """
+    Blocks stored as .npy files in a directory, using at most max_bytes. The modification time
+    of a file is its last use.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        self._lock = threading.Lock()
+        self._written = 0
+        self._etags = {}
+        self._s3 = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            block = np.load(path)
+            os.utime(path)
+
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self.bytes_hit += block.nbytes
+        return block
+
+    def put(self, key, block):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, block)
+            os.replace(tmp_path, path)
+
+        except OSError as e:
+            logging.warning("Could not cache block: %s", e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            self._written += block.nbytes
+            # Other processes write to the same directory, so its size is only checked from
+            # time to time rather than tracked
+            evict = self._written > self.max_bytes * (1 - EVICT_TO)
+            if evict:
+                self._written = 0
+
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used blocks until the cache is within its budget."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def etag(self, url):
+        """
+        Return the ETag of a file (its size and modification time for local files), or None if
+        it can't be found, in which case its blocks are not cached
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            cached = self._etags.get(url)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        try:
+            if url.startswith("s3://"):
+                if self._s3 is None:
+                    import boto3
+                    self._s3 = boto3.client("s3", endpoint_url=os.getenv("AWS_S3_ENDPOINT_URL"))
+                bucket, key = url[len("s3://"):].split("/", 1)
+                etag = self._s3.head_object(Bucket=bucket, Key=key)["ETag"]
+            elif url.startswith(("http://", "https://")):
+                with urllib.request.urlopen(urllib.request.Request(url, method="HEAD")) as response:
+                    etag = response.headers.get("ETag")
+            else:
+                stat = os.stat(url)
+                etag = f"{stat.st_size}-{stat.st_mtime_ns}"
+
+        except Exception as e:
+            logging.debug("Could not get the ETag of %s: %s", url, e)
+            etag = None
+
+        with self._lock:
+            self._etags[url] = (etag, now + ETAG_TTL)
+        return etag
+
+    def stats(self, reset=False):
+        with self._lock:
+            stats = {"hits": self.hits, "misses": self.misses, "bytes_hit": self.bytes_hit}
+            if reset:
+                self.hits = self.misses = self.bytes_hit = 0
+        return stats
+
+
+def _source_url(name):
+    """Return the URL of a file opened by rasterio, from its GDAL name."""
+    for prefix, scheme in (("/vsis3/", "s3://"), ("/vsicurl/", "")):
+        if name.startswith(prefix):
+            return scheme + name[len(prefix):]
+    return name
+
+
+def _window_ranges(window, ds):
+    """Return the rows and columns of a window, the whole file if it is None."""
+    if window is None:
+        return (0, ds.height), (0, ds.width)
+    if hasattr(window, "toranges"):
+        window = window.toranges()
+    return tuple((int(start), int(stop)) for start, stop in window)
+
+
+def _cached_read(read):
+    def _read(self, window=None, out_shape=None):
+        cache = _cache
+        if cache is None:
+            return read(self, window=window, out_shape=out_shape)
+
+        ds, bidx = self.source.ds, self.source.bidx
+        (row_start, row_stop), (col_start, col_stop) = _window_ranges(window, ds)
+        shape = (row_stop - row_start, col_stop - col_start)
+
+        # Decimated reads come from the overviews, boundless ones are padded, and the blocks of
+        # files that aren't tiled are single rows, so these are read from the source
+        if ((out_shape is not None and tuple(out_shape[-2:]) != shape)
+                or row_start < 0 or col_start < 0 or row_stop > ds.height or col_stop > ds.width
+                or not ds.profile.get("tiled", False)):
+            return read(self, window=window, out_shape=out_shape)
+
+        url = _source_url(ds.name)
+        etag = cache.etag(url)
+        if etag is None:
+            return read(self, window=window, out_shape=out_shape)
+
+        block_height, block_width = ds.block_shapes[bidx - 1]
+        data = np.empty(shape, dtype=ds.dtypes[bidx - 1])
+
+        for block_row in range(row_start // block_height, (row_stop - 1) // block_height + 1):
+            for block_col in range(col_start // block_width, (col_stop - 1) // block_width + 1):
+                top, left = block_row * block_height, block_col * block_width
+
+                key = hashlib.sha1(repr((url, etag, bidx, block_row, block_col)).encode()).hexdigest()
+                block = cache.get(key)
+                if block is None:
+                    block = read(self, window=Window(left, top, min(block_width, ds.width - left),
+                                                     min(block_height, ds.height - top)))
+                    cache.put(key, block)
+
+                rows = slice(max(row_start, top), min(row_stop, top + block_height))
+                cols = slice(max(col_start, left), min(col_stop, left + block_width))
+                data[rows.start - row_start:rows.stop - row_start, cols.start - col_start:cols.stop - col_start] = \
+                    block[rows.start - top:rows.stop - top, cols.start - left:cols.stop - left]
+
+        return data.reshape(out_shape) if out_shape is not None else data
+
+    return _read
+
+
+def install(directory, max_bytes):
+    """Cache the blocks read by the datacube loader in this process."""
+    global _cache
+    from datacube.storage._rio import BandDataSource, OverrideBandDataSource
+
+    for cls in (BandDataSource, OverrideBandDataSource):
+        if cls not in _original_reads:
+            _original_reads[cls] = cls.read
+            cls.read = _cached_read(cls.read)
+
+    _cache = BlockCache(directory, max_bytes)
+
+
+def uninstall():
+    global _cache
+    for cls, read in _original_reads.items():
+        cls.read = read
+    _original_reads.clear()
+    _cache = None
+
+
+def block_cache_stats(reset=False):
+    """Return the hits and misses of the cache of this process, or None if there is none."""
+    return _cache.stats(reset=reset) if _cache is not None else None
+
+
+class BlockCachePlugin(WorkerPlugin):
+    """Installs the block cache on every dask worker, including workers started later."""
+
+    name = "block-cache"
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def setup(self, worker):
+        install(self.directory, self.max_bytes)
+
+    def teardown(self, worker):
+        uninstall()
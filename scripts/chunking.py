@@ -0,0 +1,126 @@
+#################
+# Chunk planner #
+#################
+
+# Chooses dask chunk sizes from the size of the array a job is about to load and the memory
+# of the dask workers, for jobs that set their chunk sizes to "auto".
+
+import logging
+import math
+import numpy as np
+import pyproj
+from dask.distributed import default_client
+
+# Fraction of the memory available to a task that a block may use, leaving room for the
+# inputs and outputs of other steps and for dask's own spilling thresholds
+MEMORY_FRACTION = 0.5
+
+# Used when there is no dask client to ask
+DEFAULT_TASK_MEMORY = 2 * 1024 ** 3
+
+# Smallest chunk side worth scheduling
+MIN_CHUNK_SIZE = 256
+
+
+def task_memory(dask_client=None):
+    """
+    Return the memory available to a single task, i.e. the smallest worker memory limit
+    divided by its number of threads
+    """
+
+    try:
+        dask_client = dask_client or default_client()
+        workers = dask_client.scheduler_info()["workers"].values()
+        limits = [worker["memory_limit"] / max(worker["nthreads"], 1) for worker in workers if worker.get("memory_limit")]
+        if limits:
+            return int(min(limits))
+
+    except Exception as e:
+        logging.warning("Could not get the memory of the dask workers: %s", e)
+
+    return DEFAULT_TASK_MEMORY
+
+
+def query_shape(query):
+    """
+    Return the width and height in pixels of the array loaded by a query, from its extents
+    and resolution
+    """
+
+    query_crs = query.get("crs", "EPSG:4326")
+    output_crs = query["output_crs"]
+
+    xs = query["x"]
+    ys = query["y"]
+
+    if query_crs != output_crs:
+        transformer = pyproj.Transformer.from_crs(query_crs, output_crs, always_xy=True)
+        corners = [transformer.transform(x, y) for x in xs for y in ys]
+        xs = [x for x, _ in corners]
+        ys = [y for _, y in corners]
+
+    y_res, x_res = query["resolution"]
+
+    width = math.ceil((max(xs) - min(xs)) / abs(x_res))
+    height = math.ceil((max(ys) - min(ys)) / abs(y_res))
+    return width, height
+
+
+def count_scenes(dc, query):
+    """
+    Return the number of time steps a query loads, from the datasets in the index
+    """
+
+    search = {key: query[key] for key in ("product", "time", "x", "y", "crs") if key in query}
+    datasets = dc.find_datasets(**search)
+
+    if query.get("group_by") == "solar_day":
+        return len({ds.center_time.date() for ds in datasets})
+
+    return len({ds.center_time for ds in datasets})
+
+
+def pixel_bytes(dc, query):
+    """
+    Return the bytes per pixel and time step of the measurements of a query
+    """
+
+    product = dc.index.products.get_by_name(query["product"])
+    measurements = product.lookup_measurements(query.get("measurements"))
+    return sum(np.dtype(measurement["dtype"]).itemsize for measurement in measurements.values())
+
+
+def balance_chunk_size(size, chunk_size):
+    """
+    Return the largest chunk size not above chunk_size that splits size into equal chunks
+    """
+
+    chunks = math.ceil(size / chunk_size)
+    return math.ceil(size / chunks)
+
+
+def plan_chunk_size(dc, query, scenes_per_chunk=None, working_bytes=0, dask_client=None):
+    """
+    Return the side in pixels of square x/y chunks for a query, as large as possible while
+    keeping each block within the memory budget of a task.
+
+    A block holds scenes_per_chunk time steps, by default all of the time steps found in the
+    index, and every pixel of every time step needs the bytes of the loaded measurements plus
+    working_bytes for intermediate results, e.g. float32 copies of the bands.
+    """
+
+    width, height = query_shape(query)
+
+    if scenes_per_chunk is None:
+        scenes_per_chunk = count_scenes(dc, query)
+
+    block_pixel_bytes = max(scenes_per_chunk, 1) * (pixel_bytes(dc, query) + working_bytes)
+    budget = task_memory(dask_client) * MEMORY_FRACTION
+
+    chunk_size = max(int(math.sqrt(budget / block_pixel_bytes)), MIN_CHUNK_SIZE)
+    chunk_size = balance_chunk_size(max(width, height, 1), chunk_size)
+
+    logging.info("Planned %d x %d chunks for a %d x %d array of %d time steps, with %.0f MB per task.",
+                 chunk_size, chunk_size, width, height, scenes_per_chunk, budget / 1024 ** 2)
+
+    return chunk_size
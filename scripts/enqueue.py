@@ -0,0 +1,176 @@
+import argparse
+import json
+import logging
+import os
+import rediswq
+from shapely.geometry import box
+from tiling import plan_tiles, read_region, tile_query
+from utils import BATCH_JOBS, get_output_keys, get_product_resolution
+
+#############
+# Tile grid #
+#############
+
+def job_resolution(product):
+    """
+    Return the coarsest output resolution of the comma separated products of a job, whose
+    pixel grid is also the pixel grid of the finer ones
+    """
+
+    return max(get_product_resolution(p.strip()) for p in product.split(","))
+
+
+def generate_tiles(region, tile_size, resolution, origin=(0.0, 0.0)):
+    """
+    Return the query extents (x_from, y_from, x_to, y_to) of the pixel aligned tiles covering
+    a region, each loading only its own pixels
+    """
+
+    return [tile_query(tile, resolution) for tile in plan_tiles(region, tile_size, resolution, origin=origin)]
+
+
+def generate_jobs(job_code, product, tiles, crs, years, prefix, **options):
+    """
+    Return the job documents for every tile and every year
+    """
+
+    jobs = []
+
+    # Batch jobs cover every year, and every comma separated product, of a tile
+    if job_code in BATCH_JOBS:
+        for x_from, y_from, x_to, y_to in tiles:
+            job = {
+                "job_code": job_code,
+                "products": product,
+                "years": ",".join(str(year) for year in years),
+                "query_x_from": str(x_from),
+                "query_y_from": str(y_from),
+                "query_x_to": str(x_to),
+                "query_y_to": str(y_to),
+                "query_crs": crs,
+                "output_crs": crs,
+                "prefix": prefix,
+            }
+            job.update(options)
+            jobs.append(job)
+
+        return jobs
+
+    for year in years:
+        for x_from, y_from, x_to, y_to in tiles:
+            job = {
+                "job_code": job_code,
+                "product": product,
+                "query_x_from": str(x_from),
+                "query_y_from": str(y_from),
+                "query_x_to": str(x_to),
+                "query_y_to": str(y_to),
+                "query_crs": crs,
+                "time_from": f"{year}-01-01",
+                "time_to": f"{year}-12-31",
+                "output_crs": crs,
+                "prefix": prefix.format(year=year, product=product),
+            }
+            job.update(options)
+            jobs.append(job)
+
+    return jobs
+
+
+def filter_existing_jobs(s3_client, jobs, bucket='public-eo-data'):
+    """
+    Return the jobs whose outputs are not all in the bucket yet, listing each prefix only once
+    """
+
+    listed = {}
+    pending = []
+
+    for job in jobs:
+        keys = get_output_keys(**job)
+        if keys is None:
+            pending.append(job)
+            continue
+
+        job_bucket = job.get('bucket', bucket)
+        existing = set()
+        # Combined jobs may write to several prefixes
+        for prefix in {key.rsplit('/', 1)[0] for key in keys}:
+            if (job_bucket, prefix) not in listed:
+                listed[(job_bucket, prefix)] = s3_client.list_keys(job_bucket, f"{prefix}/")
+            existing |= listed[(job_bucket, prefix)]
+
+        if not set(keys) <= existing:
+            pending.append(job)
+
+    return pending
+
+
+########
+# Main #
+########
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Queue product generation jobs for a tile grid.")
+    parser.add_argument("--job-code", required=True, help="e.g. geomedian, fractional_cover, geomedian_fractional_cover, geomedian_batch, shoreline")
+    parser.add_argument("--product", required=True,
+                        help="e.g. s2_esa_sr_granule, batch jobs take a comma separated list")
+    parser.add_argument("--crs", required=True, help="query and output CRS, e.g. EPSG:3460")
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument("--extent", type=float, nargs=4,
+                        metavar=("X_FROM", "Y_FROM", "X_TO", "Y_TO"), help="region extent in the CRS")
+    region.add_argument("--region", help="GeoJSON file of the region, only tiles intersecting it are queued")
+    parser.add_argument("--region-crs", default="EPSG:4326", help="CRS of the GeoJSON region")
+    parser.add_argument("--tile-size", required=True, type=float,
+                        help="tile size in CRS units, a multiple of the resolution")
+    parser.add_argument("--grid-origin", default=[0.0, 0.0], type=float, nargs=2, metavar=("X", "Y"),
+                        help="origin of the tile grid in the CRS, on the pixel grid")
+    parser.add_argument("--resolution", type=float,
+                        help="output resolution in CRS units, by default the coarsest of the products")
+    parser.add_argument("--years", required=True, nargs="+", help="years to process")
+    parser.add_argument("--prefix", required=True,
+                        help="output prefix, {year} and {product} are replaced for each job")
+    parser.add_argument("--option", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra job parameter, may be repeated")
+    parser.add_argument("--priority", default=0, type=int, help="jobs with a higher priority are processed first")
+    parser.add_argument("--skip-existing", action="store_true", help="skip jobs whose outputs are already in the bucket")
+    parser.add_argument("--queue", default="jobProduct")
+    parser.add_argument("--dry-run", action="store_true", help="print the jobs instead of queueing them")
+    args = parser.parse_args()
+
+    options = dict(option.split("=", 1) for option in args.option)
+
+    if args.region is not None:
+        region = read_region(args.region, args.crs, region_crs=args.region_crs)
+    else:
+        region = box(*args.extent)
+
+    resolution = args.resolution or job_resolution(args.product)
+    tiles = generate_tiles(region, args.tile_size, resolution, origin=tuple(args.grid_origin))
+    logging.info("Planned %d tiles.", len(tiles))
+
+    jobs = generate_jobs(args.job_code, args.product, tiles, args.crs, args.years, args.prefix, **options)
+    logging.info("Generated %d jobs.", len(jobs))
+
+    if args.skip_existing:
+        from s3 import S3Client
+
+        jobs = filter_existing_jobs(S3Client(), jobs, bucket=options.get('bucket', 'public-eo-data'))
+        logging.info("%d jobs have missing outputs.", len(jobs))
+
+    items = [json.dumps(job) for job in jobs]
+
+    if args.dry_run:
+        for item in items:
+            print(item)
+        return
+
+    host = os.getenv("REDIS_SERVICE_HOST", "redis-master")
+    q = rediswq.RedisWQ(name=args.queue, host=host)
+
+    added = q.put(items, priority=args.priority)
+    logging.info("Queued %d jobs, %d were already queued.", added, len(items) - added)
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import itertools
 import xarray as xr
 import rasterio
 
@@ -13,7 +14,7 @@ def _get_transform_from_xr(data, x_coord='longitude', y_coord='latitude'):
 
 
 def export_xarray_to_geotiff(data, tif_path, bands=None, no_data=-9999, crs="EPSG:4326",
-                             x_coord='longitude', y_coord='latitude'):
+                             x_coord='longitude', y_coord='latitude', interleave=None):
     """
     Export a GeoTIFF from a 2D `xarray.Dataset`.
     Parameters
@@ -31,7 +32,10 @@ def export_xarray_to_geotiff(data, tif_path, bands=None, no_data=-9999, crs="EPS
         The CRS of the output.
     x_coord, y_coord: string
         The string names of the x and y dimensions.
+    interleave: string
+        'BAND' or 'PIXEL' interleaving of multiband files, the GDAL default if None.
     """
+    profile = {'interleave': interleave.lower()} if interleave else {}
     if isinstance(data, xr.DataArray):
         height, width = data.sizes[y_coord], data.sizes[x_coord]
         count, dtype = 1, data.dtype
@@ -54,10 +58,325 @@ def export_xarray_to_geotiff(data, tif_path, bands=None, no_data=-9999, crs="EPS
             dtype=dtype,
             crs=crs,
             transform=_get_transform_from_xr(data, x_coord=x_coord, y_coord=y_coord),
-            nodata=no_data) as dst:
+            nodata=no_data,
+            **profile) as dst:
         if isinstance(data, xr.DataArray):
             dst.write(data.values, 1)
         else:
             for index, band in enumerate(bands):
                 dst.write(data[band].values.astype(dtype), index + 1)
     dst.close()
+
+
+def _iter_computed_blocks(data, windows, x_coord='longitude', y_coord='latitude', max_in_flight=4):
+    """Yield (window, block) pairs as the dask blocks of an `xarray.Dataset` are computed.
+
+    When a distributed client is available blocks are submitted to the cluster, keeping at
+    most `max_in_flight` of them in flight, and are yielded in order of completion.
+    Otherwise blocks are computed one at a time with the default dask scheduler.
+    """
+
+    def _block(window):
+        return data.isel({y_coord: slice(window.row_off, window.row_off + window.height),
+                          x_coord: slice(window.col_off, window.col_off + window.width)})
+
+    windows = iter(windows)
+
+    try:
+        from dask.distributed import default_client, as_completed
+        client = default_client()
+    except (ImportError, ValueError):
+        for window in windows:
+            yield window, _block(window).compute()
+        return
+
+    in_flight = {}
+
+    def _submit(window):
+        future = client.compute(_block(window))
+        in_flight[future] = window
+        return future
+
+    completed = as_completed([_submit(window) for window in itertools.islice(windows, max_in_flight)])
+
+    for future in completed:
+        window = in_flight.pop(future)
+        block = future.result()
+        future.release()
+
+        next_window = next(windows, None)
+        if next_window is not None:
+            completed.add(_submit(next_window))
+
+        yield window, block
+
+
+def stream_xarray_to_geotiffs(data, outputs, no_data=-9999, crs="EPSG:4326",
+                              x_coord='longitude', y_coord='latitude', max_in_flight=4):
+    """
+    Export GeoTIFFs from a dask-backed 2D `xarray.Dataset` without materialising it.
+    Each dask block is computed on its own and written into the matching window of
+    every output file, so memory use is bounded by the chunk size rather than the
+    size of the dataset.
+    Parameters
+    ----------
+    data: xarray.Dataset
+        A dask-backed xarray with 2 dimensions to be exported as GeoTIFFs.
+    outputs: dict
+        Maps the path of each GeoTIFF file to write to the list of bands it holds,
+        in the order they should be written. All bands are computed in a single pass.
+    no_data: int
+        The nodata value.
+    crs: string
+        The CRS of the output.
+    x_coord, y_coord: string
+        The string names of the x and y dimensions.
+    max_in_flight: int
+        The maximum number of blocks being computed at any one time.
+    """
+    from rasterio.windows import Window
+
+    bands = [band for output_bands in outputs.values() for band in output_bands]
+    data = data[list(dict.fromkeys(bands))]
+
+    height, width = data.dims[y_coord], data.dims[x_coord]
+    transform = _get_transform_from_xr(data, x_coord=x_coord, y_coord=y_coord)
+
+    windows = []
+    row_off = 0
+    for block_height in data.chunks[y_coord]:
+        col_off = 0
+        for block_width in data.chunks[x_coord]:
+            windows.append(Window(col_off, row_off, block_width, block_height))
+            col_off += block_width
+        row_off += block_height
+
+    dsts = {}
+    try:
+        for tif_path, output_bands in outputs.items():
+            dsts[tif_path] = rasterio.open(
+                tif_path,
+                'w',
+                driver='GTiff',
+                height=height,
+                width=width,
+                count=len(output_bands),
+                dtype=data[output_bands[0]].dtype,
+                crs=crs,
+                transform=transform,
+                nodata=no_data,
+                tiled=True,
+                blockxsize=256,
+                blockysize=256)
+
+        for window, block in _iter_computed_blocks(data, windows, x_coord=x_coord, y_coord=y_coord,
+                                                   max_in_flight=max_in_flight):
+            for tif_path, output_bands in outputs.items():
+                dst = dsts[tif_path]
+                for index, band in enumerate(output_bands):
+                    dst.write(block[band].values.astype(dst.dtypes[index]), index + 1, window=window)
+            del block
+
+    finally:
+        for dst in dsts.values():
+            dst.close()
+
+
+##############
+# COG writer #
+##############
+
+# Compression profiles for Cloud Optimized GeoTIFFs: the GDAL compression method, the creation
+# option that sets its level (or maximum error for LERC) and the default value for that option
+COG_PROFILES = {
+    'deflate': ('DEFLATE', 'ZLEVEL', 9),
+    'zstd': ('ZSTD', 'ZSTD_LEVEL', 9),
+    'lerc': ('LERC', 'MAX_Z_ERROR', 0),
+}
+
+
+def get_cog_creation_options(dtype, profile='deflate', level=None, num_threads='ALL_CPUS', blocksize=512,
+                             interleave=None):
+    """
+    Return the GDAL GTiff creation options for a COG with the given compression profile.
+    Parameters
+    ----------
+    dtype: numpy.dtype or string
+        The data type of the bands, used to pick the predictor.
+    profile: string
+        One of the keys of `COG_PROFILES`.
+    level: int or float
+        The compression level, or the maximum error for the `lerc` profile.
+        The profile default is used if None.
+    num_threads: int or string
+        The number of threads GDAL uses to compress tiles, or 'ALL_CPUS'.
+    blocksize: int
+        The size in pixels of the internal tiles.
+    interleave: string
+        'BAND' or 'PIXEL' interleaving of multiband files, the GDAL default if None.
+    """
+    import numpy as np
+
+    try:
+        compress, level_option, default_level = COG_PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"Unknown COG profile {profile}, expected one of {', '.join(COG_PROFILES)}")
+
+    options = {
+        'TILED': 'YES',
+        'BLOCKXSIZE': blocksize,
+        'BLOCKYSIZE': blocksize,
+        'COMPRESS': compress,
+        level_option: default_level if level is None else level,
+        'NUM_THREADS': num_threads,
+        'COPY_SRC_OVERVIEWS': 'YES',
+    }
+
+    if compress != 'LERC':
+        options['PREDICTOR'] = 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+
+    if interleave is not None:
+        options['INTERLEAVE'] = interleave
+
+    return options
+
+
+def _copy_to_cog(src, tif_path, creation_options, overview_levels, overview_resampling):
+    """Build overviews for the open dataset `src` and copy it to a COG at `tif_path`."""
+    from rasterio.enums import Resampling
+    from rasterio.shutil import copy
+
+    factors = [2 ** level for level in range(1, overview_levels + 1)]
+    src.build_overviews(factors, Resampling[overview_resampling])
+
+    copy(src, tif_path, driver='GTiff', **creation_options)
+
+
+def export_xarray_to_cog(data, tif_path, bands=None, no_data=-9999, crs="EPSG:4326",
+                         x_coord='longitude', y_coord='latitude',
+                         profile='deflate', level=None, overview_levels=5, overview_resampling='average',
+                         num_threads='ALL_CPUS', blocksize=512, interleave=None):
+    """
+    Export a Cloud Optimized GeoTIFF from a 2D `xarray.Dataset` in a single disk pass.
+    The bands and their overviews are assembled in memory and then written out as compressed
+    tiles, using a pool of `num_threads` GDAL threads for compression.
+    Parameters
+    ----------
+    data: xarray.Dataset or xarray.DataArray
+        An xarray with 2 dimensions to be exported as a COG.
+    tif_path: string
+        The path to write the COG file to. You should include the file extension.
+    bands: list of string
+        The bands to write - in the order they should be written.
+        Ignored if `data` is an `xarray.DataArray`.
+    no_data: int
+        The nodata value.
+    crs: string
+        The CRS of the output.
+    x_coord, y_coord: string
+        The string names of the x and y dimensions.
+    profile, level, num_threads, blocksize, interleave:
+        See `get_cog_creation_options`.
+    overview_levels: int
+        The maximum number of overview levels.
+    overview_resampling: string
+        The resampling method used to build overviews.
+    """
+    from rasterio.io import MemoryFile
+
+    if isinstance(data, xr.DataArray):
+        height, width = data.sizes[y_coord], data.sizes[x_coord]
+        count, dtype = 1, data.dtype
+    else:
+        if bands is None:
+            bands = list(data.data_vars.keys())
+        height, width = data.dims[y_coord], data.dims[x_coord]
+        count, dtype = len(bands), data[bands[0]].dtype
+
+    creation_options = get_cog_creation_options(dtype, profile=profile, level=level,
+                                                num_threads=num_threads, blocksize=blocksize,
+                                                interleave=interleave)
+
+    with MemoryFile() as memfile:
+        with memfile.open(
+                driver='GTiff',
+                height=height,
+                width=width,
+                count=count,
+                dtype=dtype,
+                crs=crs,
+                transform=_get_transform_from_xr(data, x_coord=x_coord, y_coord=y_coord),
+                nodata=no_data,
+                tiled=True,
+                blockxsize=blocksize,
+                blockysize=blocksize) as mem:
+            if isinstance(data, xr.DataArray):
+                mem.write(data.values, 1)
+            else:
+                for index, band in enumerate(bands):
+                    mem.write(data[band].values.astype(dtype), index + 1)
+
+            _copy_to_cog(mem, tif_path, creation_options, overview_levels, overview_resampling)
+
+
+def convert_geotiff_to_cog(tif_path, profile='deflate', level=None, overview_levels=5, overview_resampling='average',
+                           num_threads='ALL_CPUS', blocksize=512, interleave=None):
+    """
+    Convert an existing GeoTIFF to a Cloud Optimized GeoTIFF in place, in-process.
+    This is used for files that were written incrementally e.g. by `stream_xarray_to_geotiffs`.
+    See `export_xarray_to_cog` for the parameters.
+    """
+    import os
+
+    tmp_path = f"{tif_path}.cog.tif"
+
+    try:
+        with rasterio.open(tif_path, 'r+') as src:
+            creation_options = get_cog_creation_options(src.dtypes[0], profile=profile, level=level,
+                                                        num_threads=num_threads, blocksize=blocksize,
+                                                        interleave=interleave)
+            _copy_to_cog(src, tmp_path, creation_options, overview_levels, overview_resampling)
+
+        os.replace(tmp_path, tif_path)
+
+    finally:
+        # Only left behind if the conversion failed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+###############
+# Zarr writer #
+###############
+
+def export_xarray_to_zarr(data, store, bands=None, no_data=-9999, crs="EPSG:4326"):
+    """
+    Export a 2D `xarray.Dataset` to a Zarr store, one array per band, with consolidated metadata.
+    When `data` is dask-backed, every chunk is computed and written to the store by the dask
+    worker holding it, and only the metadata is written from the calling process.
+    Parameters
+    ----------
+    data: xarray.Dataset
+        An xarray with 2 dimensions to be exported to Zarr.
+    store: MutableMapping
+        The Zarr store to write to, e.g. an `s3fs.S3Map`. Its contents are replaced.
+    bands: list of string
+        The bands to write, all bands if None.
+    no_data: int
+        The nodata value, written as the fill value of every array.
+    crs: string
+        The CRS of the output, written as an attribute of the group.
+    """
+    if bands is None:
+        bands = list(data.data_vars.keys())
+
+    data = data[bands]
+    # Scalar coordinates, e.g. the time of the composite, are not part of the 2D output
+    data = data.drop_vars([coord for coord in data.coords if coord not in data.dims])
+    data.attrs = {'crs': crs}
+
+    encoding = {band: {'_FillValue': no_data} for band in bands}
+    for band in bands:
+        data[band].encoding = {}
+
+    data.to_zarr(store, mode='w', encoding=encoding, consolidated=True)
@@ -2,8 +2,32 @@
 # Fractional Cover #
 ####################
 
+import numpy as np
 import xarray as xr
+import metrics
+from chunking import plan_chunk_size
 from datacube_utilities.dc_fractional_coverage_classifier import frac_coverage_classify
+from water_masks import get_water_mask
+
+
+def _mask_frac_classes(frac_classes, land, nodata):
+    """
+    Mask to remove clouds, cloud shadow, and water
+    """
+
+    valid = frac_classes != nodata
+    return frac_classes.where(valid & land if land is not None else valid)
+
+
+def _fused_block(block, land, nodata):
+    """
+    Classify the fractional cover of a block of the land composite and mask it by the land
+    mask of the same pixels
+    """
+
+    frac_classes = frac_coverage_classify(block, no_data=nodata)
+
+    return _mask_frac_classes(frac_classes, land, nodata)
 
 
 def process_fractional_cover(
@@ -20,6 +44,10 @@ def process_fractional_cover(
     dask_time_chunk_size="10",
     dask_x_chunk_size="600",
     dask_y_chunk_size="600",
+    streaming_output="False",
+    fused_water_mask="False",
+    water_mask="auto",
+    water_product=None,
     **kwargs,
 ):
     nodata = -9999
@@ -30,56 +58,172 @@ def process_fractional_cover(
     # Product here is a geomedian product
     if product.startswith("ls"):
         resolution = (-30, 30)
-        water_product = product[:3] + "_water_classification"
     else:
         resolution = (-10, 10)
-        # TODO: Change when S2 WOFS ready
-        water_product = None
-        return None
+
+    water_mask = get_water_mask(water_mask, product, water_product)
 
     query = {}
 
     query["output_crs"] = output_crs
     query["resolution"] = resolution
+
+    if query_crs != "EPSG:4326":
+        query["crs"] = query_crs
+
+    query["x"] = (float(query_x_from), float(query_x_to))
+    query["y"] = (float(query_y_from), float(query_y_to))
+
+    if dask_x_chunk_size == "auto" or dask_y_chunk_size == "auto":
+        with metrics.span("plan"):
+            # Blocks hold a time chunk of the composite, plus float32 copies of its bands
+            dask_x_chunk_size = dask_y_chunk_size = plan_chunk_size(
+                dc, dict(query, product=product, measurements=data_bands),
+                scenes_per_chunk=int(dask_time_chunk_size), working_bytes=4 * len(data_bands),
+            )
+
     query["dask_chunks"] = {
         "time": int(dask_time_chunk_size),
         "x": int(dask_x_chunk_size),
         "y": int(dask_y_chunk_size),
     }
 
+    if fused_water_mask == "True":
+        return process_fractional_cover_fused(
+            dc, product, water_mask, data_bands, time, query, nodata, streaming_output
+        )
+
+    with metrics.span("load") as span:
+        land_composite = dc.load(
+            product=product, measurements=data_bands, time=time, **query
+        )
+        span["bytes_loaded"] = land_composite.nbytes
+
+    if len(land_composite.dims) == 0 or len(land_composite.data_vars) == 0:
+        return None
+
+    return classify_fractional_cover(dc, land_composite, water_mask, time, query, nodata, streaming_output)
+
+
+def classify_fractional_cover(dc, land_composite, water_mask, time, query, nodata, streaming_output):
+    """
+    Classify the fractional cover of a surface reflectance composite and mask it
+    """
+
+    land = water_mask.land_mask(dc, land_composite, time, query)
+
+    # Fractional Cover Classification
+
+    frac_classes = xr.map_blocks(
+        frac_coverage_classify, land_composite, kwargs={"no_data": nodata}
+    )
+
+    frac_cov_masked = _mask_frac_classes(frac_classes, land, nodata)
+
+    ## Compute
+
+    # In streaming mode blocks are computed and written one at a time at export
+    if streaming_output == "True":
+        return frac_cov_masked
+
+    with metrics.span("compute", dask_obj=frac_cov_masked):
+        fractional_cover = frac_cov_masked.compute()
+
+    return fractional_cover
+
+
+def process_fractional_cover_from_geomedian(
+    dc,
+    geomedian,
+    product,
+    query_x_from,
+    query_x_to,
+    query_y_from,
+    query_y_to,
+    time_from,
+    time_to,
+    output_crs,
+    query_crs="EPSG:4326",
+    dask_time_chunk_size="10",
+    dask_x_chunk_size="600",
+    dask_y_chunk_size="600",
+    streaming_output="False",
+    water_mask="auto",
+    water_product=None,
+    **kwargs,
+):
+    """
+    Classify the fractional cover of a geomedian computed by the same job from the surface
+    reflectance product, instead of loading the geomedian back from the datacube. The chunk
+    sizes only apply to the water product, if the water mask loads one.
+    """
+
+    nodata = -9999
+    time = (time_from, time_to)
+
+    query = {}
+
+    query["output_crs"] = output_crs
+    query["resolution"] = (-30, 30) if product.startswith("ls") else (-10, 10)
+
     if query_crs != "EPSG:4326":
         query["crs"] = query_crs
 
     query["x"] = (float(query_x_from), float(query_x_to))
     query["y"] = (float(query_y_from), float(query_y_to))
 
-    water_scenes = dc.load(
-        product=water_product, measurements=["water_classification"], time=time, **query
-    )
-    water_scenes = water_scenes.where(water_scenes >= 0)
+    # Chunks left out span the whole extent
+    query["dask_chunks"] = {"time": int(dask_time_chunk_size)}
+    for dim, size in (("x", dask_x_chunk_size), ("y", dask_y_chunk_size)):
+        if size != "auto":
+            query["dask_chunks"][dim] = int(size)
 
-    water_composite_mean = water_scenes.water_classification.mean(dim="time")
+    # The composite has the time dimension of a geomedian product loaded from the datacube,
+    # whose datasets are centred on the end of their period
+    land_composite = geomedian.expand_dims(time=[np.datetime64(time_to, "ns")])
 
-    land_composite = dc.load(
-        product=product, measurements=data_bands, time=time, **query
-    )
+    water_mask = get_water_mask(water_mask, product, water_product)
+
+    return classify_fractional_cover(dc, land_composite, water_mask, time, query, nodata, streaming_output)
+
+
+def process_fractional_cover_fused(dc, product, water_mask, data_bands, time, query, nodata, streaming_output):
+    """
+    Classify and mask the fractional cover block by block. The water mask of each spatial chunk
+    of the land composite is computed over that chunk only, e.g. by loading the water scenes one
+    at a time, instead of the whole water stack being loaded and reduced separately.
+    """
+
+    with metrics.span("load") as span:
+        land_composite = dc.load(
+            product=product, measurements=data_bands, time=time, **query
+        )
+        span["bytes_loaded"] = land_composite.nbytes
 
     if len(land_composite.dims) == 0 or len(land_composite.data_vars) == 0:
         return None
 
-    # Fractional Cover Classification
+    land = water_mask.land_blocks(dc, land_composite, time, query)
 
+    # The structure of the output, used to build the graph without computing anything
     frac_classes = xr.map_blocks(
         frac_coverage_classify, land_composite, kwargs={"no_data": nodata}
     )
-
-    # Mask to remove clounds, cloud shadow, and water.
-    frac_cov_masked = frac_classes.where(
-        (frac_classes != nodata) & (water_composite_mean <= 0.4)
+    template = frac_classes.where(frac_classes != nodata)
+
+    frac_cov_masked = xr.map_blocks(
+        _fused_block,
+        land_composite,
+        args=[land],
+        kwargs={"nodata": nodata},
+        template=template,
     )
 
-    ## Compute
+    # In streaming mode blocks are computed and written one at a time at export
+    if streaming_output == "True":
+        return frac_cov_masked
 
-    fractional_cover = frac_cov_masked.compute()
+    with metrics.span("compute", dask_obj=frac_cov_masked):
+        fractional_cover = frac_cov_masked.compute()
 
     return fractional_cover
@@ -2,12 +2,25 @@
 # Geometric median #
 ####################
 
-import odc.algo
+from datetime import date, timedelta
+import numpy as np
+import xarray as xr
 from odc.algo import to_f32, from_float, xr_geomedian
-from masking import mask_good_quality
+from chunking import plan_chunk_size
+from masking import keep_good_quality, quality_band
+import metrics
 
+DATA_BANDS = ["red", "green", "blue", "nir", "swir1", "swir2"]
 
-def process_geomedian(
+# Scale and offset of the surface reflectance values, aiming for 0-1 values in float32
+# (the scale differs per product)
+SCALE, OFFSET = 1 / 10_000, 0
+
+# Maximum number of iterations of the incremental update
+MAX_ITERATIONS = 50
+
+
+def load_geomedian_inputs(
     dc,
     product,
     query_x_from,
@@ -19,21 +32,25 @@ def process_geomedian(
     output_crs,
     query_crs="EPSG:4326",
     dask_chunk_size="1000",
+    datasets=None,
     **kwargs,
 ):
+    """
+    Load the scenes of a surface reflectance product, or of the given datasets of it, with
+    pixels of bad quality replaced by nodata, or return None if there are none
+    """
+
     time_extents = (time_from, time_to)
 
-    data_bands = ["red", "green", "blue", "nir", "swir1", "swir2"]
-    mask_bands = ["pixel_qa" if product.startswith("ls") else "scene_classification"]
+    data_bands = DATA_BANDS
+    mask_bands = [quality_band(product)]
 
     if product.startswith("ls"):
         resolution = (-30, 30)
         group_by = "solar_day"
-        nodata = -9999
     else:
         resolution = (-10, 10)
         group_by = "time"
-        nodata = 0
 
     query = {}
 
@@ -43,7 +60,6 @@ def process_geomedian(
     query["resolution"] = resolution
     query["measurements"] = data_bands + mask_bands
     query["group_by"] = group_by
-    query["dask_chunks"] = {"x": int(dask_chunk_size), "y": int(dask_chunk_size)}
 
     if query_crs != "EPSG:4326":
         query["crs"] = query_crs
@@ -51,35 +67,195 @@ def process_geomedian(
     query["x"] = (float(query_x_from), float(query_x_to))
     query["y"] = (float(query_y_from), float(query_y_to))
 
-    xx = dc.load(**query)  # use the query we defined above
+    if dask_chunk_size == "auto":
+        with metrics.span("plan"):
+            # Blocks hold every scene, plus float32 copies of the data bands
+            dask_chunk_size = plan_chunk_size(dc, query, working_bytes=4 * len(data_bands))
+
+    query["dask_chunks"] = {"x": int(dask_chunk_size), "y": int(dask_chunk_size)}
+
+    if datasets is not None:
+        query["datasets"] = datasets
+
+    with metrics.span("load") as span:
+        xx = dc.load(**query)  # use the query we defined above
+        span["bytes_loaded"] = xx.nbytes
 
     if len(xx.dims) == 0 or len(xx.data_vars) == 0:
         return None
 
-    scale, offset = (
-        1 / 10_000,  # differs per product, aim for 0-1 values in float32
-        0,
+    with metrics.span("mask"):
+        # Keep pixels with valid data (requires working with native resolution datasets),
+        # decoding the quality band and masking every band in one task per chunk
+        return keep_good_quality(xx, product, data_bands)
+
+
+def _nodata(product):
+    return -9999 if product.startswith("ls") else 0
+
+
+def _from_scaled(yy, product):
+    return from_float(
+        yy, dtype="int16",
+        nodata=_nodata(product),
+        scale=1 / SCALE,
+        offset=-OFFSET / SCALE,
     )
 
-    # Identify pixels with valid data (requires working with native resolution datasets)
-    good_quality = mask_good_quality(xx, product)
 
-    xx_data = xx[data_bands]
-    xx_clean = odc.algo.keep_good_only(xx_data, where=good_quality)
-    xx_clean = to_f32(xx_clean, scale=scale, offset=offset)
+def compute_geomedian(xx_clean, product, streaming_output="False"):
+    """
+    Return the geometric median of masked scenes, computed unless streaming_output is "True"
+    """
+
+    xx_clean = to_f32(xx_clean, scale=SCALE, offset=OFFSET)
     yy = xr_geomedian(
         xx_clean,
         num_threads=1,  # disable internal threading, dask will run several concurrently
-        eps=0.2 * scale,  # 1/5 pixel value resolution
+        eps=0.2 * SCALE,  # 1/5 pixel value resolution
         nocheck=True,  # disable some checks inside geomedian library that use too much ram
     )
-    yy = from_float(
-        yy, dtype="int16",
-        nodata=nodata,
-        scale=1 / scale,
-        offset=-offset / scale,
-    )
+    yy = _from_scaled(yy, product)
 
-    yy = yy.compute()
+    # In streaming mode blocks are computed and written one at a time at export
+    if streaming_output != "True":
+        with metrics.span("compute", dask_obj=yy):
+            yy = yy.compute()
 
     return yy
+
+
+def process_geomedian(dc, product, streaming_output="False", **kwargs):
+    xx_clean = load_geomedian_inputs(dc, product, **kwargs)
+    if xx_clean is None:
+        return None
+
+    return compute_geomedian(xx_clean, product, streaming_output)
+
+
+def _contiguous_periods(outputs, indices):
+    """
+    Return the indices of outputs grouped by runs of periods that follow each other, with the
+    first and last day of each run
+    """
+
+    runs = []
+    for index in sorted(indices, key=lambda index: outputs[index][1]["time_from"]):
+        time_from, time_to = outputs[index][1]["time_from"], outputs[index][1]["time_to"]
+        if runs and date.fromisoformat(time_from) <= date.fromisoformat(runs[-1][2]) + timedelta(days=1):
+            run_indices, run_from, run_to = runs[-1]
+            runs[-1] = (run_indices + [index], run_from, max(run_to, time_to))
+        else:
+            runs.append(([index], time_from, time_to))
+    return runs
+
+
+def process_geomedian_batch(dc, outputs, indices=None, streaming_output="False", **kwargs):
+    """
+    Yield the index and geomedian of each of the (job code, job parameters) outputs of a batch
+    job in turn, or only of the given indices of outputs. The scenes of each product are loaded,
+    masked and persisted on the dask cluster once for each run of consecutive periods, and each
+    yearly geomedian is computed from them.
+    """
+
+    if indices is None:
+        indices = range(len(outputs))
+
+    products = {}
+    for index in indices:
+        products.setdefault(outputs[index][1]["product"], []).append(index)
+
+    for product, product_indices in products.items():
+        for run_indices, time_from, time_to in _contiguous_periods(outputs, product_indices):
+            xx_clean = load_geomedian_inputs(dc, **dict(kwargs, product=product, time_from=time_from, time_to=time_to))
+            if xx_clean is None:
+                continue
+
+            xx_clean = xx_clean.persist()
+
+            for index in run_indices:
+                output_kwargs = outputs[index][1]
+                period = xx_clean.sel(time=slice(output_kwargs["time_from"], output_kwargs["time_to"]))
+                if period.sizes["time"] == 0:
+                    continue
+
+                yield index, compute_geomedian(period, product, streaming_output)
+
+            del xx_clean
+
+
+#########################
+# Incremental geomedian #
+#########################
+
+def observation_count(xx_clean):
+    """
+    Return the number of scenes with a valid observation of each pixel
+    """
+
+    return to_f32(xx_clean[DATA_BANDS[:1]], scale=SCALE, offset=OFFSET)[DATA_BANDS[0]].notnull().sum("time")
+
+
+def _weiszfeld_update(estimate, count, scenes, eps):
+    """
+    Return the weighted geometric median of the current estimates, weighted by their number of
+    observations, and of the new observations of each pixel, with the Weiszfeld algorithm.
+    The band is the last axis, preceded by the time axis of the new observations.
+    """
+
+    valid = np.all(np.isfinite(scenes), axis=-1)
+    has_estimate = np.all(np.isfinite(estimate), axis=-1) & (count > 0)
+
+    weights = np.concatenate([np.where(has_estimate, count, 0)[..., None], valid], axis=-1).astype("float32")
+    points = np.concatenate([np.nan_to_num(estimate)[..., None, :], np.nan_to_num(scenes)], axis=-2)
+
+    total = weights.sum(axis=-1)
+    # Start from the weighted mean
+    yy = (weights[..., None] * points).sum(axis=-2) / np.maximum(total, 1)[..., None]
+
+    for _ in range(MAX_ITERATIONS):
+        distance = np.linalg.norm(points - yy[..., None, :], axis=-1)
+        inverse = weights / np.maximum(distance, eps)
+        yy_next = (inverse[..., None] * points).sum(axis=-2) / np.maximum(inverse.sum(axis=-1), eps)[..., None]
+
+        converged = np.all(np.linalg.norm(yy_next - yy, axis=-1) < eps)
+        yy = yy_next
+        if converged:
+            break
+
+    yy[total == 0] = np.nan
+    return yy.astype("float32")
+
+
+def update_geomedian(estimate, count, xx_clean, product):
+    """
+    Return the geometric median of a previous estimate, computed from count observations per
+    pixel, refined with new masked scenes, and the updated count, without computing them. The
+    estimate is a dataset of the int16 bands of a geomedian output over the pixels of the scenes.
+    """
+
+    nodata = _nodata(product)
+    estimate = estimate[DATA_BANDS].where(estimate[DATA_BANDS[0]] != nodata) * SCALE + OFFSET
+
+    # The estimate and count are chunked spatially like the scenes. The scenes are loaded a
+    # scene per block, so their blocks are merged along time and band, the core dimensions of
+    # the update
+    chunks = {"y": xx_clean.chunks["y"], "x": xx_clean.chunks["x"]}
+    estimate = estimate.to_array("band").chunk(dict(chunks, band=-1))
+    count = count.chunk(chunks)
+    scenes = to_f32(xx_clean[DATA_BANDS], scale=SCALE, offset=OFFSET).to_array("band").chunk({"time": -1, "band": -1})
+
+    yy = xr.apply_ufunc(
+        _weiszfeld_update,
+        estimate, count, scenes,
+        input_core_dims=[["band"], [], ["time", "band"]],
+        output_core_dims=[["band"]],
+        kwargs={"eps": 0.2 * SCALE},
+        dask="parallelized",
+        output_dtypes=[np.float32],
+    )
+    yy = _from_scaled(yy.to_dataset("band"), product)
+
+    count = count + observation_count(xx_clean)
+
+    return yy, count
@@ -0,0 +1,179 @@
+#########################
+# Incremental geomedian #
+#########################
+
+# Keeps the geomedian of a tile up to date as new scenes are indexed, by refining the last
+# estimate with the new scenes only. Each run saves the number of observations of every pixel
+# as a `count` band next to the outputs, and the ids of the datasets used, with the number of
+# scenes used, in a state file.
+
+import logging
+import xarray as xr
+from rasterio.io import MemoryFile
+from geomedian import DATA_BANDS, compute_geomedian, load_geomedian_inputs, observation_count, update_geomedian
+from index_cache import CachedDatacube
+from metadata import band_files
+from utils import STATE_BANDS, get_output_base_name, get_product_resolution, predict_ds_extents, \
+    read_incremental_state
+import metrics
+
+
+def read_output_bands(s3_client, bucket, prefix, base_name, bands, output_layout="separate"):
+    """
+    Return the arrays of the bands of an output in the bucket, or None if any is missing
+    """
+
+    files = {}
+    arrays = {}
+
+    for band, (fname, index) in band_files(base_name, bands, output_layout).items():
+        if fname not in files:
+            files[fname] = s3_client.read_object(bucket, f"{prefix}/{fname}")
+        if files[fname] is None:
+            return None
+
+        with MemoryFile(files[fname]) as memfile:
+            with memfile.open() as src:
+                arrays[band] = src.read(index)
+
+    return arrays
+
+
+def _search(product, query_x_from, query_x_to, query_y_from, query_y_to, time_from, time_to,
+            query_crs="EPSG:4326"):
+    search = {
+        "product": product,
+        "time": (time_from, time_to),
+        "x": (float(query_x_from), float(query_x_to)),
+        "y": (float(query_y_from), float(query_y_to)),
+    }
+    if query_crs != "EPSG:4326":
+        search["crs"] = query_crs
+    return search
+
+
+def process_geomedian_incremental(
+    dc,
+    s3_client,
+    product,
+    query_x_from,
+    query_x_to,
+    query_y_from,
+    query_y_to,
+    time_from,
+    time_to,
+    output_crs,
+    query_crs="EPSG:4326",
+    bucket="public-eo-data",
+    prefix="luigi",
+    epsg4326_naming="False",
+    output_layout="separate",
+    output_format="geotiff",
+    incremental_max_fraction="0.5",
+    streaming_output="False",
+    **kwargs,
+):
+    """
+    Return the geomedian of a tile and its observation count, refined from the last run with
+    the datasets it did not use, or None if there are none.
+
+    The update treats the last estimate as a single observation weighted by the number of
+    observations it was computed from, so it drifts from the exact geomedian as updates add up.
+    The geomedian is computed from every scene again once the scenes added by updates exceed
+    incremental_max_fraction of the scenes of the last full computation.
+    """
+
+    query = dict(kwargs, product=product, query_x_from=query_x_from, query_x_to=query_x_to,
+                 query_y_from=query_y_from, query_y_to=query_y_to, time_from=time_from, time_to=time_to,
+                 output_crs=output_crs, query_crs=query_crs)
+
+    # Datasets indexed since the last run must be found straight away, so the cache is bypassed
+    index_dc = dc.dc if isinstance(dc, CachedDatacube) else dc
+    datasets = index_dc.find_datasets(ensure_location=True,
+                                      **_search(product, query_x_from, query_x_to, query_y_from, query_y_to,
+                                                time_from, time_to, query_crs=query_crs))
+    if not datasets:
+        return None
+
+    state = None
+    base_name = None
+
+    # Output names are only known ahead of loading when the query is in the output CRS
+    if query_crs != output_crs or epsg4326_naming == "True" or output_format != "geotiff":
+        logging.warning("Incremental updates need GeoTIFF outputs named in the query CRS, computing in full.")
+    else:
+        x_from, x_to, y_from, y_to = predict_ds_extents(query_x_from, query_x_to, query_y_from, query_y_to,
+                                                        get_product_resolution(product))
+        base_name = get_output_base_name(product, "geomedian", time_from, time_to, output_crs,
+                                         x_from, x_to, y_from, y_to)
+        state = read_incremental_state(s3_client, bucket, prefix, base_name)
+
+    dataset_ids = sorted(str(ds.id) for ds in datasets)
+    new_datasets = datasets
+
+    # Datasets are told apart by id rather than by indexed time, as the transactions indexing
+    # them can commit in another order than their indexed times
+    if state is not None and "dataset_ids" not in state:
+        logging.info("The last run did not record its datasets, computing in full.")
+        state = None
+    elif state is not None and not set(state["dataset_ids"]) <= set(dataset_ids):
+        logging.info("Datasets used by the last run were archived, computing in full.")
+        state = None
+
+    if state is not None:
+        used = set(state["dataset_ids"])
+        new_datasets = [ds for ds in datasets if str(ds.id) not in used]
+        if not new_datasets:
+            logging.info("No new datasets, the geomedian is up to date.")
+            return None
+
+        if state["incremental_scenes"] + len(new_datasets) > float(incremental_max_fraction) * state["full_scenes"]:
+            logging.info("Too many scenes since the last full computation, computing in full.")
+            state = None
+
+    yy = None
+
+    if state is not None:
+        xx_clean = load_geomedian_inputs(dc, datasets=new_datasets, **query)
+        if xx_clean is None:
+            return None
+
+        with metrics.span("load") as span:
+            arrays = read_output_bands(s3_client, bucket, prefix, base_name, DATA_BANDS + STATE_BANDS, output_layout)
+            span["bytes_loaded"] = sum(array.nbytes for array in arrays.values()) if arrays else 0
+
+        shape = (xx_clean.sizes["y"], xx_clean.sizes["x"])
+        if arrays is None or any(array.shape != shape for array in arrays.values()):
+            logging.warning("Could not read the outputs of the last run, computing in full.")
+            state = None
+        else:
+            logging.info("Updating the geomedian with %d new datasets.", len(new_datasets))
+
+            coords = {"y": xx_clean.y, "x": xx_clean.x}
+            estimate = xr.Dataset({band: (("y", "x"), arrays[band]) for band in DATA_BANDS}, coords=coords)
+            count = xr.DataArray(arrays["count"], dims=("y", "x"), coords=coords)
+            count = count.where(count > 0, 0)
+
+            yy, count = update_geomedian(estimate, count, xx_clean, product)
+            state = dict(state,
+                         dataset_ids=dataset_ids,
+                         incremental_scenes=state["incremental_scenes"] + len(new_datasets))
+
+    if yy is None:
+        xx_clean = load_geomedian_inputs(dc, datasets=datasets, **query)
+        if xx_clean is None:
+            return None
+
+        yy = compute_geomedian(xx_clean, product, streaming_output="True")
+        count = observation_count(xx_clean)
+        state = {"dataset_ids": dataset_ids, "full_scenes": len(datasets), "incremental_scenes": 0}
+
+    yy["count"] = count.astype("int16")
+
+    # In streaming mode blocks are computed and written one at a time at export
+    if streaming_output != "True":
+        with metrics.span("compute", dask_obj=yy):
+            yy = yy.compute()
+
+    yy.attrs["incremental_state"] = state
+    return yy
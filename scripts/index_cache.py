@@ -0,0 +1,164 @@
+#######################
+# Dataset index cache #
+#######################
+
+# Caches the datasets found in the index for recent queries, so that repeated and overlapping
+# queries, e.g. the geomedian then fractional cover of a tile or adjacent overlapping tiles,
+# are answered without a database round trip.
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datacube.utils.geometry import box
+
+# Query terms a cached search can be made of, anything else goes to the index
+SEARCH_TERMS = {"product", "time", "x", "y", "crs"}
+
+
+def _search_key(query):
+    """Return the (product, time, crs) of a search and its extent, or None if it can't be cached."""
+    if not set(query) <= SEARCH_TERMS or not {"product", "x", "y"} <= set(query):
+        return None
+
+    crs = query.get("crs", "EPSG:4326")
+    time = query.get("time")
+    time = tuple(str(t) for t in time) if isinstance(time, (list, tuple)) else time
+
+    x_from, x_to = sorted(float(x) for x in query["x"])
+    y_from, y_to = sorted(float(y) for y in query["y"])
+
+    return (query["product"], time, crs), (x_from, y_from, x_to, y_to)
+
+
+class _Region:
+    """The datasets found for a product and time over an extent."""
+
+    def __init__(self, bounds, crs, datasets, expires):
+        self.bounds = bounds
+        self.extent = box(*bounds, crs)
+        self.expires = expires
+        # Dataset footprints in the CRS of the query, to select the datasets of smaller extents
+        self.datasets = [(ds, ds.extent.to_crs(self.extent.crs) if ds.extent is not None else None)
+                         for ds in datasets]
+
+    def contains(self, bounds):
+        x_from, y_from, x_to, y_to = bounds
+        left, bottom, right, top = self.bounds
+        return left <= x_from and bottom <= y_from and x_to <= right and y_to <= top
+
+    def select(self, bounds):
+        extent = box(*bounds, self.extent.crs)
+        return [ds for ds, footprint in self.datasets if footprint is None or footprint.intersects(extent)]
+
+
+class CachedDatacube:
+    """
+    Wraps a `datacube.Datacube`, caching the datasets found for each product, time and extent
+    for ttl_secs, and keeping at most max_entries searches, the least recently used being
+    evicted first. A search is answered from the cache when a cached search of the same
+    product and time covers its extent.
+
+    `load` resolves its datasets through the cache, and `prefetch` resolves the datasets of
+    many queries, e.g. of a batch of queued tiles, in one search per product and time.
+    Everything else is passed through to the wrapped instance.
+    """
+
+    def __init__(self, dc, ttl_secs=600, max_entries=256):
+        self.dc = dc
+        self.ttl_secs = ttl_secs
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._regions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.dc, name)
+
+    def _lookup(self, key, bounds):
+        now = time.monotonic()
+        for region_key, region in list(self._regions.items()):
+            if region.expires <= now:
+                del self._regions[region_key]
+            elif region_key[0] == key and region.contains(bounds):
+                self._regions.move_to_end(region_key)
+                return region
+        return None
+
+    def _store(self, key, bounds, datasets):
+        region = _Region(bounds, key[2], datasets, time.monotonic() + self.ttl_secs)
+        with self._lock:
+            self._regions[(key, bounds)] = region
+            self._regions.move_to_end((key, bounds))
+            while len(self._regions) > self.max_entries:
+                self._regions.popitem(last=False)
+
+    def find_datasets(self, ensure_location=False, **query):
+        search = _search_key(query)
+        if search is None:
+            return self.dc.find_datasets(ensure_location=ensure_location, **query)
+
+        key, bounds = search
+        with self._lock:
+            region = self._lookup(key, bounds)
+            if region is not None:
+                self.hits += 1
+                datasets = region.select(bounds)
+            else:
+                self.misses += 1
+
+        if region is None:
+            datasets = self.dc.find_datasets(**query)
+            self._store(key, bounds, datasets)
+
+        # Cached searches hold every dataset, the ones without a location are filtered out as
+        # by the index
+        return [ds for ds in datasets if ds.uris] if ensure_location else datasets
+
+    def load(self, **query):
+        if "datasets" in query or "product" not in query:
+            return self.dc.load(**query)
+
+        # As Datacube.load does, datasets that can't be read are left out
+        search = {term: query[term] for term in SEARCH_TERMS if term in query}
+        datasets = self.find_datasets(ensure_location=True, **search)
+        return self.dc.load(datasets=datasets, **query)
+
+    def prefetch(self, queries):
+        """
+        Resolve the datasets of many searches with one search of the union of their extents
+        per product, time and CRS, and return the number of searches made
+        """
+
+        groups = {}
+        for query in queries:
+            search = _search_key(query)
+            if search is None:
+                continue
+
+            key, bounds = search
+            with self._lock:
+                if self._lookup(key, bounds) is not None:
+                    continue
+
+            union = groups.get(key)
+            groups[key] = bounds if union is None else (min(union[0], bounds[0]), min(union[1], bounds[1]),
+                                                        max(union[2], bounds[2]), max(union[3], bounds[3]))
+
+        for (product, time_range, crs), (x_from, y_from, x_to, y_to) in groups.items():
+            query = {"product": product, "x": (x_from, x_to), "y": (y_from, y_to)}
+            if time_range is not None:
+                query["time"] = time_range
+            if crs != "EPSG:4326":
+                query["crs"] = crs
+
+            datasets = self.dc.find_datasets(**query)
+            self._store((product, time_range, crs), (x_from, y_from, x_to, y_to), datasets)
+            logging.info("Prefetched %d datasets of %s.", len(datasets), product)
+
+        return len(groups)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._regions)}
@@ -1,35 +1,83 @@
+import numpy as np
+import xarray as xr
+
+# Quality values of good pixels, per product family
+GOOD_QUALITY_VALUES = {
+    # scene_classification: dark area pixels, vegetation, not vegetated, water, unclassified
+    's2': [2, 4, 5, 6, 7],
+    # pixel_qa: clear, then water
+    'ls8': [322, 386, 834, 898, 1346, 324, 388, 836, 900, 1348],
+    'ls': [66, 130, 68, 132],
+}
+
+
+def _product_family(product):
+    if product.startswith('s2'):
+        return 's2'
+    elif product.startswith('ls8'):
+        return 'ls8'
+    else:
+        return 'ls'
+
+
+def quality_band(product):
+    """
+    Return the name of the quality band of a product
+    """
+
+    return 'scene_classification' if product.startswith('s2') else 'pixel_qa'
+
+
+def good_quality_lut(product):
+    """
+    Return a lookup table from quality value to good pixel. The table is one entry longer than
+    the largest good value, so that indices clipped to its end map to False.
+    """
+
+    values = GOOD_QUALITY_VALUES[_product_family(product)]
+    lut = np.zeros(max(values) + 2, dtype=bool)
+    lut[values] = True
+    return lut
+
+
+def _lookup(qa, lut):
+    return lut.take(qa, mode='clip')
+
+
 def mask_good_quality(ds, product):
     """
     Identify pixels with valid data (requires working with native resolution datasets)
     """
 
-    if product.startswith('s2'):
-        good_quality = (
-            (ds.scene_classification == 2) | # clear, mask in DARK_AREA_PIXELS
-            (ds.scene_classification == 4) | #        mask in VEGETATION
-            (ds.scene_classification == 5) | #        mask in NOT_VEGETATED
-            (ds.scene_classification == 7) | #        mask in UNCLASSIFIED
-            (ds.scene_classification == 6)   # water, mask in WATER
-        )
-    elif product.startswith('ls8'):
-        good_quality = (
-            (ds.pixel_qa == 322)  | # clear
-            (ds.pixel_qa == 386)  |
-            (ds.pixel_qa == 834)  |
-            (ds.pixel_qa == 898)  |
-            (ds.pixel_qa == 1346) |
-            (ds.pixel_qa == 324)  | # water
-            (ds.pixel_qa == 388)  |
-            (ds.pixel_qa == 836)  |
-            (ds.pixel_qa == 900)  |
-            (ds.pixel_qa == 1348)
-        )
-    else:
-        good_quality = (
-            (ds.pixel_qa == 66)   | # clear
-            (ds.pixel_qa == 130)  |
-            (ds.pixel_qa == 68)   | # water
-            (ds.pixel_qa == 132)
-        )
-
-    return good_quality
+    return xr.apply_ufunc(_lookup, ds[quality_band(product)],
+                          kwargs={'lut': good_quality_lut(product)},
+                          dask='parallelized', output_dtypes=[bool])
+
+
+def _keep_good_block(block, data_bands, qa_band, lut):
+    good = _lookup(block[qa_band].values, lut)
+
+    clean = {}
+    for band in data_bands:
+        data = block[band]
+        nodata = data.attrs.get('nodata')
+        if nodata is None:
+            nodata = np.nan if data.dtype.kind == 'f' else 0
+        clean[band] = data.copy(data=np.where(good, data.values, np.array(nodata, dtype=data.dtype)))
+
+    return xr.Dataset(clean, attrs=block.attrs)
+
+
+def keep_good_quality(ds, product, data_bands):
+    """
+    Replace pixels with bad quality by nodata in data_bands, equivalent to
+    `odc.algo.keep_good_only(ds[data_bands], where=mask_good_quality(ds, product))`
+    but with the mask decoded and applied to all bands in a single task per chunk
+    """
+
+    qa_band = quality_band(product)
+
+    return xr.map_blocks(_keep_good_block, ds[data_bands + [qa_band]],
+                         kwargs={'data_bands': data_bands, 'qa_band': qa_band,
+                                 'lut': good_quality_lut(product)},
+                         template=ds[data_bands])
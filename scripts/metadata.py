@@ -2,6 +2,41 @@ import uuid
 from datetime import datetime
 import yaml
 
+# Layouts of the band files of an output: one file per band, or all bands in a single band
+# interleaved or pixel interleaved file, mapped to the GDAL INTERLEAVE option of the latter
+OUTPUT_LAYOUTS = {
+    'separate': None,
+    'band': 'BAND',
+    'pixel': 'PIXEL',
+}
+
+
+def band_files(band_base_name, bands, output_layout='separate', output_format='geotiff'):
+    """
+    Return the file name and the 1-based index in that file of each band of an output, or for
+    the zarr output format the name of the store and of the band's array in it
+    """
+
+    if output_format == 'zarr':
+        return {band: (f"{band_base_name}.zarr", band) for band in bands}
+
+    if output_layout not in OUTPUT_LAYOUTS:
+        raise ValueError(f"Unknown output layout {output_layout}, expected one of {', '.join(OUTPUT_LAYOUTS)}")
+
+    if OUTPUT_LAYOUTS[output_layout] is None:
+        return {band: (f"{band_base_name}_{band}.tif", 1) for band in bands}
+
+    return {band: (f"{band_base_name}_bands.tif", index + 1) for index, band in enumerate(bands)}
+
+
+def _band_doc(path, layer, output_layout):
+    doc = {'path': path}
+    if OUTPUT_LAYOUTS[output_layout] is not None:
+        # The datacube reads the band of a multiband GeoTIFF given by `band`, `layer` is for NetCDF
+        doc['band'] = layer
+    return doc
+
+
 def generate_datacube_metadata(metadata_obj_key,
                                bands,
                                band_base_name,
@@ -14,14 +49,15 @@ def generate_datacube_metadata(metadata_obj_key,
                                output_crs,
                                x_from, x_to,
                                y_from, y_to,
+                               output_layout='separate',
+                               output_format='geotiff',
                                **kwargs):
     doc = {
         'id': str(uuid.uuid5(uuid.NAMESPACE_URL, metadata_obj_key)),
         'image': {
             'bands': {
-                band: {
-                    'path': f"{band_base_name}_{band}.tif"
-                } for band in bands
+                band: _band_doc(path, layer, output_layout)
+                for band, (path, layer) in band_files(band_base_name, bands, output_layout, output_format).items()
             }
         },
         'extent': {
@@ -0,0 +1,267 @@
+###############
+# Job metrics #
+###############
+
+# Per-stage instrumentation of jobs: each job logs one JSON line with the wall time, memory,
+# bytes loaded/written and dask task count of its stages, and totals are exposed in the
+# Prometheus text format on the worker.
+
+import contextvars
+import json
+import logging
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The job being processed by the current thread
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+# Seconds between samples of the resident set size of the worker process during spans
+RSS_SAMPLE_SECS = 0.5
+
+# The measurements of the spans in progress, whose peak RSS is updated by the sampler
+_open_spans = set()
+_open_spans_lock = threading.Lock()
+_sampler = None
+
+
+def _rss_bytes():
+    """Return the current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class _Peak:
+    """The peak resident set size seen while a span is open."""
+
+    def __init__(self):
+        self.rss_bytes = _rss_bytes()
+
+    def sample(self, rss_bytes):
+        self.rss_bytes = max(self.rss_bytes, rss_bytes)
+
+
+def _sample_rss():
+    while True:
+        time.sleep(RSS_SAMPLE_SECS)
+        rss_bytes = _rss_bytes()
+        with _open_spans_lock:
+            for peak in _open_spans:
+                peak.sample(rss_bytes)
+
+
+def _open_peak():
+    """
+    Start tracking the peak RSS of a span. The process-wide high-water mark can't be used as
+    it never goes down between jobs, so the RSS is sampled from a background thread instead.
+    """
+    global _sampler
+    peak = _Peak()
+    with _open_spans_lock:
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample_rss, name="rss-sampler", daemon=True)
+            _sampler.start()
+        _open_spans.add(peak)
+    return peak
+
+
+def _close_peak(peak):
+    with _open_spans_lock:
+        _open_spans.discard(peak)
+    peak.sample(_rss_bytes())
+    return peak.rss_bytes
+
+
+def count_tasks(obj):
+    """Return the number of tasks in the graph of a dask-backed object, 0 otherwise."""
+    graph = getattr(obj, "__dask_graph__", lambda: None)()
+    return len(graph) if graph is not None else 0
+
+
+class JobMetrics:
+    """Measurements of the stages of a single job."""
+
+    def __init__(self, job_code, **labels):
+        self.job_code = job_code
+        self.labels = labels
+        self.status = "ok"
+        self.stages = {}
+        self._start = time.monotonic()
+        self.wall_secs = None
+
+    def stage(self, name):
+        """Return the measurements of a stage, created on first use."""
+        return self.stages.setdefault(name, {
+            "wall_secs": 0.0,
+            "max_rss_bytes": 0,
+            "bytes_loaded": 0,
+            "bytes_written": 0,
+            "dask_tasks": 0,
+        })
+
+    def finish(self):
+        self.wall_secs = time.monotonic() - self._start
+
+    def to_dict(self):
+        return {
+            "job_code": self.job_code,
+            **self.labels,
+            "status": self.status,
+            "wall_secs": self.wall_secs,
+            "max_rss_bytes": max((stage["max_rss_bytes"] for stage in self.stages.values()), default=0),
+            "stages": self.stages,
+        }
+
+
+class MetricsRegistry:
+    """Totals over all finished jobs, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._stages = {}
+        self._counters = {}
+        self.last_job = None
+
+    def observe(self, metrics):
+        with self._lock:
+            self.last_job = metrics.to_dict()
+            key = (metrics.job_code, metrics.status)
+            self._jobs[key] = self._jobs.get(key, 0) + 1
+            for name, values in metrics.stages.items():
+                totals = self._stages.setdefault((metrics.job_code, name), {})
+                for field, value in values.items():
+                    if field == "max_rss_bytes":
+                        totals[field] = max(totals.get(field, 0), value)
+                    else:
+                        totals[field] = totals.get(field, 0) + value
+
+    def count(self, name, value):
+        """Add to a counter that is not per job, e.g. of the dask workers."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def render(self):
+        lines = [
+            "# TYPE odc_jobs_total counter",
+        ]
+        with self._lock:
+            for (job_code, status), count in sorted(self._jobs.items()):
+                lines.append(f'odc_jobs_total{{job_code="{job_code}",status="{status}"}} {count}')
+
+            fields = [
+                ("wall_secs", "odc_job_stage_seconds_total", "counter"),
+                ("bytes_loaded", "odc_job_stage_bytes_loaded_total", "counter"),
+                ("bytes_written", "odc_job_stage_bytes_written_total", "counter"),
+                ("dask_tasks", "odc_job_stage_dask_tasks_total", "counter"),
+                ("max_rss_bytes", "odc_job_stage_max_rss_bytes", "gauge"),
+            ]
+            for field, metric, kind in fields:
+                lines.append(f"# TYPE {metric} {kind}")
+                for (job_code, stage), totals in sorted(self._stages.items()):
+                    lines.append(f'{metric}{{job_code="{job_code}",stage="{stage}"}} {totals.get(field, 0)}')
+
+            for name, value in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name} {value}")
+
+        lines.append("# TYPE odc_worker_rss_bytes gauge")
+        lines.append(f"odc_worker_rss_bytes {_rss_bytes()}")
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+@contextmanager
+def job(job_code, **labels):
+    """Collect metrics for the stages run by this thread, then log and register them."""
+    metrics = JobMetrics(job_code, **labels)
+    token = _current_job.set(metrics)
+
+    try:
+        yield metrics
+
+    except BaseException:
+        metrics.status = "failed"
+        raise
+
+    finally:
+        _current_job.reset(token)
+        metrics.finish()
+        REGISTRY.observe(metrics)
+        logging.info("Job metrics %s", json.dumps(metrics.to_dict()))
+
+
+def current_job():
+    """Return the metrics of the job being processed by this thread, if any."""
+    return _current_job.get()
+
+
+@contextmanager
+def span(name, dask_obj=None):
+    """
+    Time a stage of the current job. Stages run more than once, e.g. per band, are summed.
+    The yielded dict can be updated with bytes_loaded, the in-memory size of the arrays loaded
+    (not the bytes read from storage), and bytes_written, and dask_obj is used to count the
+    tasks that are about to be computed.
+    """
+    metrics = _current_job.get()
+    extra = {"bytes_loaded": 0, "bytes_written": 0, "dask_tasks": count_tasks(dask_obj) if dask_obj is not None else 0}
+    start = time.monotonic()
+    peak = _open_peak()
+
+    try:
+        yield extra
+
+    finally:
+        max_rss_bytes = _close_peak(peak)
+        if metrics is not None:
+            stage = metrics.stage(name)
+            stage["wall_secs"] += time.monotonic() - start
+            stage["max_rss_bytes"] = max(stage["max_rss_bytes"], max_rss_bytes)
+            for field, value in extra.items():
+                stage[field] += value
+
+
+def add(name, **values):
+    """Add to the counters of a stage of the current job, e.g. bytes_written."""
+    metrics = _current_job.get()
+    if metrics is not None:
+        stage = metrics.stage(name)
+        for field, value in values.items():
+            stage[field] += value
+
+
+##################
+# Metrics server #
+##################
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    """Serve the metrics at /metrics on the given port from a background thread."""
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,181 @@
+##################
+# Mosaic builder #
+##################
+
+# Builds a GDAL VRT per band (or multiband) file name over the files of pixel aligned tiles,
+# e.g. as planned by enqueue.py, so that a whole region can be read as one raster. The tiles
+# are referenced relative to the VRT, which is uploaded next to them.
+
+import argparse
+import io
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+import rasterio
+from s3 import S3Client
+
+# Band files are named {stem}_{x_from}_{y_from}_{x_to}_{y_to}_{band}.tif, see utils.get_output_base_name
+BAND_FILE = re.compile(r"^(?P<stem>.+)_(?P<extent>-?[\d.]+_-?[\d.]+_-?[\d.]+_-?[\d.]+)_(?P<band>[^_]+)\.tif$")
+
+GDAL_TYPES = {
+    'uint8': 'Byte',
+    'int16': 'Int16',
+    'uint16': 'UInt16',
+    'int32': 'Int32',
+    'uint32': 'UInt32',
+    'float32': 'Float32',
+    'float64': 'Float64',
+}
+
+
+def group_band_files(keys):
+    """
+    Return the keys of the band files under a prefix grouped by mosaic, i.e. by the name of
+    their files without the extents
+    """
+
+    mosaics = {}
+    for key in sorted(keys):
+        match = BAND_FILE.match(os.path.basename(key))
+        if match:
+            mosaics.setdefault(f"{match['stem']}_{match['band']}", []).append(key)
+    return mosaics
+
+
+def _gdal_env():
+    """Return the GDAL settings to read the bucket with the credentials of S3Client."""
+    endpoint_url = os.getenv("AWS_S3_ENDPOINT_URL")
+    if not endpoint_url:
+        return {}
+
+    return {
+        'AWS_S3_ENDPOINT': re.sub(r"^https?://", "", endpoint_url),
+        'AWS_HTTPS': 'NO' if endpoint_url.startswith('http://') else 'YES',
+        'AWS_VIRTUAL_HOSTING': 'FALSE',
+    }
+
+
+def read_tiles(bucket, keys):
+    """Return the georeferencing and layout of each file."""
+    tiles = []
+    with rasterio.Env(**_gdal_env()):
+        for key in keys:
+            with rasterio.open(f"/vsis3/{bucket}/{key}") as src:
+                tiles.append({
+                    'name': os.path.basename(key),
+                    'crs': src.crs,
+                    'transform': src.transform,
+                    'width': src.width,
+                    'height': src.height,
+                    'count': src.count,
+                    'dtype': src.dtypes[0],
+                    'nodata': src.nodata,
+                    'block': src.block_shapes[0],
+                })
+    return tiles
+
+
+def build_vrt(tiles):
+    """
+    Return the XML of a VRT mosaicking tiles that share a CRS, resolution, pixel grid and
+    number of bands
+    """
+
+    first = tiles[0]
+    x_res, y_res = first['transform'].a, first['transform'].e
+
+    for tile in tiles:
+        if (tile['crs'] != first['crs'] or (tile['transform'].a, tile['transform'].e) != (x_res, y_res)
+                or tile['count'] != first['count']):
+            raise ValueError(f"{tile['name']} does not have the CRS, resolution and bands of {first['name']}")
+
+    left = min(tile['transform'].c for tile in tiles)
+    top = max(tile['transform'].f for tile in tiles)
+    right = max(tile['transform'].c + tile['width'] * x_res for tile in tiles)
+    bottom = min(tile['transform'].f + tile['height'] * y_res for tile in tiles)
+
+    def _offset(value, origin, res, name):
+        offset = (value - origin) / res
+        if abs(offset - round(offset)) > 0.01:
+            raise ValueError(f"{name} is not aligned to the pixel grid of the mosaic")
+        return int(round(offset))
+
+    width = _offset(right, left, x_res, "The mosaic")
+    height = _offset(bottom, top, y_res, "The mosaic")
+
+    vrt = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    ET.SubElement(vrt, 'SRS').text = first['crs'].to_wkt()
+    ET.SubElement(vrt, 'GeoTransform').text = f"{left!r}, {x_res!r}, 0.0, {top!r}, 0.0, {y_res!r}"
+
+    data_type = GDAL_TYPES[first['dtype']]
+    offsets = [(_offset(tile['transform'].c, left, x_res, tile['name']),
+                _offset(tile['transform'].f, top, y_res, tile['name'])) for tile in tiles]
+
+    for index in range(1, first['count'] + 1):
+        band = ET.SubElement(vrt, 'VRTRasterBand', dataType=data_type, band=str(index))
+        if first['nodata'] is not None:
+            ET.SubElement(band, 'NoDataValue').text = repr(first['nodata'])
+
+        for tile, (x_off, y_off) in zip(tiles, offsets):
+            size = {'xSize': str(tile['width']), 'ySize': str(tile['height'])}
+
+            source = ET.SubElement(band, 'ComplexSource' if tile['nodata'] is not None else 'SimpleSource')
+            ET.SubElement(source, 'SourceFilename', relativeToVRT="1").text = tile['name']
+            ET.SubElement(source, 'SourceBand').text = str(index)
+            ET.SubElement(source, 'SourceProperties', RasterXSize=str(tile['width']), RasterYSize=str(tile['height']),
+                          DataType=GDAL_TYPES[tile['dtype']],
+                          BlockXSize=str(tile['block'][1]), BlockYSize=str(tile['block'][0]))
+            ET.SubElement(source, 'SrcRect', xOff="0", yOff="0", **size)
+            ET.SubElement(source, 'DstRect', xOff=str(x_off), yOff=str(y_off), **size)
+            if tile['nodata'] is not None:
+                ET.SubElement(source, 'NODATA').text = repr(tile['nodata'])
+
+    return ET.tostring(vrt, encoding='unicode')
+
+
+def build_mosaics(s3_client, bucket, prefix):
+    """
+    Build and upload a VRT for every band of every product and period under a prefix, and
+    return their keys
+    """
+
+    prefix = prefix.rstrip('/')
+    keys = s3_client.list_keys(bucket, f"{prefix}/")
+
+    uploads = []
+    destinations = []
+
+    for name, band_keys in group_band_files(keys).items():
+        destination = f"{prefix}/{name}.vrt"
+        logging.info("Building %s from %d tiles.", destination, len(band_keys))
+
+        vrt = build_vrt(read_tiles(bucket, band_keys))
+
+        uploads.append(s3_client.upload_fileobj_async(io.BytesIO(vrt.encode()), bucket, destination))
+        destinations.append(destination)
+
+    failed = s3_client.wait(uploads)
+    if failed:
+        raise RuntimeError(f"{failed} of {len(uploads)} mosaic uploads failed")
+
+    return destinations
+
+
+########
+# Main #
+########
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Build VRT mosaics of the band files of the tiles under a prefix.")
+    parser.add_argument("--bucket", default="public-eo-data")
+    parser.add_argument("--prefix", required=True, help="e.g. common_sensing/fiji/sentinel_2_geomedian/2019")
+    args = parser.parse_args()
+
+    destinations = build_mosaics(S3Client(), args.bucket, args.prefix)
+    logging.info("Built %d mosaics.", len(destinations))
+
+if __name__ == '__main__':
+    main()
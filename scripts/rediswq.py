@@ -8,6 +8,86 @@
 import redis
 import uuid
 import hashlib
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Atomically move an item from the main queue to the processing queue. Prioritised items, i.e.
+# the one with the lowest score in the priority set, are served before the main list.
+_LEASE_SCRIPT = """
+local item = redis.call('zrange', KEYS[3], 0, 0)[1]
+if item then
+  redis.call('zrem', KEYS[3], item)
+  redis.call('lpush', KEYS[2], item)
+else
+  item = redis.call('rpoplpush', KEYS[1], KEYS[2])
+end
+return item
+"""
+
+# Add items, given as pairs of item key and item, to the priority set unless they are already
+# queued or being processed, which is tracked in a hash of item keys to their scores. Scores are
+# the lane offset plus a sequence number, so that items are served in order of priority and then
+# of submission.
+_PUT_SCRIPT = """
+local added = 0
+local offset = tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+  local itemkey = ARGV[i]
+  if redis.call('hexists', KEYS[2], itemkey) == 0 then
+    local score = offset + redis.call('incr', KEYS[3])
+    redis.call('hset', KEYS[2], itemkey, score)
+    redis.call('zadd', KEYS[1], score, ARGV[i + 1])
+    added = added + 1
+  end
+end
+return added
+"""
+
+# Move the given items of the processing queue whose lease has expired back to where they came
+# from: prioritised items go back to the priority set with their original score, others are
+# pushed where lease() pops from the main queue so that they are picked up next. The lease key of
+# the item ARGV[2 * i] is KEYS[4 + i] and its item key ARGV[2 * i - 1].
+_CHECK_EXPIRED_LEASES_SCRIPT = """
+local requeued = 0
+for i = 1, #ARGV / 2 do
+  local itemkey, item = ARGV[2 * i - 1], ARGV[2 * i]
+  if redis.call('exists', KEYS[4 + i]) == 0 and redis.call('lrem', KEYS[2], 1, item) == 1 then
+    local score = redis.call('hget', KEYS[4], itemkey)
+    if score then
+      redis.call('zadd', KEYS[3], score, item)
+    else
+      redis.call('rpush', KEYS[1], item)
+    end
+    requeued = requeued + 1
+  end
+end
+return requeued
+"""
+
+# Remove a completed item from the processing queue and from the items tracked, and release its
+# lease, provided it still belongs to the given session.
+_COMPLETE_SCRIPT = """
+redis.call('lrem', KEYS[1], 0, ARGV[1])
+if redis.call('get', KEYS[2]) == ARGV[3] then
+  redis.call('del', KEYS[2])
+end
+return redis.call('hdel', KEYS[3], ARGV[2])
+"""
+
+# Extend a lease, provided it still belongs to the given session.
+_RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+  return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Seconds an item of the processing queue must have been seen without a lease before it is
+# returned to the work queue, much longer than lease() takes to set the lease after the move
+LEASE_GRACE_SECS = 10
 
 class RedisWQ(object):
     """Simple Finite Work Queue with Redis Backend
@@ -16,10 +96,16 @@ class RedisWQ(object):
     after workers start, the workers can detect when the queue
     is completely empty.
 
-    The items in the work queue are assumed to have unique values.
+    The items in the work queue are assumed to have unique values. Items added
+    with put() are de-duplicated against those queued or being processed, and
+    are served by priority before any item pushed directly to the main list.
+
+    Leases of crashed workers are returned to the work queue by
+    check_expired_leases(), while the lease of an item that is still being
+    worked on can be kept alive with heartbeat().
 
-    This object is not intended to be used by multiple threads
-    concurrently.
+    Each Redis command runs on a connection of its own from the pool, so
+    items can be leased, kept alive and completed from several threads.
     """
     def __init__(self, name, **redis_kwargs):
        """The default connection parameters are: host='localhost', port=6379, db=0
@@ -35,6 +121,17 @@ class RedisWQ(object):
        self._main_q_key = name
        self._processing_q_key = name + ":processing"
        self._lease_key_prefix = name + ":leased_by_session:"
+       # Items added with put() wait in a sorted set instead, and are tracked until completed.
+       self._priority_q_key = name + ":priority"
+       self._items_key = name + ":items"
+       self._seq_key = name + ":seq"
+       self._put_script = self._db.register_script(_PUT_SCRIPT)
+       self._lease_script = self._db.register_script(_LEASE_SCRIPT)
+       self._check_expired_leases_script = self._db.register_script(_CHECK_EXPIRED_LEASES_SCRIPT)
+       self._renew_lease_script = self._db.register_script(_RENEW_LEASE_SCRIPT)
+       self._complete_script = self._db.register_script(_COMPLETE_SCRIPT)
+       # Items of the processing queue seen without a lease, with when they were first seen
+       self._unleased = {}
 
     def sessionID(self):
         """Return the ID for this session."""
@@ -44,8 +141,12 @@ class RedisWQ(object):
         """Return the size of the main queue."""
         return self._db.llen(self._main_q_key)
 
+    def _priority_qsize(self):
+        """Return the size of the priority queue."""
+        return self._db.zcard(self._priority_q_key)
+
     def _processing_qsize(self):
-        """Return the size of the main queue."""
+        """Return the size of the processing queue."""
         return self._db.llen(self._processing_q_key)
 
     def empty(self):
@@ -53,22 +154,68 @@ class RedisWQ(object):
 
         False does not necessarily mean that there is work available to work on right now,
         """
-        return self._main_qsize() == 0 and self._processing_qsize() == 0
-
-# TODO: implement this
-#    def check_expired_leases(self):
-#        """Return to the work queueReturn True if the queue is empty, False otherwise."""
-#        # Processing list should not be _too_ long since it is approximately as long
-#        # as the number of active and recently active workers.
-#        processing = self._db.lrange(self._processing_q_key, 0, -1)
-#        for item in processing:
-#          # If the lease key is not present for an item (it expired or was 
-#          # never created because the client crashed before creating it)
-#          # then move the item back to the main queue so others can work on it.
-#          if not self._lease_exists(item):
-#            TODO: transactionally move the key from processing queue to
-#            to main queue, while detecting if a new lease is created
-#            or if either queue is modified.
+        return self._main_qsize() == 0 and self._priority_qsize() == 0 and self._processing_qsize() == 0
+
+    def peek(self, count=100):
+        """Return up to count items, in the order they would be leased, without leasing them."""
+        items = self._db.zrange(self._priority_q_key, 0, count - 1)
+        if len(items) < count:
+            # Items are leased from the tail of the main queue
+            items += self._db.lrange(self._main_q_key, -(count - len(items)), -1)[::-1]
+        return items
+
+    def put(self, items, priority=0, batch_size=1000):
+        """Add items (bytes or str) to the work queue and return how many were added.
+
+        Items already queued or being processed are skipped. Items with a higher
+        priority are leased first, and items with the same priority in the order
+        they were added. Items are sent in batches of batch_size, all in a single
+        round trip.
+        """
+        items = list(items)
+        # Each lane spans 10^12 sequence numbers, well within the exact range of a score
+        offset = -int(priority) * 10 ** 12
+        pipe = self._db.pipeline(transaction=False)
+        for start in range(0, len(items), batch_size):
+            args = [offset]
+            for item in items[start:start + batch_size]:
+                args += [self._itemkey(item.encode() if isinstance(item, str) else item), item]
+            self._put_script(keys=[self._priority_q_key, self._items_key, self._seq_key],
+                             args=args,
+                             client=pipe)
+        return sum(pipe.execute())
+
+    def check_expired_leases(self, grace_secs=LEASE_GRACE_SECS):
+        """Return items whose lease expired to the work queue, and return how many there were.
+
+        An item is moved to the processing queue before its lease is set, so items are only
+        returned once they have been seen without a lease for grace_secs, by an earlier call.
+        Each item is moved in a single transaction, so it cannot be leased or completed
+        while it is being moved.
+        """
+        # Processing list should not be _too_ long since it is approximately as long
+        # as the number of active and recently active workers.
+        items = self._db.lrange(self._processing_q_key, 0, -1)
+
+        pipe = self._db.pipeline(transaction=False)
+        for item in items:
+            pipe.exists(self._lease_key_prefix + self._itemkey(item))
+        now = time.monotonic()
+        self._unleased = {item: self._unleased.get(item, now)
+                          for item, leased in zip(items, pipe.execute()) if not leased}
+
+        expired = [item for item, since in self._unleased.items() if now - since >= grace_secs]
+        if not expired:
+            return 0
+
+        itemkeys = [self._itemkey(item) for item in expired]
+        args = []
+        for itemkey, item in zip(itemkeys, expired):
+            args += [itemkey, item]
+        return self._check_expired_leases_script(keys=[self._main_q_key, self._processing_q_key,
+                                                       self._priority_q_key, self._items_key]
+                                                 + [self._lease_key_prefix + itemkey for itemkey in itemkeys],
+                                                 args=args)
 
     def _itemkey(self, item):
         """Returns a string that uniquely identifies an item (bytes)."""
@@ -78,7 +225,7 @@ class RedisWQ(object):
         """True if a lease on 'item' exists."""
         return self._db.exists(self._lease_key_prefix + self._itemkey(item))
 
-    def lease(self, lease_secs=60, block=True, timeout=None):
+    def lease(self, lease_secs=60, block=True, timeout=None, priority_secs=5):
         """Begin working on an item the work queue. 
 
         Lease the item for lease_secs.  After that time, other
@@ -86,45 +233,93 @@ class RedisWQ(object):
         and pick up the item instead.
 
         If optional args block is true and timeout is None (the default), block
-        if necessary until an item is available."""
-        if block:
-            item = self._db.brpoplpush(self._main_q_key, self._processing_q_key, timeout=timeout)
-        else:
-            item = self._db.rpoplpush(self._main_q_key, self._processing_q_key)
-        if item:
-            # Record that we (this session id) are working on a key.  Expire that
-            # note after the lease timeout.
-            # Note: if we crash at this line of the program, then GC will see no lease
-            # for this item a later return it to the main queue.
-            itemkey = self._itemkey(item)
-            self._db.setex(self._lease_key_prefix + itemkey, lease_secs, self._session)
-        return item
+        if necessary until an item is available. The wait is done by Redis on the
+        main queue, and is cut to priority_secs at most for the priority set to be
+        looked at again."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            item = self._lease_script(keys=[self._main_q_key, self._processing_q_key, self._priority_q_key])
+            if not item and block:
+                wait = priority_secs if deadline is None else min(priority_secs, deadline - time.monotonic())
+                if wait > 0:
+                    item = self._db.brpoplpush(self._main_q_key, self._processing_q_key,
+                                               timeout=max(math.ceil(wait), 1))
+            if item:
+                # Record that we (this session id) are working on a key.  Expire that
+                # note after the lease timeout.
+                # Note: if we crash at this line of the program, then GC will see no lease
+                # for this item and later return it to the main queue. GC leaves items
+                # without a lease alone for a grace period, for the lease to be set here.
+                itemkey = self._itemkey(item)
+                self._db.setex(self._lease_key_prefix + itemkey, lease_secs, self._session)
+                return item
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                return None
+
+    def renew_lease(self, item, lease_secs):
+        """Extend the lease on 'item' to lease_secs from now.
+
+        Return False if this session no longer holds the lease, i.e. it expired
+        and the item may have been handed to another worker.
+        """
+        itemkey = self._itemkey(item)
+        return bool(self._renew_lease_script(keys=[self._lease_key_prefix + itemkey],
+                                             args=[self._session, lease_secs]))
+
+    @contextmanager
+    def heartbeat(self, item, lease_secs, interval_secs=None, max_secs=None):
+        """Keep renewing the lease on 'item' from a background thread while in this context.
+
+        The lease is renewed every interval_secs, a third of lease_secs by default, so
+        short lease periods can be used while items take much longer to process. If
+        max_secs is given, renewals stop after max_secs and the lease is left to expire.
+        """
+        if interval_secs is None:
+            interval_secs = max(lease_secs / 3, 1)
+        stop = threading.Event()
+        started = time.monotonic()
+
+        def beat():
+            while not stop.wait(interval_secs):
+                if max_secs is not None and time.monotonic() - started >= max_secs:
+                    logging.warning("Stopped renewing the lease on item %s after %d s.", self._itemkey(item), max_secs)
+                    return
+                try:
+                    if not self.renew_lease(item, lease_secs):
+                        logging.warning("Lost the lease on item %s.", self._itemkey(item))
+                        return
+                except redis.RedisError as e:
+                    logging.warning("Lease renewal failed: %s", e)
+
+        thread = threading.Thread(target=beat, name="lease-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
 
     def complete(self, value):
         """Complete working on the item with 'value'.
 
         If the lease expired, the item may not have completed, and some
         other worker may have picked it up.  There is no indication
-        of what happened.
+        of what happened, but the lease of the other worker is left alone.
+        The item may be added again from now on.
         """
-        self._db.lrem(self._processing_q_key, 0, value)
-        # If we crash here, then the GC code will try to move the value, but it will
-        # not be here, which is fine.  So this does not need to be a transaction.
         itemkey = self._itemkey(value)
-        self._db.delete(self._lease_key_prefix + itemkey, self._session)
+        self._complete_script(keys=[self._processing_q_key, self._lease_key_prefix + itemkey, self._items_key],
+                              args=[value, itemkey, self._session])
 
 # TODO: add functions to clean up all keys associated with "name" when
 # processing is complete.
 
-# TODO: add a function to add an item to the queue.  Atomically
-# check if the queue is empty and if so fail to add the item
-# since other workers might think work is done and be in the process
-# of exiting.
+# TODO: make put() atomically check if the queue is empty and if so fail
+# to add the item since other workers might think work is done and be in
+# the process of exiting.
 
 # TODO(etune): move to my own github for hosting, e.g. github.com/erictune/rediswq-py and
 # make it so it can be pip installed by anyone (see
 # http://stackoverflow.com/questions/8247605/configuring-so-that-pip-install-can-work-from-github)
 
-# TODO(etune): finish code to GC expired leases, and call periodically
-#  e.g. each time lease times out.
 
@@ -1,9 +1,24 @@
+import logging
 import os
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, wait
+
+MB = 1024 ** 2
 
 class S3Client:
     """
-    A simple interface for uploading small files to an S3 bucket
+    A simple interface for uploading files to an S3 bucket
+
+    Uploads can be queued with `upload_file_async`, which returns a future straight away and runs
+    the upload on a shared pool of threads, so that the caller can carry on producing the next
+    file. Large files are split into parts that are uploaded concurrently. All uploads share the
+    same connection pool, and every request is retried by botocore with exponential backoff.
+
+    The transfer settings are read from the environment:
+    S3_MULTIPART_CHUNKSIZE_MB (default 16), S3_MAX_CONCURRENCY (parts in flight per file, default 8),
+    S3_UPLOAD_WORKERS (files in flight, default 4) and S3_MAX_ATTEMPTS (default 5).
     """
 
     def __init__(self):
@@ -11,11 +26,102 @@ class S3Client:
         aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
         aws_s3_endpoint_url = os.getenv("AWS_S3_ENDPOINT_URL")
 
+        multipart_chunksize = int(os.getenv("S3_MULTIPART_CHUNKSIZE_MB", "16")) * MB
+        max_concurrency = int(os.getenv("S3_MAX_CONCURRENCY", "8"))
+        upload_workers = int(os.getenv("S3_UPLOAD_WORKERS", "4"))
+
+        max_attempts = int(os.getenv("S3_MAX_ATTEMPTS", "5"))
+
+        # Every part of every concurrent upload needs its own pooled connection. Retries are
+        # left to botocore alone, per request, so each one is tried at most max_attempts times.
+        config = Config(max_pool_connections=max_concurrency * upload_workers,
+                        retries={'max_attempts': max_attempts, 'mode': 'standard'})
+
         self.s3_client = boto3.client('s3',
                                       aws_access_key_id=aws_access_key_id,
                                       aws_secret_access_key=aws_secret_access_key,
-                                      endpoint_url=aws_s3_endpoint_url)
+                                      endpoint_url=aws_s3_endpoint_url,
+                                      config=config)
+
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_chunksize,
+                                              multipart_chunksize=multipart_chunksize,
+                                              max_concurrency=max_concurrency,
+                                              use_threads=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="s3-upload")
 
     def upload_file(self, source, bucket, destination):
-        self.s3_client.upload_file(source, bucket, destination)
+        self.s3_client.upload_file(source, bucket, destination, Config=self.transfer_config)
+
+    def list_keys(self, bucket, prefix):
+        """Return the set of keys of all objects under prefix, listed in pages of up to 1000 keys."""
+        keys = set()
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            keys.update(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    def read_object(self, bucket, key):
+        """Return the contents of an object, or None if there is no object with that key."""
+        try:
+            return self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+
+    def zarr_store(self, bucket, key):
+        """
+        Return a Zarr store for the objects under key. The store can be pickled, so that dask
+        workers write their chunks to the bucket directly. It holds no credentials, each process
+        using it finds its own, e.g. from its environment or instance role.
+        """
+        import s3fs
+
+        fs = s3fs.S3FileSystem(client_kwargs={'endpoint_url': os.getenv("AWS_S3_ENDPOINT_URL")})
+        return s3fs.S3Map(f"{bucket}/{key}", s3=fs)
+
+    def _upload_file_task(self, source, bucket, destination, remove):
+        try:
+            self.upload_file(source, bucket, destination)
+
+        except Exception as e:
+            logging.error("Upload of %s to %s failed: %s", source, destination, e)
+            raise
+
+        finally:
+            if remove:
+                os.remove(source)
+
+    def upload_file_async(self, source, bucket, destination, remove=False):
+        """
+        Queue the upload of a file and return a `concurrent.futures.Future` for it.
+        The local file is deleted once the upload has finished, successfully or not, if remove is True.
+        """
+        return self._executor.submit(self._upload_file_task, source, bucket, destination, remove)
+
+    def _upload_fileobj_task(self, fileobj, bucket, destination):
+        try:
+            # upload_fileobj reads from the current position, which is the end of a buffer
+            # that was just written to
+            fileobj.seek(0)
+            self.s3_client.upload_fileobj(fileobj, bucket, destination, Config=self.transfer_config)
+
+        except Exception as e:
+            logging.error("Upload to %s failed: %s", destination, e)
+            raise
+
+        finally:
+            fileobj.close()
+
+    def upload_fileobj_async(self, fileobj, bucket, destination):
+        """
+        Queue the upload of a seekable file-like object, e.g. an in-memory buffer, and return a
+        `concurrent.futures.Future` for it. The object is uploaded from its start and closed once
+        the upload has finished.
+        """
+        return self._executor.submit(self._upload_fileobj_task, fileobj, bucket, destination)
 
+    def wait(self, futures):
+        """Wait for the given uploads to finish and return the number of failed ones."""
+        done, _ = wait(futures)
+        return sum(1 for future in done if future.exception() is not None)
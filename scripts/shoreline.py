@@ -2,42 +2,81 @@
 # Shoreline Extraction #
 ########################
 
-import xarray as xr
+import logging
+import os
+import tempfile
+import numpy as np
 import pandas as pd
+import pyproj
+import xarray as xr
+import metrics
+from chunking import plan_chunk_size
+import tides
 
-from datacube_utilities.dea_datahandling import load_ard
 import datacube_utilities.waterline_functions_deaafrica as waterline_funcs
 
+WATER_PRODUCTS = [
+    "ls8_water_classification",
+    "ls7_water_classification",
+    "ls5_water_classification",
+    "ls4_water_classification",
+]
+
+def load_tide_data(lon, lat, time_from=None, time_to=None):
+    """
+    Return the tide heights of the gauge nearest to a location. They are read from the tide
+    store in the worker, because it doesn't exist on the dask workers.
+    """
+    store = tides.open_store()
+    gauge = store.nearest_gauge(lon, lat)
+    logging.info("Using tide gauge %s (%s).", gauge, tides.GAUGES[gauge]["name"])
+
+    return store.tide_data(gauge, time_from, time_to)
+
+
+def query_centre(query_x_from, query_x_to, query_y_from, query_y_to, query_crs="EPSG:4326"):
+    """
+    Return the longitude and latitude of the centre of the query extents
+    """
+    x = (float(query_x_from) + float(query_x_to)) / 2
+    y = (float(query_y_from) + float(query_y_to)) / 2
 
-def load_tide_data():
-    tide_files = "/tide-data/*.csv"
-    dfs = []
-    # The data here comes from http://www.bom.gov.au/oceanography/projects/spslcmp/data/index.shtml for Fiji
-    for f in tide_files:
-        # We must read the data now because it doesn't exist on the dask workers
-        df = pd.read_csv(f)
+    if query_crs == "EPSG:4326":
+        return x, y
 
-        if "Sea Level" in df.columns:
-            df["tides"] = df["Sea Level"]
-            df = pd.DataFrame.drop(df, columns=["Sea Level"])
-        elif "tide" in df.columns:
-            df["tides"] = df["tide"]
-            df = pd.DataFrame.drop(df, columns=["tide"])
-        if " Date & UTC Time" in df.columns:
-            df["time"] = df[" Date & UTC Time"]
-            df = pd.DataFrame.drop(df, columns=[" Date & UTC Time"])
+    transformer = pyproj.Transformer.from_crs(query_crs, "EPSG:4326", always_xy=True)
+    return transformer.transform(x, y)
 
-        dfs.append(df)
 
-    tide_data = pd.concat(dfs)
-    tide_data["time"] = pd.to_datetime(tide_data["time"], infer_datetime_format=True)
-    tide_data["tide_height"] = tide_data["tides"]
-    df = tide_data.set_index("time")
-    df = df.loc[~df.index.duplicated(keep="first")]
-    df = df[df.tides != -9999]
-    df
+def find_tide_datasets(dc, products, tide_data, tide_range_from, tide_range_to, **query):
+    """
+    Return the datasets of each product matching the query that were acquired when the tide
+    was strictly between tide_range_from and tide_range_to, as a dict keyed by product
+    """
+    if tide_data.empty:
+        logging.warning("No tide heights in the period of the query, the tide gauge record doesn't cover it.")
+        return {}
 
-    return df
+    tide_times = tide_data.index.values.astype("datetime64[ns]").astype("int64")
+    tide_heights = tide_data.tide_height.values
+
+    selected = {}
+    for product in products:
+        datasets = dc.find_datasets(product=product, **query)
+        if not datasets:
+            continue
+
+        # Interpolate a tide height for the time each scene was taken, in UTC like the tide data
+        times = pd.to_datetime([ds.center_time for ds in datasets], utc=True).tz_convert(None)
+        heights = np.interp(times.asi8, tide_times, tide_heights, left=np.nan, right=np.nan)
+
+        keep = (heights > tide_range_from) & (heights < tide_range_to)
+        logging.info("Selected %d of %d %s scenes within the tide range.", keep.sum(), len(datasets), product)
+
+        if keep.any():
+            selected[product] = [ds for ds, k in zip(datasets, keep) if k]
+
+    return selected
 
 
 def process_shoreline(
@@ -65,11 +104,6 @@ def process_shoreline(
     query["time"] = time
     query["output_crs"] = output_crs
     query["resolution"] = (-30, 30)
-    query["dask_chunks"] = {
-        "time": int(dask_time_chunk_size),
-        "x": int(dask_x_chunk_size),
-        "y": int(dask_y_chunk_size),
-    }
 
     if query_crs != "EPSG:4326":
         query["crs"] = query_crs
@@ -77,50 +111,59 @@ def process_shoreline(
     query["x"] = (float(query_x_from), float(query_x_to))
     query["y"] = (float(query_y_from), float(query_y_to))
 
-    landsat_ds = load_ard(
-        dc=dc,
-        products=[
-            "ls8_water_classification",
-            "ls7_water_classification",
-            "ls5_water_classification",
-            "ls4_water_classification",
-        ],
-        group_by="solar_day",
-        mask_invalid_data=False,
-        mask_pixel_quality=False,
-        **query,
-    )
-
-    if len(landsat_ds.dims) == 0 or len(landsat_ds.data_vars) == 0:
-        return None
-
-    water_classes = landsat_ds.where(landsat_ds >= 0)
-
-    tide_data = load_tide_data()
-
-    # First, we convert the data to an xarray dataset so we can analyse it in the same way as our Landsat data
-    tide_data_xr = tide_data.to_xarray()[["tide_height"]].chunk(chunks={"time": -1})
-
-    # We want to convert our hourly tide heights to estimates of exactly how high the tide was at
-    # the time that each satellite image was taken. To do this, we can use `.interp` to
-    # 'interpolate' a tide height for each Landsat timestamp:
-    landsat_tideheights = tide_data_xr.interp(time=water_classes.time)
-
-    # We then want to put these values back into the Landsat dataset so that each image has an estimated tide height:
-    water_classes["tide_height"] = landsat_tideheights.tide_height
-
-    # Filter landsat images by tide height
-    landsat_hightide = water_classes.where(
-        (water_classes.tide_height > tide_range_from)
-        & (water_classes.tide_height < tide_range_to),
-        drop=True,
-    )
+    if dask_x_chunk_size == "auto" or dask_y_chunk_size == "auto":
+        with metrics.span("plan"):
+            # Blocks hold a time chunk of water classifications, plus their float mean
+            dask_x_chunk_size = dask_y_chunk_size = plan_chunk_size(
+                dc, dict(query, product=WATER_PRODUCTS[0], measurements=["water"]),
+                scenes_per_chunk=int(dask_time_chunk_size), working_bytes=8,
+            )
+
+    query["dask_chunks"] = {
+        "time": int(dask_time_chunk_size),
+        "x": int(dask_x_chunk_size),
+        "y": int(dask_y_chunk_size),
+    }
+
+    # Pad the period by a day so that the first and last scenes can be interpolated
+    lon, lat = query_centre(query_x_from, query_x_to, query_y_from, query_y_to, query_crs)
+    tide_data = load_tide_data(lon, lat,
+                               pd.Timestamp(time_from) - pd.Timedelta(days=1),
+                               pd.Timestamp(time_to) + pd.Timedelta(days=2))
+
+    with metrics.span("load") as span:
+        # Select the scenes within the tide range from the index, before loading any pixels
+        datasets = find_tide_datasets(
+            dc,
+            products=WATER_PRODUCTS,
+            tide_data=tide_data,
+            tide_range_from=float(tide_range_from),
+            tide_range_to=float(tide_range_to),
+            **{key: query[key] for key in ("time", "x", "y", "crs") if key in query},
+        )
+
+        if not datasets:
+            return None
+
+        landsat_ds = [
+            dc.load(datasets=product_datasets, measurements=["water"], group_by="solar_day", **query)
+            for product_datasets in datasets.values()
+        ]
+        landsat_ds = [ds for ds in landsat_ds if len(ds.dims) > 0 and len(ds.data_vars) > 0]
+        if not landsat_ds:
+            return None
+
+        landsat_ds = xr.concat(landsat_ds, dim="time").sortby("time") if len(landsat_ds) > 1 else landsat_ds[0]
+        span["bytes_loaded"] = landsat_ds.nbytes
+
+    landsat_hightide = landsat_ds.where(landsat_ds >= 0)
 
     landsat_resampled = landsat_hightide.water.resample(time=time_step).mean("time")
 
     ## Compute
 
-    landsat_resampled = landsat_resampled.compute()
+    with metrics.span("compute", dask_obj=landsat_resampled):
+        landsat_resampled = landsat_resampled.compute()
 
     shoreline = xr.DataArray.to_dataset(landsat_resampled, dim=None, name="shoreline")
 
@@ -130,16 +173,19 @@ def process_shoreline(
     attribute_data = {"time": [str(i)[0:10] for i in landsat_resampled.time.values]}
     attribute_dtypes = {"time": "str"}
 
-    fname = f"output_waterlines.shp"
-    waterline_funcs.contour_extract(
-        z_values=[0],
-        ds_array=landsat_resampled,
-        ds_crs=landsat_ds.crs,
-        ds_affine=landsat_ds.geobox.transform,
-        output_shp=fname,
-        attribute_data=attribute_data,
-        attribute_dtypes=attribute_dtypes,
-        min_vertices=5,
-    )
+    # Use a directory per job so that concurrent jobs do not overwrite each other's sidecar files
+    output_dir = tempfile.mkdtemp(prefix="shoreline-")
+    fname = os.path.join(output_dir, "output_waterlines.shp")
+    with metrics.span("export"):
+        waterline_funcs.contour_extract(
+            z_values=[0],
+            ds_array=landsat_resampled,
+            ds_crs=landsat_ds.crs,
+            ds_affine=landsat_ds.geobox.transform,
+            output_shp=fname,
+            attribute_data=attribute_data,
+            attribute_dtypes=attribute_dtypes,
+            min_vertices=5,
+        )
 
     return shoreline, fname
@@ -0,0 +1,152 @@
+#############
+# Tide data #
+#############
+
+# Tide gauge records are parsed once from the BOM CSVs into sorted arrays of times and heights
+# per gauge, saved as .npy files that workers memory-map at start-up.
+
+import argparse
+import glob
+import logging
+import math
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+# Tide gauges, keyed by the prefix of their CSV files.
+# The data comes from http://www.bom.gov.au/oceanography/projects/spslcmp/data/index.shtml
+GAUGES = {
+    "IDO70004": {"name": "Lautoka, Fiji", "lon": 177.44, "lat": -17.60},
+}
+
+# Date formats used by the CSVs, most files use the first one
+TIME_FORMATS = ["%d-%b-%Y %H:%M", "%d/%m/%Y %H:%M"]
+
+NODATA = -9999
+
+DEFAULT_STORE_DIR = "/tide-store"
+
+
+def _parse_times(values):
+    for time_format in TIME_FORMATS:
+        try:
+            return pd.to_datetime(values, format=time_format)
+        except ValueError:
+            continue
+    raise ValueError(f"Unknown date format, e.g. {values.iloc[0]!r}")
+
+
+def read_gauge_csvs(paths):
+    """
+    Return the sorted, de-duplicated times and sea levels of the given CSVs of a gauge,
+    without missing values
+    """
+
+    dfs = []
+    for path in paths:
+        # Only the time and sea level columns are used, whatever their header is called
+        df = pd.read_csv(path, header=0, names=["time", "tides"], usecols=[0, 1], skipinitialspace=True)
+        df["time"] = _parse_times(df["time"])
+        dfs.append(df)
+
+    df = pd.concat(dfs)
+    df = df[df.tides != NODATA].dropna()
+    df = df.drop_duplicates(subset="time", keep="first").sort_values("time")
+
+    return df["time"].values.astype("datetime64[ns]"), df["tides"].values.astype("float32")
+
+
+def build_store(csv_dir, store_dir):
+    """Convert the CSVs of every gauge in csv_dir to {gauge}_time.npy and {gauge}_height.npy files."""
+    os.makedirs(store_dir, exist_ok=True)
+
+    for gauge in GAUGES:
+        paths = sorted(glob.glob(os.path.join(csv_dir, f"{gauge}_*.csv")))
+        if not paths:
+            logging.warning("No tide data for gauge %s.", gauge)
+            continue
+
+        times, heights = read_gauge_csvs(paths)
+        np.save(os.path.join(store_dir, f"{gauge}_time.npy"), times)
+        np.save(os.path.join(store_dir, f"{gauge}_height.npy"), heights)
+        logging.info("Saved %d tide heights of gauge %s from %d files.", len(times), gauge, len(paths))
+
+
+def _distance_km(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * math.asin(math.sqrt(a))
+
+
+class TideStore:
+    """
+    Memory-mapped tide heights of the gauges saved by `build_store`
+    """
+
+    def __init__(self, store_dir):
+        self.times = {}
+        self.heights = {}
+
+        for gauge in GAUGES:
+            time_path = os.path.join(store_dir, f"{gauge}_time.npy")
+            if os.path.exists(time_path):
+                self.times[gauge] = np.load(time_path, mmap_mode="r")
+                self.heights[gauge] = np.load(os.path.join(store_dir, f"{gauge}_height.npy"), mmap_mode="r")
+
+        if not self.times:
+            raise FileNotFoundError(f"No tide data in {store_dir}")
+
+    def nearest_gauge(self, lon, lat):
+        """Return the gauge with data that is closest to a location."""
+        return min(self.times, key=lambda gauge: _distance_km(lon, lat, GAUGES[gauge]["lon"], GAUGES[gauge]["lat"]))
+
+    def tide_data(self, gauge, time_from=None, time_to=None):
+        """
+        Return the tide heights of a gauge between two times as a DataFrame indexed by time,
+        with the heights in both the "tides" and "tide_height" columns
+        """
+
+        times = self.times[gauge]
+        start = 0 if time_from is None else np.searchsorted(times, np.datetime64(time_from, "ns"), side="left")
+        end = len(times) if time_to is None else np.searchsorted(times, np.datetime64(time_to, "ns"), side="right")
+
+        heights = np.asarray(self.heights[gauge][start:end])
+        return pd.DataFrame({"tides": heights, "tide_height": heights},
+                            index=pd.DatetimeIndex(np.asarray(times[start:end]), name="time"))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def open_store(store_dir=None):
+    """
+    Return the tide store of this process, opening it on first use from store_dir or the
+    TIDE_STORE_DIR environment variable
+    """
+
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            _store = TideStore(store_dir or os.getenv("TIDE_STORE_DIR", DEFAULT_STORE_DIR))
+        return _store
+
+
+########
+# Main #
+########
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Convert tide gauge CSVs to a memory-mappable tide store.")
+    parser.add_argument("--csv-dir", default="/tide-data")
+    parser.add_argument("--store-dir", default=DEFAULT_STORE_DIR)
+    args = parser.parse_args()
+
+    build_store(args.csv_dir, args.store_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+############################
+# Web tile pyramid builder #
+############################
+
+# Composites the web tiles rendered by the jobs of a prefix, e.g. the tiles of a region planned
+# by enqueue.py, into one XYZ pyramid per product, period and rendering. The edge tiles of
+# adjacent jobs are blended, and the levels above the deepest one are averaged from the level
+# below, so that every tile of the pyramid covers the outputs of every job under it.
+
+import argparse
+import io
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from s3 import S3Client
+from web_tiles import JOB_TILES_DIR, composite, decode_png, downsample, encode_png
+
+# Job tiles are named {base name}_{rendering}/{z}/{x}/{y}.png under JOB_TILES_DIR, where the base
+# name is {stem}_{crs}_{x_from}_{y_from}_{x_to}_{y_to}, see utils.get_output_base_name
+JOB_TILE = re.compile(r"^(?P<stem>.+)_(?P<crs>[a-z]+\d+)_-?[\d.]+_-?[\d.]+_-?[\d.]+_-?[\d.]+_(?P<rendering>[^/]+)"
+                      r"/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$")
+
+
+def group_job_tiles(keys, prefix):
+    """
+    Return the keys of the job tiles under a prefix grouped by pyramid, i.e. by product, period
+    and rendering, then by zoom level and tile
+    """
+
+    pyramids = {}
+    for key in sorted(keys):
+        match = JOB_TILE.match(key[len(f"{prefix}/{JOB_TILES_DIR}/"):])
+        if match:
+            levels = pyramids.setdefault(f"{match['stem']}_{match['rendering']}", {})
+            levels.setdefault(int(match['z']), {}).setdefault((int(match['x']), int(match['y'])), []).append(key)
+    return pyramids
+
+
+def build_pyramid(s3_client, bucket, destination, levels, num_threads=8):
+    """
+    Build and upload the pyramid of the job tiles of each zoom level, down to the level where
+    it fits in a single tile, and return the futures of the uploads. Jobs whose native zoom
+    level is lower than the deepest one are composited in at their own level. One level is held
+    in memory at a time.
+    """
+
+    uploads = []
+    tiles = {}
+    zoom = max(levels)
+
+    def _read(item):
+        xy, keys = item
+        children = [tiles[xy]] if xy in tiles else []
+        return xy, composite(children + [decode_png(s3_client.read_object(bucket, key)) for key in keys])
+
+    def _write(item):
+        (x, y), tile = item
+        return s3_client.upload_fileobj_async(io.BytesIO(encode_png(tile)), bucket, f"{destination}/{zoom}/{x}/{y}.png")
+
+    with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="tile-pyramid") as executor:
+        while True:
+            tiles.update(dict(executor.map(_read, levels.get(zoom, {}).items())))
+            tiles = {xy: tile for xy, tile in tiles.items() if tile[3].any()}
+            uploads += executor.map(_write, tiles.items())
+
+            if zoom == 0 or (zoom <= min(levels) and len(tiles) <= 1):
+                break
+
+            zoom -= 1
+            parents = {(x // 2, y // 2) for x, y in tiles}
+            tiles = {(x, y): downsample([tiles.get((2 * x + dx, 2 * y + dy)) for dy in (0, 1) for dx in (0, 1)])
+                     for x, y in parents}
+
+    logging.debug("Built %s down to zoom level %d.", destination, zoom)
+    return uploads
+
+
+def build_pyramids(s3_client, bucket, prefix, num_threads=8):
+    """
+    Build and upload a pyramid for every product, period and rendering of the job tiles under a
+    prefix, written under `{prefix}/tiles/{name}/{z}/{x}/{y}.png`, and return their names
+    """
+
+    prefix = prefix.rstrip('/')
+    keys = s3_client.list_keys(bucket, f"{prefix}/{JOB_TILES_DIR}/")
+
+    uploads = []
+    names = []
+
+    for name, levels in group_job_tiles(keys, prefix).items():
+        logging.info("Building the %s web tiles from %d job tiles.", name,
+                     sum(len(level_keys) for level in levels.values() for level_keys in level.values()))
+
+        uploads += build_pyramid(s3_client, bucket, f"{prefix}/tiles/{name}", levels, num_threads)
+        names.append(name)
+
+    failed = s3_client.wait(uploads)
+    if failed:
+        raise RuntimeError(f"{failed} of {len(uploads)} web tile uploads failed")
+
+    return names
+
+
+########
+# Main #
+########
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Build the XYZ web tile pyramids of the jobs under a prefix.")
+    parser.add_argument("--bucket", default="public-eo-data")
+    parser.add_argument("--prefix", required=True, help="e.g. common_sensing/fiji/sentinel_2_geomedian/2019")
+    parser.add_argument("--num-threads", type=int, default=8)
+    args = parser.parse_args()
+
+    names = build_pyramids(S3Client(), args.bucket, args.prefix, args.num_threads)
+    logging.info("Built %d web tile pyramids.", len(names))
+
+if __name__ == '__main__':
+    main()
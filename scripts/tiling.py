@@ -0,0 +1,86 @@
+################
+# Tile planner #
+################
+
+# Splits a region into tiles aligned to the output pixel grid, so that every output pixel is
+# computed by exactly one tile and the outputs of all tiles can be mosaicked without resampling
+# or seams, e.g. with mosaic.py.
+
+import json
+import math
+import pyproj
+from shapely.geometry import box, shape
+from shapely.ops import transform, unary_union
+
+
+def read_region(path, crs, region_crs="EPSG:4326"):
+    """
+    Return the union of the geometries of a GeoJSON file (a geometry, feature or feature
+    collection) in region_crs, as a shapely geometry in crs
+    """
+
+    with open(path) as f:
+        doc = json.load(f)
+
+    if doc.get("type") == "FeatureCollection":
+        geometries = [shape(feature["geometry"]) for feature in doc["features"]]
+    elif doc.get("type") == "Feature":
+        geometries = [shape(doc["geometry"])]
+    else:
+        geometries = [shape(doc)]
+
+    region = unary_union(geometries)
+
+    if region_crs != crs:
+        transformer = pyproj.Transformer.from_crs(region_crs, crs, always_xy=True)
+        region = transform(transformer.transform, region)
+
+    return region
+
+
+def _is_multiple(value, step):
+    return math.isclose(value / step, round(value / step), abs_tol=1e-6)
+
+
+def plan_tiles(region, tile_size, resolution, origin=(0.0, 0.0)):
+    """
+    Yield the pixel edges (x_from, y_from, x_to, y_to) of the tiles of a grid that intersect a
+    region, a shapely geometry in the output CRS.
+
+    Tiles are tile_size units wide and high and start at origin, which must be on the pixel
+    grid of the datacube (multiples of the resolution), as must tile_size. Adjacent tiles share
+    an edge but no pixel.
+    """
+
+    if not _is_multiple(tile_size, resolution):
+        raise ValueError(f"Tile size {tile_size} is not a multiple of the resolution {resolution}")
+    if not all(_is_multiple(value, resolution) for value in origin):
+        raise ValueError(f"Grid origin {origin} is not on the pixel grid of resolution {resolution}")
+
+    x_origin, y_origin = origin
+    left, bottom, right, top = region.bounds
+
+    col_from = math.floor((left - x_origin) / tile_size)
+    col_to = math.ceil((right - x_origin) / tile_size)
+    row_from = math.floor((bottom - y_origin) / tile_size)
+    row_to = math.ceil((top - y_origin) / tile_size)
+
+    for row in range(row_from, row_to):
+        for col in range(col_from, col_to):
+            tile = (x_origin + col * tile_size, y_origin + row * tile_size,
+                    x_origin + (col + 1) * tile_size, y_origin + (row + 1) * tile_size)
+            # Tiles only touching the region have no pixel in it
+            if region.intersects(box(*tile)) and not region.touches(box(*tile)):
+                yield tile
+
+
+def tile_query(tile, resolution):
+    """
+    Return the query extent (x_from, y_from, x_to, y_to) that loads exactly the pixels of a
+    tile. The datacube snaps queries outwards to the pixel grid, so the edges are moved a
+    quarter pixel inwards for rounding not to add a row or column of the neighbouring tile.
+    """
+
+    inset = resolution / 4
+    x_from, y_from, x_to, y_to = tile
+    return x_from + inset, y_from + inset, x_to - inset, y_to - inset
@@ -1,9 +1,17 @@
+import io
 import logging
+import math
 import os
+import shutil
+import zipfile
+import xarray as xr
 from pyproj import Proj, transform
 from os.path import basename
-from export import export_xarray_to_geotiff
-from metadata import generate_datacube_metadata
+from export import _get_transform_from_xr, export_xarray_to_geotiff, export_xarray_to_cog, convert_geotiff_to_cog, \
+    export_xarray_to_zarr, stream_xarray_to_geotiffs
+from metadata import OUTPUT_LAYOUTS, band_files, generate_datacube_metadata
+from web_tiles import JOB_TILES_DIR, RENDERINGS, render_level, to_rgba
+import metrics
 import yaml
 
 #########
@@ -28,6 +36,204 @@ def point_to_epsg4326(crs, x, y):
     return longitude, latitude
 
 
+# Bands written by each job code
+JOB_BANDS = {
+    'geomedian': ['red', 'green', 'blue', 'nir', 'swir1', 'swir2'],
+    'fractional_cover': ['bs', 'pv', 'npv'],
+    'shoreline': ['shoreline'],
+}
+
+
+# Jobs that write the outputs of several job codes from one computation
+COMBINED_JOBS = {
+    'geomedian_fractional_cover': ['geomedian', 'fractional_cover'],
+}
+
+# Jobs that write the outputs of a job code for several products and years of one tile
+BATCH_JOBS = {
+    'geomedian_batch': 'geomedian',
+}
+
+
+def _as_list(value):
+    return [str(v).strip() for v in value] if isinstance(value, (list, tuple)) else str(value).split(',')
+
+
+def job_outputs(job_code, **kwargs):
+    """
+    Return the (job code, job parameters) of each set of outputs a job writes.
+
+    The fractional cover outputs of combined jobs go to `fractional_cover_prefix`, by default
+    `prefix`. Batch jobs write the outputs of each of their `products` (by default `product`)
+    and `years`, over the whole year, with `{year}` and `{product}` replaced in `prefix`.
+    """
+
+    if job_code in BATCH_JOBS:
+        outputs = []
+        for product in _as_list(kwargs.get('products', kwargs.get('product'))):
+            for year in _as_list(kwargs['years']):
+                output_kwargs = dict(kwargs,
+                                     product=product,
+                                     time_from=f"{year}-01-01",
+                                     time_to=f"{year}-12-31",
+                                     prefix=kwargs.get('prefix', 'luigi').format(year=year, product=product))
+                outputs.append((BATCH_JOBS[job_code], output_kwargs))
+        return outputs
+
+    if job_code not in COMBINED_JOBS:
+        return [(job_code, kwargs)]
+
+    outputs = []
+    for output_code in COMBINED_JOBS[job_code]:
+        output_kwargs = dict(kwargs)
+        output_prefix = kwargs.get(f"{output_code}_prefix")
+        if output_prefix is not None:
+            output_kwargs['prefix'] = output_prefix
+        outputs.append((output_code, output_kwargs))
+
+    return outputs
+
+
+def get_product_resolution(product):
+    """
+    Return the output resolution in metres used for a source product
+    """
+
+    return 30 if product is None or product.startswith('ls') else 10
+
+
+def get_output_base_name(product, job_code, time_from, time_to, output_crs,
+                         x_from, x_to, y_from, y_to, epsg4326_naming='False'):
+    """
+    Return the prefix of the names of all output files for a dataset with the given extents
+    """
+
+    pn = product[0:3] if product.startswith('ls') else product[0:2]
+
+    # Generate EPSG:4326 extents for band filename upon request
+    if epsg4326_naming == 'True':
+        x_from, y_from = point_to_epsg4326(output_crs, x_from, y_from)
+        x_to, y_to = point_to_epsg4326(output_crs, x_to, y_to)
+
+    crs = output_crs.lower().replace(':', '')
+
+    return f"{pn}_{job_code}_{time_from}_{time_to}_{crs}_{x_from}_{y_from}_{x_to}_{y_to}"
+
+
+def output_files(base_name, bands, output_layout='separate', output_format='geotiff'):
+    """
+    Return the bands held by each band file (or Zarr store) of an output, in the order they
+    are written
+    """
+
+    files = {}
+    for band, (fname, _) in band_files(base_name, bands, output_layout, output_format).items():
+        files.setdefault(fname, []).append(band)
+    return files
+
+
+def predict_ds_extents(query_x_from, query_x_to, query_y_from, query_y_to, resolution):
+    """
+    Predict the extents `get_ds_extents` returns for data loaded with the given query, assuming
+    the query is in the output CRS. The datacube snaps the query outwards to the pixel grid, and
+    coordinates are pixel centres with y decreasing.
+    """
+
+    x_from = math.floor(float(query_x_from) / resolution) * resolution + resolution / 2
+    x_to = math.ceil(float(query_x_to) / resolution) * resolution - resolution / 2
+    y_from = math.ceil(float(query_y_to) / resolution) * resolution - resolution / 2
+    y_to = math.floor(float(query_y_from) / resolution) * resolution + resolution / 2
+
+    return x_from, x_to, y_from, y_to
+
+
+def _predict_job_extents(job_code, product, query_x_from, query_x_to, query_y_from, query_y_to):
+    # Shorelines are always loaded at 30 m, whatever the product
+    resolution = 30 if job_code == 'shoreline' else get_product_resolution(product)
+    return predict_ds_extents(query_x_from, query_x_to, query_y_from, query_y_to, resolution)
+
+
+def predict_output_coords(job_code, product, query_x_from, query_x_to, query_y_from, query_y_to, **kwargs):
+    """
+    Return a dataset holding only the x and y coordinates of the first and last pixels of the
+    outputs of a job, as predicted from its parameters, enough for `save_metadata`
+    """
+
+    x_from, x_to, y_from, y_to = _predict_job_extents(job_code, product, query_x_from, query_x_to,
+                                                      query_y_from, query_y_to)
+    return xr.Dataset(coords={'x': [x_from, x_to], 'y': [y_from, y_to]})
+
+
+def _get_output_keys(job_code,
+                     product,
+                     query_x_from, query_x_to,
+                     query_y_from, query_y_to,
+                     time_from, time_to,
+                     output_crs,
+                     query_crs='EPSG:4326',
+                     prefix='luigi',
+                     epsg4326_naming='False',
+                     output_layout='separate',
+                     output_format='geotiff',
+                     **kwargs):
+    if job_code not in JOB_BANDS or query_crs != output_crs:
+        return None
+
+    x_from, x_to, y_from, y_to = _predict_job_extents(job_code, product, query_x_from, query_x_to,
+                                                      query_y_from, query_y_to)
+
+    base_name = get_output_base_name(product, job_code, time_from, time_to, output_crs,
+                                     x_from, x_to, y_from, y_to, epsg4326_naming=epsg4326_naming)
+
+    files = output_files(base_name, JOB_BANDS[job_code], output_layout, output_format)
+    if output_format == 'zarr':
+        # The consolidated metadata is written last, once all chunks are in the store
+        keys = [f"{prefix}/{fname}/.zmetadata" for fname in files]
+    else:
+        keys = [f"{prefix}/{fname}" for fname in files]
+
+    if writes_metadata(job_code, output_format):
+        keys.append(get_metadata_key(prefix, base_name))
+
+    # The shapefile archive is named like the band files, without the product
+    if job_code == 'shoreline':
+        keys.append(f"{prefix}/{base_name.split('_', 1)[1]}_shoreline.zip")
+
+    return keys
+
+
+def get_output_keys(job_code, **kwargs):
+    """
+    Return the S3 keys of the band files and metadata a job is expected to write, ahead of
+    loading any data, or None if they cannot be predicted from the job parameters.
+    """
+
+    keys = []
+    for output_code, output_kwargs in job_outputs(job_code, **kwargs):
+        output_keys = _get_output_keys(output_code, **output_kwargs)
+        if output_keys is None:
+            return None
+        keys += output_keys
+
+    return keys
+
+
+def find_missing_outputs(s3_client, job_code, bucket='public-eo-data', **kwargs):
+    """
+    Return the S3 keys of the outputs of a job that are not in the bucket yet, or None if they
+    cannot be predicted from the job parameters. A single listing of the common prefix of the
+    keys is used to check them all.
+    """
+
+    keys = get_output_keys(job_code, **kwargs)
+    if keys is None:
+        return None
+
+    existing = s3_client.list_keys(bucket, os.path.commonprefix(keys))
+
+    return [key for key in keys if key not in existing]
+
+
 #################
 # Data uploader #
 #################
@@ -42,58 +248,146 @@ def save_data(s3_client,
               bucket='public-eo-data', prefix='luigi',
               epsg4326_naming='False',
               cogeo_output='True',
+              cog_profile='deflate',
+              cog_level=None,
+              cog_overview_levels='5',
+              cog_num_threads='ALL_CPUS',
+              streaming_output='False',
+              streaming_max_in_flight='4',
+              output_layout='separate',
+              output_format='geotiff',
               **kwargs):
     """
     Save raster data for each band in the list of bands
+
+    With the `band` or `pixel` output layout, all bands go to a single band or pixel interleaved
+    file instead of a file per band, see `metadata.OUTPUT_LAYOUTS`.
+
+    COGs are written in-process using the `cog_profile` compression profile (deflate, zstd
+    or lerc) with an optional `cog_level`, see `export.get_cog_creation_options`.
+
+    In streaming mode `ds` is expected to be dask-backed: its blocks are computed and
+    written to the band files as they finish instead of being loaded all at once.
+
+    With the `zarr` output format, all bands are written to a single Zarr store in the bucket.
+    When `ds` is dask-backed, each dask worker writes the chunks it computes to the bucket.
+
+    Uploads run in the background, the list of their futures is returned.
     """
 
-    pn = product[0:3] if product.startswith('ls') else product[0:2]
-    no_data = -9999 if product.startswith('ls') else 0
+    uploads = []
+
+    # Fractional cover uses -9999 as nodata whatever the sensor
+    no_data = -9999 if product.startswith('ls') or job_code == 'fractional_cover' else 0
 
     # Get dataset extents
     x_from, x_to, y_from, y_to = get_ds_extents(ds)
 
-    # Generate EPSG:4326 extents for band filename upon request
-    if epsg4326_naming == 'True':
-        x_from, y_from = point_to_epsg4326(output_crs, x_from, y_from)
-        x_to, y_to = point_to_epsg4326(output_crs, x_to, y_to)
+    base_name = get_output_base_name(product, job_code, time_from, time_to, output_crs,
+                                     x_from, x_to, y_from, y_to, epsg4326_naming=epsg4326_naming)
 
-    crs = output_crs.lower().replace(':', '')
+    if output_format == 'zarr':
+        destination = f"{prefix}/{base_name}.zarr"
+        logging.debug("Writing Zarr store %s.", destination)
+
+        with metrics.span("export", dask_obj=ds):
+            export_xarray_to_zarr(ds, s3_client.zarr_store(bucket, destination), bands=bands,
+                                  no_data=no_data, crs=output_crs)
+
+        return uploads
+
+    if cog_level is not None:
+        # LERC takes a maximum error rather than an integer compression level
+        cog_level = float(cog_level) if cog_profile == 'lerc' else int(cog_level)
+
+    files = output_files(base_name, bands, output_layout)
+    interleave = OUTPUT_LAYOUTS[output_layout]
+
+    cog_options = {
+        'profile': cog_profile,
+        'level': cog_level,
+        'overview_levels': int(cog_overview_levels),
+        'num_threads': cog_num_threads,
+        'interleave': interleave,
+    }
+
+    if streaming_output == 'True':
+        logging.debug("Streaming band files for %s.", ", ".join(bands))
+
+        try:
+            # Computing and writing blocks are interleaved, so both are accounted as export
+            with metrics.span("export", dask_obj=ds) as span:
+                stream_xarray_to_geotiffs(ds, files, no_data=no_data, crs=output_crs, x_coord='x', y_coord='y',
+                                          max_in_flight=int(streaming_max_in_flight))
+                span["bytes_written"] = sum(os.path.getsize(fname) for fname in files)
+
+        except Exception:
+            for fname in files:
+                if os.path.exists(fname):
+                    os.remove(fname)
+            raise
 
-    for band in bands:
-        destination = f"{prefix}/{pn}_{job_code}_{time_from}_{time_to}_{crs}_{x_from}_{y_from}_{x_to}_{y_to}_{band}.tif"
+    for fname, file_bands in files.items():
+        destination = f"{prefix}/{fname}"
 
-        fname = basename(destination)
         logging.debug("Saving band file %s.", fname)
 
-        export_xarray_to_geotiff(ds, fname, bands=[band], no_data=no_data, crs=output_crs, x_coord='x', y_coord='y')
+        cog_status = False
 
         if cogeo_output == 'True':
-            import shlex, subprocess
+            try:
+                with metrics.span("cog") as span:
+                    if streaming_output == 'True':
+                        convert_geotiff_to_cog(fname, **cog_options)
+                    else:
+                        export_xarray_to_cog(ds, fname, bands=file_bands, no_data=no_data, crs=output_crs,
+                                             x_coord='x', y_coord='y', **cog_options)
+                    span["bytes_written"] = os.path.getsize(fname)
+                cog_status = True
 
-            # TODO: use the Python API directly, albeit memory cleanup might be more effective using subprocess?
-            args = shlex.split(f"rio cogeo create {fname} {fname} --co PREDICTOR=2 --co ZLEVEL=9 --cog-profile deflate --overview-level 5 --overview-resampling average")
+            except Exception as e:
+                logging.error("COG conversion failed for file %s: %s", fname, e)
 
-            # DONT: don't capture the output from rio cogeo as it is already part of this process's stdout/stderr so it's available in Kubernetes' logs
-            cog_status = subprocess.call(args)
+        if not cog_status and streaming_output != 'True':
+            with metrics.span("export") as span:
+                export_xarray_to_geotiff(ds, fname, bands=file_bands, no_data=no_data, crs=output_crs,
+                                         x_coord='x', y_coord='y', interleave=interleave)
+                span["bytes_written"] = os.path.getsize(fname)
 
-            if cog_status:
-               logging.error("COG conversion failed for file %s.", fname)
+        metrics.add("upload", bytes_written=os.path.getsize(fname))
 
-        try:
-            s3_client.upload_file(fname, bucket, destination);
-
-        except Exception as e:
-            logging.error("Unhandled exception %s", e)
+        # Upload in the background while the next file is being encoded
+        uploads.append(s3_client.upload_file_async(fname, bucket, destination, remove=True))
 
-        finally:
-            os.remove(fname)
+    return uploads
 
 
 #####################
 # Metadata uploader #
 #####################
 
+# Product type in the metadata of each job code, as in datacube-product-definitions
+PRODUCT_TYPES = {
+    'geomedian': 'surface_reflectance_statistical_summary',
+    'fractional_cover': 'fractional_cover_annual_summary',
+}
+
+METADATA_SUFFIX = "_datacube-metadata.yaml"
+
+
+def writes_metadata(job_code, output_format='geotiff'):
+    """
+    Return whether the outputs of a job code get a datacube metadata file: only job codes with a
+    product type do, and Zarr stores are not indexed as the datacube has no reader for them
+    """
+
+    return job_code in PRODUCT_TYPES and output_format != 'zarr'
+
+
+def get_metadata_key(prefix, base_name):
+    return f"{prefix}/{base_name}{METADATA_SUFFIX}"
+
+
 def save_metadata(s3_client,
                   ds,
                   job_code,
@@ -106,19 +400,17 @@ def save_metadata(s3_client,
                   **kwargs):
     """
     Save YAML manifest for each band in the list of bands
+
+    The upload runs in the background, the list of its futures is returned.
     """
 
-    pn = product[0:3] if product.startswith('ls') else product[0:2]
+    uploads = []
 
     # Get dataset extents
     x_from, x_to, y_from, y_to = get_ds_extents(ds)
 
-    # Generate EPSG:4326 extents for band filename upon request
-    if epsg4326_naming == 'True':
-        x_from, y_from = point_to_epsg4326(output_crs, x_from, y_from)
-        x_to, y_to = point_to_epsg4326(output_crs, x_to, y_to)
-
-    crs = output_crs.lower().replace(':', '')
+    band_base_name = get_output_base_name(product, job_code, time_from, time_to, output_crs,
+                                          x_from, x_to, y_from, y_to, epsg4326_naming=epsg4326_naming)
 
     if product.startswith('ls'):
         satellite = product[2]
@@ -133,9 +425,7 @@ def save_metadata(s3_client,
         platform = 'SENTINEL_2'
         instrument = 'MSI'
 
-    band_base_name = f"{pn}_{job_code}_{time_from}_{time_to}_{crs}_{x_from}_{y_from}_{x_to}_{y_to}"
-
-    destination = f"{prefix}/{pn}_{job_code}_{time_from}_{time_to}_{crs}_{x_from}_{y_from}_{x_to}_{y_to}_datacube-metadata.yaml"
+    destination = get_metadata_key(prefix, band_base_name)
 
     fname = basename(destination)
     logging.debug("Saving metadata file %s.", fname)
@@ -149,11 +439,13 @@ def save_metadata(s3_client,
     longitude_from, latitude_from = point_to_epsg4326(output_crs, x_from, y_from)
     longitude_to, latitude_to = point_to_epsg4326(output_crs, x_to, y_to)
 
-    if job_code == 'geomedian':
+    doc = None
+
+    if writes_metadata(job_code, kwargs.get('output_format', 'geotiff')):
         doc = generate_datacube_metadata(metadata_obj_key,
                                          bands,
                                          band_base_name,
-                                         'surface_reflectance_statistical_summary',
+                                         PRODUCT_TYPES[job_code],
                                          platform,
                                          instrument,
                                          time_from, time_to,
@@ -168,14 +460,124 @@ def save_metadata(s3_client,
         with open(fname, 'w') as outfile:
             yaml.dump(doc, outfile)
 
-        try:
-            s3_client.upload_file(fname, bucket, destination);
+        uploads.append(s3_client.upload_file_async(fname, bucket, destination, remove=True))
+
+    return uploads
+
+######################
+# Web tile uploader #
+######################
+
+def save_web_tiles(s3_client,
+                   ds,
+                   job_code,
+                   product,
+                   time_from, time_to,
+                   output_crs,
+                   bucket='public-eo-data', prefix='luigi',
+                   epsg4326_naming='False',
+                   streaming_output='False',
+                   xyz_tiles='False',
+                   xyz_max_zoom=None,
+                   xyz_num_threads='4',
+                   **kwargs):
+    """
+    Save the deepest zoom level of an XYZ pyramid of PNG tiles for each rendering of the job
+    code, if `xyz_tiles` is True
+
+    The tiles are written under `{prefix}/tiles/jobs/{base name}_{rendering}/{z}/{x}/{y}.png`, a
+    namespace per job as the edge tiles of adjacent jobs cover each other. They are composited
+    into one pyramid per product and period by tile_pyramid.py. Tiles are rendered from the
+    computed dataset, so streaming jobs are skipped.
+
+    Uploads run in the background, the list of their futures is returned.
+    """
+
+    uploads = []
+
+    if xyz_tiles != 'True' or job_code not in RENDERINGS:
+        return uploads
+
+    if streaming_output == 'True':
+        logging.warning("Web tiles are not rendered in streaming mode.")
+        return uploads
+
+    no_data = -9999 if product.startswith('ls') or job_code == 'fractional_cover' else 0
+
+    x_from, x_to, y_from, y_to = get_ds_extents(ds)
+
+    base_name = get_output_base_name(product, job_code, time_from, time_to, output_crs,
+                                     x_from, x_to, y_from, y_to, epsg4326_naming=epsg4326_naming)
+
+    transform = _get_transform_from_xr(ds, x_coord='x', y_coord='y')
+
+    for rendering, (bands, value_range) in RENDERINGS[job_code].items():
+        logging.debug("Rendering %s web tiles.", rendering)
+
+        with metrics.span("tiles") as span:
+            rgba = to_rgba(ds, bands, value_range, no_data)
+            for (z, x, y), png in render_level(rgba, transform, output_crs, get_product_resolution(product),
+                                               max_zoom=xyz_max_zoom, num_threads=int(xyz_num_threads)):
+                destination = f"{prefix}/{JOB_TILES_DIR}/{base_name}_{rendering}/{z}/{x}/{y}.png"
+                uploads.append(s3_client.upload_fileobj_async(io.BytesIO(png), bucket, destination))
+                span["bytes_written"] += len(png)
+
+    return uploads
+
+##############################
+# Incremental state uploader #
+##############################
+
+# Bands saved with the outputs of incremental jobs, after the bands of the job code
+STATE_BANDS = ['count']
+
+
+def get_state_key(prefix, base_name):
+    return f"{prefix}/{base_name}_state.yaml"
+
+
+def read_incremental_state(s3_client, bucket, prefix, base_name):
+    """
+    Return the state saved by the last incremental run of an output, or None if there is none
+    """
+
+    doc = s3_client.read_object(bucket, get_state_key(prefix, base_name))
+    return yaml.safe_load(doc) if doc is not None else None
 
-        except Exception as e:
-            logging.error("Unhandled exception %s", e)
 
-        finally:
-            os.remove(fname)
+def save_incremental_state(s3_client,
+                           ds,
+                           job_code,
+                           product,
+                           time_from, time_to,
+                           output_crs,
+                           bucket='public-eo-data', prefix='luigi',
+                           epsg4326_naming='False',
+                           **kwargs):
+    """
+    Save the state of an incremental job, held in the `incremental_state` attribute of `ds`
+
+    The upload runs in the background, the list of its futures is returned.
+    """
+
+    uploads = []
+
+    state = ds.attrs.get('incremental_state')
+    if state is None:
+        return uploads
+
+    x_from, x_to, y_from, y_to = get_ds_extents(ds)
+
+    base_name = get_output_base_name(product, job_code, time_from, time_to, output_crs,
+                                     x_from, x_to, y_from, y_to, epsg4326_naming=epsg4326_naming)
+
+    destination = get_state_key(prefix, base_name)
+    logging.debug("Saving state file %s.", basename(destination))
+
+    buffer = io.BytesIO(yaml.safe_dump(state).encode())
+    uploads.append(s3_client.upload_fileobj_async(buffer, bucket, destination))
+
+    return uploads
 
 ######################
 # Shapefile uploader #
@@ -191,7 +593,16 @@ def upload_shapefile(s3_client,
                      bucket='public-eo-data', prefix='luigi',
                      epsg4326_naming='False',
                      cogeo_output='True',
+                     temp_dir=None,
                      **kwargs):
+    """
+    Upload a shapefile, together with its sidecar files, as a single zip archive
+
+    The archive is built in memory from the files next to `fname` that share its name, which are
+    then removed, along with temp_dir if given, the temporary directory holding them. The upload
+    runs in the background, the list of its futures is returned.
+    """
+
     # Get dataset extents
     x_from, x_to, y_from, y_to = get_ds_extents(ds)
 
@@ -202,15 +613,32 @@ def upload_shapefile(s3_client,
 
     crs = output_crs.lower().replace(':', '')
 
-    destination = f"{prefix}/{job_code}_{time_from}_{time_to}_{crs}_{x_from}_{y_from}_{x_to}_{y_to}_{band}.shp"
+    destination = f"{prefix}/{job_code}_{time_from}_{time_to}_{crs}_{x_from}_{y_from}_{x_to}_{y_to}_{band}.zip"
+    name = basename(destination)[:-len('.zip')]
 
     logging.debug("Saving band shape file %s.", basename(destination))
 
-    try:
-        s3_client.upload_file(fname, bucket, destination);
+    # Store the .shp, .shx, .dbf, .prj etc. files under the output name, as expected by GIS tools
+    output_dir, shp_name = os.path.split(os.path.abspath(fname))
+    stem = os.path.splitext(shp_name)[0]
 
-    except Exception as e:
-        logging.error("Unhandled exception %s", e)
+    sidecars = [sidecar for sidecar in sorted(os.listdir(output_dir)) if os.path.splitext(sidecar)[0] == stem]
+
+    buffer = io.BytesIO()
+
+    try:
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for sidecar in sidecars:
+                archive.write(os.path.join(output_dir, sidecar), f"{name}{os.path.splitext(sidecar)[1]}")
 
     finally:
-        os.remove(fname)
+        # Only the files of the shapefile are removed unless the directory is known to be temporary
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+        else:
+            for sidecar in sidecars:
+                os.remove(os.path.join(output_dir, sidecar))
+
+    # The upload runs in the background, return its future
+    buffer.seek(0)
+    return [s3_client.upload_fileobj_async(buffer, bucket, destination)]
@@ -0,0 +1,160 @@
+########################
+# Water mask providers #
+########################
+
+# Water masks for the fractional cover job. Each provider returns a boolean mask that is True
+# over land for a lazily loaded composite, either reduced from whole stacks or, in the fused
+# fractional cover mode, computed block by block.
+
+import logging
+import dask
+import dask.array as da
+import numpy as np
+import xarray as xr
+import metrics
+from datacube import Datacube
+from datacube.api.query import query_group_by
+
+# Pixels that are water more often than this are masked
+WATER_FREQUENCY_THRESHOLD = 0.4
+
+# Pixels with a higher MNDWI than this are masked
+MNDWI_THRESHOLD = 0.0
+
+
+class NoWaterMask:
+    """Keeps every pixel."""
+
+    def land_mask(self, dc, land_composite, time, query):
+        return None
+
+    def land_blocks(self, dc, land_composite, time, query):
+        return None
+
+
+class WaterIndexMask:
+    """
+    Masks pixels whose modified normalised difference water index (MNDWI), computed from the
+    green and swir1 bands of the composite itself, is above a threshold. Needs no other product.
+    """
+
+    def __init__(self, threshold=MNDWI_THRESHOLD):
+        self.threshold = threshold
+
+    def land_mask(self, dc, land_composite, time, query):
+        green = land_composite.green.astype("float32")
+        swir1 = land_composite.swir1.astype("float32")
+        mndwi = (green - swir1) / (green + swir1)
+        return mndwi <= self.threshold
+
+    def land_blocks(self, dc, land_composite, time, query):
+        # Computed pixel by pixel from the composite, so already block by block
+        return self.land_mask(dc, land_composite, time, query)
+
+
+class WaterProductMask:
+    """
+    Masks pixels classified as water in more than a fraction of the scenes of a WOfS-style
+    water classification product, or by MNDWI where the product has no scene
+    """
+
+    def __init__(self, water_product, threshold=WATER_FREQUENCY_THRESHOLD):
+        self.water_product = water_product
+        self.threshold = threshold
+
+    def land_mask(self, dc, land_composite, time, query):
+        with metrics.span("load") as span:
+            water_scenes = dc.load(
+                product=self.water_product, measurements=["water_classification"], time=time, **query
+            )
+            span["bytes_loaded"] = water_scenes.nbytes
+
+        if len(water_scenes.dims) == 0 or len(water_scenes.data_vars) == 0:
+            logging.warning("No %s scenes, masking water with MNDWI instead.", self.water_product)
+            return WaterIndexMask().land_mask(dc, land_composite, time, query)
+
+        water_scenes = water_scenes.where(water_scenes >= 0)
+        water_composite_mean = water_scenes.water_classification.mean(dim="time")
+
+        return water_composite_mean <= self.threshold
+
+    def land_blocks(self, dc, land_composite, time, query):
+        """
+        Return the land mask over the composite, computed by a task per spatial chunk of the
+        composite that loads the water datasets over that chunk only. The list of datasets is
+        held once in the graph, as a single delayed object, rather than copied into every task.
+        """
+
+        with metrics.span("load"):
+            search = {key: query[key] for key in ("x", "y", "crs") if key in query}
+            datasets = dc.find_datasets(product=self.water_product, time=time, **search)
+            measurements = list(
+                dc.index.products.get_by_name(self.water_product)
+                .lookup_measurements(["water_classification"]).values()
+            )
+
+        if not datasets:
+            logging.warning("No %s scenes, masking water with MNDWI instead.", self.water_product)
+            return WaterIndexMask().land_blocks(dc, land_composite, time, query)
+
+        geobox = land_composite.geobox
+        like = da.zeros(geobox.shape, chunks=(land_composite.chunks["y"], land_composite.chunks["x"]), dtype=bool)
+        land = da.map_blocks(self._land_block, like, dask.delayed(datasets, traverse=False), measurements, geobox,
+                             dtype=bool)
+
+        return xr.DataArray(land, dims=("y", "x"), coords={"y": land_composite.y, "x": land_composite.x})
+
+    def _land_block(self, like, datasets, measurements, geobox, block_info=None):
+        """
+        Return the land mask over a block of a geobox, loading one time slice of the water
+        datasets at a time into a running sum and count so that memory does not grow with the
+        number of scenes
+        """
+
+        (row, _), (col, _) = block_info[0]["array-location"]
+        geobox = geobox[row:row + like.shape[0], col:col + like.shape[1]]
+
+        total = np.zeros(geobox.shape, dtype="float32")
+        count = np.zeros(geobox.shape, dtype="uint16")
+
+        # Skip the datasets that do not overlap the block at all
+        datasets = [ds for ds in datasets if ds.extent is None or
+                    ds.extent.to_crs(geobox.crs).intersects(geobox.extent)]
+
+        if datasets:
+            sources = Datacube.group_datasets(datasets, query_group_by(group_by="time"))
+            for index in range(sources.sizes["time"]):
+                scene = Datacube.load_data(sources.isel(time=[index]), geobox, measurements)
+                values = scene[measurements[0].name].values[0]
+                valid = values >= 0
+                total += np.where(valid, values, 0)
+                count += valid
+
+        water_mean = np.divide(total, count, out=np.full(geobox.shape, np.nan, dtype="float32"), where=count > 0)
+
+        return water_mean <= self.threshold
+
+
+def get_water_mask(name, product, water_product=None):
+    """
+    Return the water mask provider for a geomedian product: "wofs" (a water classification
+    product, by default the one of the same Landsat sensor), "index" (MNDWI), "none", or
+    "auto", which uses a water classification product when there is one and MNDWI otherwise
+    """
+
+    if water_product is None and product.startswith("ls"):
+        water_product = product[:3] + "_water_classification"
+
+    if name == "auto":
+        name = "wofs" if water_product is not None else "index"
+
+    if name == "wofs":
+        if water_product is None:
+            raise ValueError(f"No water classification product for {product}")
+        return WaterProductMask(water_product)
+    elif name == "index":
+        return WaterIndexMask()
+    elif name == "none":
+        return NoWaterMask()
+
+    raise ValueError(f"Unknown water mask {name}")
@@ -0,0 +1,173 @@
+#####################
+# Web tile pyramids #
+#####################
+
+# Renders the outputs of jobs to XYZ pyramids of 256 x 256 PNG tiles in Web Mercator, so that
+# web maps read pre-rendered tiles instead of resampling the GeoTIFFs on every view. Each job
+# renders the deepest zoom level of its outputs under a directory of its own, and the tiles of
+# all jobs are then composited into a pyramid per product and period by tile_pyramid.py.
+
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, transform_bounds
+
+TILE_SIZE = 256
+
+# Directory, under the prefix of the outputs, of the tiles rendered by each job
+JOB_TILES_DIR = 'tiles/jobs'
+
+# Half the width of the Web Mercator world, in metres
+WORLD_HALF = 20037508.342789244
+
+# Renderings of each job code: the bands shown as red, green and blue and the range of values
+# stretched over 0-255
+RENDERINGS = {
+    'geomedian': {'rgb': (['red', 'green', 'blue'], (0, 3000))},
+    'fractional_cover': {'false_colour': (['bs', 'pv', 'npv'], (0, 100))},
+}
+
+
+def native_zoom(resolution, latitude):
+    """
+    Return the first zoom level whose pixels are no larger than the resolution in metres at
+    the given latitude
+    """
+
+    mercator_resolution = resolution / math.cos(math.radians(latitude))
+    return max(math.ceil(math.log2(2 * WORLD_HALF / (TILE_SIZE * mercator_resolution))), 0)
+
+
+def tile_bounds(z, x, y):
+    """Return the Web Mercator bounds (left, bottom, right, top) of an XYZ tile."""
+    size = 2 * WORLD_HALF / 2 ** z
+    left = -WORLD_HALF + x * size
+    top = WORLD_HALF - y * size
+    return left, top - size, left + size, top
+
+
+def tile_range(bounds, z):
+    """Return the ranges of x and y of the XYZ tiles covering Web Mercator bounds."""
+    size = 2 * WORLD_HALF / 2 ** z
+    left, bottom, right, top = bounds
+    last = 2 ** z - 1
+    x_from = min(max(math.floor((left + WORLD_HALF) / size), 0), last)
+    x_to = min(max(math.floor((right + WORLD_HALF) / size), 0), last)
+    y_from = min(max(math.floor((WORLD_HALF - top) / size), 0), last)
+    y_to = min(max(math.floor((WORLD_HALF - bottom) / size), 0), last)
+    return range(x_from, x_to + 1), range(y_from, y_to + 1)
+
+
+def to_rgba(ds, bands, value_range, nodata):
+    """
+    Return the bands of a 2D dataset stretched to an RGBA uint8 array, transparent where any
+    band is nodata or NaN
+    """
+
+    low, high = value_range
+    values = np.stack([ds[band].values.astype('float32') for band in bands])
+
+    valid = np.all(np.isfinite(values), axis=0)
+    if nodata is not None:
+        valid &= np.all(values != nodata, axis=0)
+
+    rgb = np.clip((values - low) * (254 / (high - low)) + 1, 1, 255)
+    rgba = np.zeros((4,) + values.shape[1:], dtype='uint8')
+    rgba[:3] = np.where(valid, rgb, 0)
+    rgba[3] = np.where(valid, 255, 0)
+    return rgba
+
+
+def downsample(children):
+    """
+    Return the tile made of a 2 x 2 block of child tiles (top left, top right, bottom left,
+    bottom right, None where empty), averaging opaque pixels only
+    """
+
+    block = np.zeros((4, 2 * TILE_SIZE, 2 * TILE_SIZE), dtype='float32')
+    for index, child in enumerate(children):
+        if child is not None:
+            row, col = divmod(index, 2)
+            block[:, row * TILE_SIZE:(row + 1) * TILE_SIZE, col * TILE_SIZE:(col + 1) * TILE_SIZE] = child
+
+    block = block.reshape(4, TILE_SIZE, 2, TILE_SIZE, 2)
+    alpha = block[3] / 255
+    weight = alpha.sum(axis=(1, 3))
+
+    tile = np.zeros((4, TILE_SIZE, TILE_SIZE), dtype='uint8')
+    opaque = weight > 0
+    for band in range(3):
+        tile[band][opaque] = np.round((block[band] * alpha).sum(axis=(1, 3))[opaque] / weight[opaque])
+    tile[3] = np.round(block[3].mean(axis=(1, 3)))
+    return tile
+
+
+def composite(tiles):
+    """
+    Return the tile made of tiles covering disjoint parts of the same area, e.g. the edge tiles
+    of adjacent jobs, weighting the colour of each pixel by its alpha
+    """
+
+    if len(tiles) == 1:
+        return tiles[0]
+
+    stack = np.stack(tiles).astype('float32')
+    alpha = stack[:, 3] / 255
+    weight = alpha.sum(axis=0)
+
+    tile = np.zeros((4, TILE_SIZE, TILE_SIZE), dtype='uint8')
+    opaque = weight > 0
+    for band in range(3):
+        tile[band][opaque] = np.round((stack[:, band] * alpha).sum(axis=0)[opaque] / weight[opaque])
+    tile[3] = np.round(np.minimum(stack[:, 3].sum(axis=0), 255))
+    return tile
+
+
+def encode_png(tile):
+    with MemoryFile() as memfile:
+        with memfile.open(driver='PNG', width=TILE_SIZE, height=TILE_SIZE, count=4, dtype='uint8') as dst:
+            dst.write(tile)
+        return memfile.read()
+
+
+def decode_png(png):
+    with MemoryFile(png) as memfile:
+        with memfile.open() as src:
+            return src.read()
+
+
+def render_level(rgba, transform, crs, resolution, max_zoom=None, num_threads=4):
+    """
+    Yield the (z, x, y) and PNG of every non-empty XYZ tile covering an RGBA array at the deepest
+    zoom level, by default the native resolution, reprojected from the array in parallel. The
+    levels above are built by tile_pyramid.py once the tiles of adjacent arrays are rendered.
+    """
+
+    height, width = rgba.shape[1:]
+    left, top = transform.c, transform.f
+    right, bottom = left + width * transform.a, top + height * transform.e
+    bounds = transform_bounds(crs, 'EPSG:3857', left, bottom, right, top)
+
+    latitude = math.degrees(math.atan(math.sinh((bounds[1] + bounds[3]) / 2 / 6378137)))
+    zoom = native_zoom(resolution, latitude) if max_zoom is None else int(max_zoom)
+
+    def _render(xy):
+        dst = np.zeros((4, TILE_SIZE, TILE_SIZE), dtype='uint8')
+        reproject(rgba, dst,
+                  src_transform=transform, src_crs=crs, src_alpha=4,
+                  dst_transform=from_bounds(*tile_bounds(zoom, *xy), TILE_SIZE, TILE_SIZE),
+                  dst_crs='EPSG:3857', dst_alpha=4,
+                  resampling=Resampling.average)
+        return xy, dst if dst[3].any() else None
+
+    xs, ys = tile_range(bounds, zoom)
+    with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="web-tiles") as executor:
+        for (x, y), tile in executor.map(_render, [(x, y) for y in ys for x in xs]):
+            if tile is not None:
+                yield (zoom, x, y), encode_png(tile)
+
+    logging.debug("Rendered web tiles at zoom level %d.", zoom)
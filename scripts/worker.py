@@ -1,14 +1,23 @@
+import ctypes
 import logging
 import os
 import rediswq
 import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from contextlib import contextmanager
 from datacube import Datacube
+from index_cache import CachedDatacube
 from dask.distributed import Client
-from s3 import S3Client
+from s3 import MB, S3Client
 import json
 import gc
-from utils import save_data, save_metadata, upload_shapefile
+import metrics
+import tides
+from metadata import band_files
+from utils import JOB_BANDS, METADATA_SUFFIX, STATE_BANDS, find_missing_outputs, job_outputs, predict_output_coords, \
+    save_data, save_incremental_state, save_metadata, save_web_tiles, upload_shapefile
 
 ###################
 # Timeout handler #
@@ -36,69 +45,440 @@ def raise_timeout(signum, frame):
     raise TimeoutError
 
 
+@contextmanager
+def deadline(dask_client, time):
+    """
+    The timeout of jobs run outside of the main thread, where no alarm can be set. The dask
+    computations of the job are run by a client of its own, which is closed once ``time`` seconds
+    have passed, cancelling its futures so that the job fails at its next dask call.
+    """
+    job_client = Client(dask_client.scheduler.address, set_as_default=False)
+
+    def expire():
+        logging.error("Job timed out after %d s, cancelling its computations.", time)
+        job_client.close()
+
+    timer = threading.Timer(time, expire)
+    timer.daemon = True
+    timer.start()
+
+    try:
+        with job_client.as_current():
+            yield
+
+    finally:
+        timer.cancel()
+        job_client.close()
+
+
 ###################
 # Request handler #
 ###################
 
-def process_request(dc, s3_client, job_code, **kwargs):
+def check_outputs(s3_client, job_code, **kwargs):
+    """
+    Return the bands of a job that still need to be written, an empty list if only its metadata
+    is missing, or None if all of its outputs are already in the bucket
+    """
+    save_bands = JOB_BANDS.get(job_code, [])
+
     try:
-        if job_code == "geomedian":
-            from geomedian import process_geomedian
+        missing = find_missing_outputs(s3_client, job_code, **kwargs)
 
-            ds = process_geomedian(dc=dc, **kwargs)
-            save_bands = ['red', 'green', 'blue', 'nir', 'swir1', 'swir2']
+    except Exception as e:
+        logging.warning("Could not check for existing outputs: %s", e)
+        missing = None
 
-        if job_code == "fractional_cover":
-            from fractional_cover import process_fractional_cover
+    if missing is None:
+        return save_bands
 
-            ds = process_fractional_cover(dc=dc, **kwargs)
-            save_bands = ['bs', 'pv', 'npv']
+    if not missing:
+        return None
 
-        if job_code == "shoreline":
-            from shoreline import process_shoreline
+    if all(key.endswith(METADATA_SUFFIX) for key in missing):
+        return []
 
-            ds, shp_fname = process_shoreline(dc=dc, **kwargs)
-            save_bands = ['shoreline']
-            upload_shapefile(s3_client=s3_client, ds=ds, fname=shp_fname, job_code=job_code, band='shoreline', **kwargs)
+    # The names of the band files without the base name, i.e. their suffixes. Other files,
+    # e.g. shapefile archives, are written along with all bands.
+    suffixes = band_files("", save_bands, kwargs.get('output_layout', 'separate'),
+                          kwargs.get('output_format', 'geotiff'))
+    return [band for band in save_bands if any(suffixes[band][0] in key for key in missing)] or save_bands
 
-        if ds:
-            logging.info("Saving data.")
-            save_data(s3_client=s3_client, ds=ds, job_code=job_code, bands=save_bands, **kwargs)
-            logging.info("Saving metadata.")
-            save_metadata(s3_client=s3_client, ds=ds, job_code=job_code, bands=save_bands, **kwargs)
 
-    except TimeoutError:
-        logging.error("Processing timed out.")
+def compute_outputs(dc, s3_client, job_code, outputs, uploads, indices, **kwargs):
+    """
+    Yield the index in outputs and the dataset of each output of a job as it is computed.
+    Batch jobs only compute the outputs whose index is in indices.
+    """
 
-    except Exception as e:
-        logging.error("Unhandled exception %s", e)
+    if job_code == "geomedian" and kwargs.get('incremental') == 'True':
+        from incremental import process_geomedian_incremental
 
-    finally:
+        yield 0, process_geomedian_incremental(dc=dc, s3_client=s3_client, **kwargs)
+
+    elif job_code == "geomedian":
+        from geomedian import process_geomedian
+
+        yield 0, process_geomedian(dc=dc, **kwargs)
+
+    if job_code == "fractional_cover":
+        from fractional_cover import process_fractional_cover
+
+        yield 0, process_fractional_cover(dc=dc, **kwargs)
+
+    if job_code == "geomedian_fractional_cover":
+        from geomedian import process_geomedian
+        from fractional_cover import process_fractional_cover_from_geomedian
+
+        # The fractional cover is classified from the geomedian of this job rather than
+        # from the geomedian product, once it has been written and indexed
+        ds = process_geomedian(dc=dc, **kwargs)
         if ds:
-            del ds
-        gc.collect()
+            # In streaming mode both outputs are computed from the same persisted blocks
+            if kwargs.get('streaming_output') == 'True':
+                ds = ds.persist()
+            yield 0, ds
+            yield 1, process_fractional_cover_from_geomedian(dc=dc, geomedian=ds, **kwargs)
+
+    if job_code == "geomedian_batch":
+        from geomedian import process_geomedian_batch
+
+        yield from process_geomedian_batch(dc=dc, outputs=outputs, indices=indices, **kwargs)
+
+    if job_code == "shoreline":
+        from shoreline import process_shoreline
+
+        # No output when no scene is within the tide range
+        result = process_shoreline(dc=dc, **kwargs)
+        if result is not None:
+            ds, shp_fname = result
+            uploads += upload_shapefile(s3_client=s3_client, ds=ds, fname=shp_fname, job_code=job_code, band='shoreline',
+                                        temp_dir=os.path.dirname(shp_fname), **kwargs)
+            yield 0, ds
+
+
+def process_request(dc, s3_client, job_code, skip_existing='True', **kwargs):
+    uploads = []
+
+    with metrics.job(job_code, product=kwargs.get('product'), prefix=kwargs.get('prefix'),
+                     time_from=kwargs.get('time_from'), time_to=kwargs.get('time_to')) as job_metrics:
+        try:
+            # Zarr outputs are written by the dask workers, so arrays are left on the cluster
+            if kwargs.get('output_format') == 'zarr':
+                if kwargs.get('xyz_tiles') == 'True':
+                    logging.warning("Web tiles are not rendered for Zarr outputs, which are written in streaming mode.")
+                kwargs['streaming_output'] = 'True'
+
+            outputs = job_outputs(job_code, **kwargs)
+            save_bands = {index: JOB_BANDS.get(output_code, []) for index, (output_code, _) in enumerate(outputs)}
+
+            # Outputs have deterministic names, so reruns only need to write what is missing.
+            # All bands are computed together, so only their export is skipped. Incremental
+            # jobs update their existing outputs.
+            if skip_existing == 'True' and kwargs.get('incremental') != 'True':
+                for index, (output_code, output_kwargs) in enumerate(outputs):
+                    bands = check_outputs(s3_client, output_code, **output_kwargs)
+                    if bands is None:
+                        logging.info("All %s outputs with prefix %s already exist.", output_code, output_kwargs.get('prefix'))
+                        del save_bands[index]
+                    elif not bands:
+                        # The metadata only needs the extents of the outputs, which are known
+                        logging.info("Writing the missing %s metadata.", output_code)
+                        uploads += save_metadata(s3_client=s3_client, ds=predict_output_coords(output_code, **output_kwargs),
+                                                 job_code=output_code, bands=JOB_BANDS[output_code], **output_kwargs)
+                        del save_bands[index]
+                    else:
+                        logging.info("Writing %s bands %s.", output_code, ", ".join(bands))
+                        save_bands[index] = bands
+
+                if not save_bands:
+                    logging.info("All outputs already exist, skipping job.")
+                    job_metrics.status = "skipped"
+                    return
+
+            # Outputs are saved as soon as they are computed, only their coordinates are kept
+            # for the metadata
+            saved = {}
+            for index, ds in compute_outputs(dc, s3_client, job_code, outputs, uploads, sorted(save_bands), **kwargs):
+                if not ds or index not in save_bands:
+                    continue
+
+                output_code, output_kwargs = outputs[index]
+                logging.info("Saving %s data.", output_code)
+                # The state of incremental jobs is saved after the bands of the job code
+                state_bands = [band for band in STATE_BANDS if band in ds.data_vars]
+                uploads += save_data(s3_client=s3_client, ds=ds, job_code=output_code,
+                                     bands=save_bands[index] + state_bands, **output_kwargs)
+                uploads += save_web_tiles(s3_client=s3_client, ds=ds, job_code=output_code, **output_kwargs)
+                saved[index] = ds.drop_vars(list(ds.data_vars))
+                del ds
+
+            if saved:
+                # Only publish the metadata once the data it refers to is in the bucket
+                with metrics.span("upload"):
+                    failed = s3_client.wait(uploads)
+
+                if failed:
+                    logging.error("Data upload failed, skipping metadata.")
+                    job_metrics.status = "failed"
+                else:
+                    logging.info("Saving metadata.")
+                    with metrics.span("metadata"):
+                        for index, ds in saved.items():
+                            output_code, output_kwargs = outputs[index]
+                            uploads += save_metadata(s3_client=s3_client, ds=ds, job_code=output_code,
+                                                     bands=JOB_BANDS[output_code], **output_kwargs)
+                            uploads += save_incremental_state(s3_client=s3_client, ds=ds, job_code=output_code,
+                                                              **output_kwargs)
+
+            else:
+                job_metrics.status = "empty"
+
+        except TimeoutError:
+            logging.error("Processing timed out.")
+            job_metrics.status = "timeout"
+
+        except Exception as e:
+            logging.error("Unhandled exception %s", e)
+            job_metrics.status = "failed"
+
+        finally:
+            with metrics.span("upload"):
+                s3_client.wait(uploads)
+            gc.collect()
 
 
 #################
 # Job processor #
 #################
 
-def process_job(dc, dask_client, s3_client, json_data, timeout_secs):
+# Modules of the scripts whose functions run on the dask workers, in the order they import each
+# other. The dask workers run a different image, without the scripts.
+DASK_MODULES = ["metrics", "chunking", "masking", "water_masks", "fractional_cover", "geomedian"]
+
+
+def upload_modules(dask_client):
+    """Upload the modules the dask workers need, to the current and to later workers."""
+    for module in DASK_MODULES:
+        dask_client.upload_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{module}.py"))
+
+
+def trim_memory():
+    """Return memory freed after a job to the OS, run on each dask worker."""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    return True
+
+
+def release_memory(dask_client):
+    """Release memory held after a job without restarting the cluster.
+
+    Results of a job are only referenced by that job's own futures, so the scheduler
+    forgets them as soon as the job drops its references to them.
+    """
+    gc.collect()
+    try:
+        dask_client.run(trim_memory)
+    except Exception as e:
+        logging.warning("Memory cleanup failed: %s", e)
+
+
+def process_job(dc, dask_client, s3_client, json_data, timeout_secs, restart_cluster=True):
     loaded_json = json.loads(json_data)
 
     try:
         #logging.info("Started processing job."))
-        with timeout(timeout_secs):
-            process_request(dc, s3_client, **loaded_json)
+        # The alarm based timeout can only be set from the main thread
+        if threading.current_thread() is threading.main_thread():
+            with timeout(timeout_secs):
+                process_request(dc, s3_client, **loaded_json)
+        else:
+            with deadline(dask_client, timeout_secs):
+                process_request(dc, s3_client, **loaded_json)
 
     except Exception as e:
         logging.error("Unhandled exception %s", e)
 
     finally:
-        dask_client.restart()
+        if restart_cluster:
+            # Statistics are held by the dask workers, which a restart resets. Jobs run
+            # concurrently share them, so they are reported by the worker loop instead.
+            if os.getenv("BLOCK_CACHE_DIR"):
+                report_block_cache(dask_client)
+            dask_client.restart()
+        else:
+            release_memory(dask_client)
         logging.info("Finished processing job.")
 
 
+def work_concurrently(q, dc, dask_client, s3_client, concurrency, lease_secs, timeout_secs, reaper_secs):
+    """
+    Keep up to `concurrency` jobs in flight against the same dask cluster, so that the compute of
+    a job overlaps the output stage of the previous one. The cluster cannot be restarted between
+    jobs as other jobs are using it, so memory is released explicitly instead.
+    """
+
+    def run(item):
+        itemstr = item.decode("utf=8")
+        logging.info("Working on %s.", itemstr)
+        # A job stuck past its deadline outside of dask can't be interrupted, so its lease is
+        # left to expire, for the item to be picked up again by the reaper
+        with q.heartbeat(item, lease_secs, max_secs=timeout_secs):
+            process_job(dc, dask_client, s3_client, itemstr, timeout_secs, restart_cluster=False)
+        q.complete(item)
+
+    running = set()
+    last_reaped = 0
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="job") as executor:
+        while running or not q.empty():
+            if len(running) == concurrency:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+                continue
+
+            if time.monotonic() - last_reaped >= reaper_secs:
+                requeued = q.check_expired_leases()
+                if requeued:
+                    logging.info("Returned %d items with expired leases to the queue.", requeued)
+                if os.getenv("BLOCK_CACHE_DIR"):
+                    report_block_cache(dask_client)
+                last_reaped = time.monotonic()
+
+            # Poll briefly while other jobs are running so finished ones are noticed quickly
+            item = q.lease(lease_secs=lease_secs, block=True, timeout=1 if running else reaper_secs)
+            if item is not None:
+                running.add(executor.submit(run, item))
+            elif not running:
+                logging.info("Waiting for work.")
+
+            running = {future for future in running if not future.done()}
+
+    if os.getenv("BLOCK_CACHE_DIR"):
+        report_block_cache(dask_client)
+
+
+#######################
+# Dataset prefetching #
+#######################
+
+def job_searches(job):
+    """
+    Return the index searches a job will make, as far as they can be predicted from the job
+    """
+    job_code = job.get("job_code")
+    product = job.get("product")
+
+    search = {
+        "x": (float(job["query_x_from"]), float(job["query_x_to"])),
+        "y": (float(job["query_y_from"]), float(job["query_y_to"])),
+    }
+    query_crs = job.get("query_crs", "EPSG:4326")
+    if query_crs != "EPSG:4326":
+        search["crs"] = query_crs
+
+    if job_code == "geomedian_batch":
+        # Each product is loaded once for the whole period of the batch
+        periods = {}
+        for _, output_kwargs in job_outputs(job_code, **job):
+            periods.setdefault(output_kwargs["product"], []).append((output_kwargs["time_from"], output_kwargs["time_to"]))
+        return [dict(search, product=product, time=(min(period)[0], max(period)[1]))
+                for product, period in periods.items()]
+
+    products = [product]
+    if job_code in ("fractional_cover", "geomedian_fractional_cover"):
+        water_product = job.get("water_product")
+        if water_product is None and product.startswith("ls"):
+            water_product = product[:3] + "_water_classification"
+        if water_product is not None:
+            products.append(water_product)
+    elif job_code == "shoreline":
+        from shoreline import WATER_PRODUCTS
+
+        products = WATER_PRODUCTS
+
+    search["time"] = (job["time_from"], job["time_to"])
+
+    return [dict(search, product=product) for product in products if product]
+
+
+def prefetch_jobs(dc, q, count):
+    """Resolve the datasets of the next count queued jobs in one search per product and time."""
+    items = q.peek(count)
+    searches = []
+    for item in items:
+        try:
+            searches += job_searches(json.loads(item.decode("utf-8")))
+        except (ValueError, KeyError, AttributeError) as e:
+            logging.warning("Could not predict the searches of %s: %s", item, e)
+
+    searches_made = dc.prefetch(searches)
+    logging.info("Prefetched datasets for %d queued jobs in %d searches, cache %s.", len(items), searches_made, dc.stats())
+
+
+def start_prefetcher(dc, q, count, interval_secs):
+    """Prefetch the datasets of queued jobs from a background thread every interval_secs."""
+
+    def prefetch():
+        while True:
+            try:
+                prefetch_jobs(dc, q, count)
+            except Exception as e:
+                logging.warning("Prefetching datasets failed: %s", e)
+            time.sleep(interval_secs)
+
+    thread = threading.Thread(target=prefetch, name="prefetch", daemon=True)
+    thread.start()
+    return thread
+
+
+###############
+# Block cache #
+###############
+
+def start_block_cache(dask_client, directory, max_bytes):
+    """Cache the source blocks read by the dask workers on their local disk."""
+    from block_cache import BlockCachePlugin
+
+    try:
+        # The dask workers run a different image, without the scripts
+        dask_client.upload_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "block_cache.py"))
+        dask_client.register_worker_plugin(BlockCachePlugin(directory, max_bytes))
+        logging.info("Caching up to %d MB of source blocks in %s on each dask worker node.", max_bytes // MB, directory)
+
+    except Exception as e:
+        logging.warning("Could not start the block cache: %s", e)
+
+
+def report_block_cache(dask_client):
+    """
+    Log and count the block cache hits and misses of the dask workers since the last report,
+    those of a job when jobs run one at a time, otherwise those of every job in the meantime
+    """
+    from block_cache import block_cache_stats
+
+    try:
+        stats = [s for s in dask_client.run(block_cache_stats, reset=True).values() if s is not None]
+
+    except Exception as e:
+        logging.warning("Could not get the block cache statistics: %s", e)
+        return
+
+    hits = sum(s["hits"] for s in stats)
+    misses = sum(s["misses"] for s in stats)
+    bytes_hit = sum(s["bytes_hit"] for s in stats)
+
+    if hits + misses:
+        logging.info("Block cache: %d hits, %d misses (%.0f%% hit rate), %d MB read from disk.",
+                     hits, misses, 100 * hits / (hits + misses), bytes_hit // MB)
+
+    metrics.REGISTRY.count("odc_block_cache_hits_total", hits)
+    metrics.REGISTRY.count("odc_block_cache_misses_total", misses)
+    metrics.REGISTRY.count("odc_block_cache_hit_bytes_total", bytes_hit)
+
+
 ##########
 # Worker #
 ##########
@@ -114,22 +494,60 @@ def worker():
 
     host = os.getenv("DASK_SCHEDULER_HOST", "dask-scheduler.dask.svc.cluster.local")
     dask_client = Client(f"{host}:8786")
+    upload_modules(dask_client)
 
-    dc = Datacube()
+    # Index searches are cached, so overlapping and repeated queries don't reach the database
+    cache_ttl = int(os.getenv("INDEX_CACHE_TTL", "600"))
+    dc = CachedDatacube(Datacube(), ttl_secs=cache_ttl, max_entries=int(os.getenv("INDEX_CACHE_SIZE", "256")))
+
+    prefetch_count = int(os.getenv("INDEX_PREFETCH_JOBS", "100"))
+    if prefetch_count > 0:
+        start_prefetcher(dc, q, prefetch_count, interval_secs=cache_ttl / 2)
 
     s3_client = S3Client()
 
-    lease_secs = int(os.getenv("JOB_LEASE_PERIOD", "3600"))
+    block_cache_dir = os.getenv("BLOCK_CACHE_DIR", "")
+    if block_cache_dir:
+        start_block_cache(dask_client, block_cache_dir, int(os.getenv("BLOCK_CACHE_SIZE_MB", "10240")) * MB)
 
-    while not q.empty():
-        item = q.lease(lease_secs=lease_secs, block=True, timeout=600)
-        if item is not None:
-            itemstr = item.decode("utf=8")
-            logging.info("Working on %s.", itemstr)
-            process_job(dc, dask_client, s3_client, itemstr, lease_secs)
-            q.complete(item)
-        else:
-            logging.info("Waiting for work.")
+    # Memory-map the tide heights once rather than per shoreline job
+    try:
+        tides.open_store()
+    except FileNotFoundError as e:
+        logging.warning("Tide data not available, shoreline jobs will fail: %s", e)
+
+    metrics_port = os.getenv("METRICS_PORT", "8000")
+    if metrics_port:
+        metrics.start_metrics_server(int(metrics_port))
+        logging.info("Serving metrics on port %s.", metrics_port)
+
+    # Leases are kept alive by a heartbeat while a job runs, so they can be much shorter than
+    # the job timeout and items of crashed workers are returned to the queue quickly
+    lease_secs = int(os.getenv("JOB_LEASE_PERIOD", "300"))
+    timeout_secs = int(os.getenv("JOB_TIMEOUT", "3600"))
+    reaper_secs = int(os.getenv("JOB_REAPER_PERIOD", "60"))
+
+    concurrency = int(os.getenv("JOB_CONCURRENCY", "1"))
+
+    if concurrency > 1:
+        logging.info("Running up to %d jobs concurrently.", concurrency)
+        work_concurrently(q, dc, dask_client, s3_client, concurrency, lease_secs, timeout_secs, reaper_secs)
+
+    else:
+        while not q.empty():
+            requeued = q.check_expired_leases()
+            if requeued:
+                logging.info("Returned %d items with expired leases to the queue.", requeued)
+
+            item = q.lease(lease_secs=lease_secs, block=True, timeout=reaper_secs)
+            if item is not None:
+                itemstr = item.decode("utf=8")
+                logging.info("Working on %s.", itemstr)
+                with q.heartbeat(item, lease_secs):
+                    process_job(dc, dask_client, s3_client, itemstr, timeout_secs)
+                q.complete(item)
+            else:
+                logging.info("Waiting for work.")
 
     logging.info("Queue empty, exiting.")
 
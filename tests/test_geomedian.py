@@ -0,0 +1,83 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from geomedian import DATA_BANDS, _weiszfeld_update, update_geomedian  # noqa: E402
+
+PRODUCT = 'ls8_usgs_sr_scene'
+NODATA = -9999
+
+
+def _scenes(values):
+    """Masked scenes of every band with the given (time, y, x) values, loaded a scene per chunk as by dc.load."""
+    time, height, width = values.shape
+    coords = {
+        'time': pd.date_range('2020-01-01', periods=time, freq='16D'),
+        'y': 1000.0 - 30 * np.arange(height),
+        'x': 2000.0 + 30 * np.arange(width),
+    }
+    ds = xr.Dataset({band: (('time', 'y', 'x'), values.astype('int16')) for band in DATA_BANDS}, coords=coords)
+    for band in DATA_BANDS:
+        ds[band].attrs['nodata'] = NODATA
+    return ds.chunk({'time': 1, 'y': 2, 'x': 2})
+
+
+def _estimate(value, count, like):
+    coords = {'y': like.y, 'x': like.x}
+    shape = (like.sizes['y'], like.sizes['x'])
+    estimate = xr.Dataset({band: (('y', 'x'), np.full(shape, value, dtype='int16')) for band in DATA_BANDS},
+                          coords=coords)
+    return estimate, xr.DataArray(np.full(shape, count, dtype='int16'), dims=('y', 'x'), coords=coords)
+
+
+def test_weiszfeld_update_without_estimate_is_the_geomedian_of_the_scenes():
+    scenes = np.array([[[0.1, 0.1], [0.1, 0.1], [0.9, 0.9]]], dtype='float32')
+    estimate = np.full((1, 2), np.nan, dtype='float32')
+
+    yy = _weiszfeld_update(estimate, np.zeros(1), scenes, eps=1e-5)
+
+    np.testing.assert_allclose(yy, [[0.1, 0.1]], atol=1e-4)
+
+
+def test_update_geomedian_with_several_new_scenes():
+    xx_clean = _scenes(np.full((3, 4, 4), 1000))
+    estimate, count = _estimate(NODATA, 0, xx_clean)
+
+    yy, count = update_geomedian(estimate, count, xx_clean, PRODUCT)
+    yy, count = yy.compute(), count.compute()
+
+    # Values are scaled to float and back, so may be off by one
+    for band in DATA_BANDS:
+        np.testing.assert_allclose(yy[band].values, 1000, atol=1)
+    np.testing.assert_array_equal(count.values, 3)
+
+
+def test_update_geomedian_is_weighted_by_the_observation_count():
+    xx_clean = _scenes(np.full((2, 4, 4), 2000))
+    estimate, count = _estimate(1000, 10, xx_clean)
+
+    yy, count = update_geomedian(estimate, count, xx_clean, PRODUCT)
+    yy, count = yy.compute(), count.compute()
+
+    for band in DATA_BANDS:
+        np.testing.assert_allclose(yy[band].values, 1000, atol=1)
+    np.testing.assert_array_equal(count.values, 12)
+
+
+def test_update_geomedian_keeps_the_estimate_without_new_observations():
+    values = np.full((2, 4, 4), 2000)
+    values[:, 0, 0] = NODATA
+    xx_clean = _scenes(values)
+    estimate, count = _estimate(1000, 1, xx_clean)
+
+    yy, count = update_geomedian(estimate, count, xx_clean, PRODUCT)
+    yy, count = yy.compute(), count.compute()
+
+    assert abs(yy[DATA_BANDS[0]].values[0, 0] - 1000) <= 1
+    assert count.values[0, 0] == 1
+    assert count.values[1, 1] == 3
@@ -0,0 +1,130 @@
+import os
+import sys
+from types import SimpleNamespace
+
+from datacube.utils.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from index_cache import CachedDatacube  # noqa: E402
+
+TIME = ('2019-01-01', '2019-12-31')
+
+
+def _dataset(name, x, y, uris=('s3://bucket/dataset',)):
+    """A dataset of one degree square with its lower left corner at x, y."""
+    return SimpleNamespace(id=name, extent=box(x, y, x + 1, y + 1, 'EPSG:4326'), uris=list(uris))
+
+
+class _Index:
+    """Finds the datasets of a product intersecting a query, recording the searches made."""
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.searches = []
+        self.loads = []
+
+    def find_datasets(self, ensure_location=False, **query):
+        self.searches.append(query)
+        (x_from, x_to), (y_from, y_to) = query['x'], query['y']
+        extent = box(x_from, y_from, x_to, y_to, 'EPSG:4326')
+        return [ds for ds in self.datasets.get(query['product'], [])
+                if ds.extent.intersects(extent) and (ds.uris or not ensure_location)]
+
+    def load(self, **query):
+        self.loads.append(query)
+        return query.get('datasets')
+
+
+def _query(x, y, size=1.0, product='ls8', time=TIME):
+    return {'product': product, 'time': time, 'x': (x, x + size), 'y': (y, y + size)}
+
+
+def _ids(datasets):
+    return sorted(ds.id for ds in datasets)
+
+
+def test_search_within_a_cached_extent_is_answered_by_footprint():
+    index = _Index({'ls8': [_dataset('a', 0, 0), _dataset('b', 2, 0)]})
+    dc = CachedDatacube(index)
+
+    assert _ids(dc.find_datasets(**_query(0, 0, size=3))) == ['a', 'b']
+    assert _ids(dc.find_datasets(**_query(0.2, 0.2, size=0.5))) == ['a']
+    assert _ids(dc.find_datasets(**_query(2.2, 0.2, size=0.5))) == ['b']
+
+    assert len(index.searches) == 1
+    assert dc.stats() == {'hits': 2, 'misses': 1, 'entries': 1}
+
+
+def test_search_of_another_time_extent_or_term_goes_to_the_index():
+    index = _Index({'ls8': [_dataset('a', 0, 0)]})
+    dc = CachedDatacube(index)
+    dc.find_datasets(**_query(0, 0))
+
+    dc.find_datasets(**_query(0, 0, time=('2020-01-01', '2020-12-31')))
+    dc.find_datasets(**_query(0.5, 0.5))
+    dc.find_datasets(**dict(_query(0, 0), platform='LANDSAT_8'))
+
+    assert len(index.searches) == 4
+
+
+def test_expired_searches_are_not_used():
+    index = _Index({'ls8': [_dataset('a', 0, 0)]})
+    dc = CachedDatacube(index, ttl_secs=0)
+
+    dc.find_datasets(**_query(0, 0))
+    dc.find_datasets(**_query(0, 0))
+
+    assert len(index.searches) == 2
+
+
+def test_least_recently_used_search_is_evicted():
+    index = _Index({'ls8': [_dataset('a', 0, 0)]})
+    dc = CachedDatacube(index, max_entries=2)
+    dc.find_datasets(**_query(0, 0))
+    dc.find_datasets(**_query(5, 5))
+    dc.find_datasets(**_query(0, 0))
+
+    dc.find_datasets(**_query(10, 10))
+
+    assert dc.stats()['entries'] == 2
+    dc.find_datasets(**_query(0, 0))
+    assert len(index.searches) == 3
+    dc.find_datasets(**_query(5, 5))
+    assert len(index.searches) == 4
+
+
+def test_datasets_without_a_location_are_only_left_out_when_asked():
+    index = _Index({'ls8': [_dataset('a', 0, 0), _dataset('archived', 0, 0, uris=())]})
+    dc = CachedDatacube(index)
+
+    assert _ids(dc.find_datasets(**_query(0, 0))) == ['a', 'archived']
+    assert _ids(dc.find_datasets(ensure_location=True, **_query(0, 0))) == ['a']
+    assert len(index.searches) == 1
+
+
+def test_load_resolves_its_datasets_through_the_cache():
+    index = _Index({'ls8': [_dataset('a', 0, 0), _dataset('archived', 0, 0, uris=())]})
+    dc = CachedDatacube(index)
+    dc.find_datasets(**_query(0, 0, size=2))
+
+    loaded = dc.load(measurements=['red'], **_query(0.5, 0.5, size=0.2))
+
+    assert _ids(loaded) == ['a']
+    assert len(index.searches) == 1
+    assert index.loads[0]['measurements'] == ['red']
+
+
+def test_prefetch_searches_the_union_of_the_extents_per_product_and_time():
+    index = _Index({'ls8': [_dataset('a', 0, 0), _dataset('b', 3, 2)], 'wofs': [_dataset('w', 0, 0)]})
+    dc = CachedDatacube(index)
+    queries = [_query(0, 0), _query(3, 2), _query(0, 0, product='wofs')]
+
+    assert dc.prefetch(queries) == 2
+
+    ls8_search = next(search for search in index.searches if search['product'] == 'ls8')
+    assert ls8_search['x'] == (0.0, 4.0) and ls8_search['y'] == (0.0, 3.0)
+    assert [_ids(dc.find_datasets(**query)) for query in queries] == [['a'], ['b'], ['w']]
+    assert len(index.searches) == 2
+
+    assert dc.prefetch(queries) == 0
@@ -0,0 +1,91 @@
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from mosaic import build_vrt, group_band_files  # noqa: E402
+
+CRS_3460 = CRS.from_epsg(3460)
+
+
+def _tile(name, left, top, width=100, height=50, res=30, nodata=-9999):
+    return {
+        'name': name,
+        'crs': CRS_3460,
+        'transform': Affine(res, 0, left, 0, -res, top),
+        'width': width,
+        'height': height,
+        'count': 1,
+        'dtype': 'int16',
+        'nodata': nodata,
+        'block': (50, 100),
+    }
+
+
+def _dst_rects(vrt):
+    return {source.find('SourceFilename').text: {k: int(v) for k, v in source.find('DstRect').attrib.items()}
+            for source in ET.fromstring(vrt).iter('ComplexSource')}
+
+
+def test_group_band_files_by_name_without_extents():
+    keys = [
+        'prefix/ls8_geomedian_2019_epsg3460_1000.0_2000.0_4000.0_500.0_red.tif',
+        'prefix/ls8_geomedian_2019_epsg3460_4000.0_2000.0_7000.0_500.0_red.tif',
+        'prefix/ls8_geomedian_2019_epsg3460_1000.0_2000.0_4000.0_500.0_blue.tif',
+        'prefix/ls8_geomedian_2019_epsg3460_1000.0_2000.0_4000.0_500.0.yaml',
+    ]
+
+    assert group_band_files(keys) == {
+        'ls8_geomedian_2019_epsg3460_red': keys[:2],
+        'ls8_geomedian_2019_epsg3460_blue': keys[2:3],
+    }
+
+
+def test_build_vrt_places_tiles_at_their_pixel_offsets():
+    tiles = [_tile('a.tif', 1000, 5000), _tile('b.tif', 4000, 5000), _tile('c.tif', 1000, 3500, width=40)]
+
+    vrt = build_vrt(tiles)
+
+    root = ET.fromstring(vrt)
+    assert (root.get('rasterXSize'), root.get('rasterYSize')) == ('200', '100')
+    assert [float(v) for v in root.find('GeoTransform').text.split(',')] == [1000, 30, 0, 5000, 0, -30]
+    assert _dst_rects(vrt) == {
+        'a.tif': {'xOff': 0, 'yOff': 0, 'xSize': 100, 'ySize': 50},
+        'b.tif': {'xOff': 100, 'yOff': 0, 'xSize': 100, 'ySize': 50},
+        'c.tif': {'xOff': 0, 'yOff': 50, 'xSize': 40, 'ySize': 50},
+    }
+    assert root.find('VRTRasterBand/NoDataValue').text == '-9999'
+
+
+def test_build_vrt_rejects_tiles_off_the_pixel_grid():
+    with pytest.raises(ValueError, match='not aligned to the pixel grid'):
+        build_vrt([_tile('a.tif', 1000, 5000), _tile('b.tif', 4010, 5000)])
+
+
+def test_build_vrt_rejects_tiles_of_another_resolution():
+    with pytest.raises(ValueError, match='resolution'):
+        build_vrt([_tile('a.tif', 1000, 5000), _tile('b.tif', 4000, 5000, res=10)])
+
+
+def test_build_vrt_reads_as_the_mosaic_of_the_tiles(tmp_path):
+    tiles = [_tile('a.tif', 1000, 5000), _tile('b.tif', 4000, 5000), _tile('c.tif', 4000, 3500)]
+    for value, tile in enumerate(tiles, 1):
+        with rasterio.open(tmp_path / tile['name'], 'w', driver='GTiff', width=tile['width'],
+                           height=tile['height'], count=1, dtype=tile['dtype'], crs=tile['crs'],
+                           transform=tile['transform'], nodata=tile['nodata']) as dst:
+            dst.write(np.full((tile['height'], tile['width']), value, dtype=tile['dtype']), 1)
+    (tmp_path / 'mosaic.vrt').write_text(build_vrt(tiles))
+
+    with rasterio.open(tmp_path / 'mosaic.vrt') as src:
+        mosaic = src.read(1)
+
+    assert mosaic.shape == (100, 200)
+    assert (mosaic[:50, :100] == 1).all() and (mosaic[:50, 100:] == 2).all() and (mosaic[50:, 100:] == 3).all()
+    assert (mosaic[50:, :100] == -9999).all()
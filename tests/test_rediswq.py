@@ -0,0 +1,109 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import rediswq  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def _queue(server, monkeypatch):
+    monkeypatch.setattr(rediswq.redis, 'StrictRedis', lambda **kwargs: fakeredis.FakeStrictRedis(server=server))
+    return rediswq.RedisWQ(name='jobs')
+
+
+def test_put_skips_items_already_queued_or_processed(server, monkeypatch):
+    q = _queue(server, monkeypatch)
+
+    assert q.put(['a', 'b']) == 2
+    assert q.put(['b', 'c']) == 1
+    item = q.lease(block=False)
+    assert q.put([item]) == 0
+
+    q.complete(item)
+    assert q.put([item]) == 1
+
+
+def test_lease_serves_priority_lanes_then_submission_order_then_main_queue(server, monkeypatch):
+    q = _queue(server, monkeypatch)
+    q._db.lpush('jobs', b'main')
+    q.put(['low-1', 'low-2'])
+    q.put(['high'], priority=1)
+
+    assert q.peek() == [b'high', b'low-1', b'low-2', b'main']
+    assert [q.lease(block=False) for _ in range(5)] == [b'high', b'low-1', b'low-2', b'main', None]
+    assert not q.empty()
+
+
+def test_expired_leases_are_returned_where_they_came_from(server, monkeypatch):
+    q = _queue(server, monkeypatch)
+    q._db.lpush('jobs', b'main')
+    q.put(['first', 'second'])
+    leased = [q.lease(block=False) for _ in range(3)]
+    for item in leased:
+        q._db.delete(q._lease_key_prefix + q._itemkey(item))
+
+    assert q.check_expired_leases(grace_secs=0) == 3
+
+    assert q._processing_qsize() == 0
+    assert [q.lease(block=False) for _ in range(3)] == leased
+
+
+def test_items_without_a_lease_are_only_returned_after_the_grace_period(server, monkeypatch):
+    q = _queue(server, monkeypatch)
+    reaper = _queue(server, monkeypatch)
+    q.put(['item'])
+    # The item is in the processing queue, its lease not set yet
+    q._db.zpopmin('jobs:priority')
+    q._db.lpush('jobs:processing', b'item')
+
+    assert reaper.check_expired_leases() == 0
+    assert q._processing_qsize() == 1
+
+    assert reaper.check_expired_leases(grace_secs=0) == 1
+    assert q.lease(block=False) == b'item'
+
+
+def test_leased_items_are_not_returned(server, monkeypatch):
+    q = _queue(server, monkeypatch)
+    q.put(['item'])
+    q.lease(lease_secs=60, block=False)
+
+    assert q.check_expired_leases(grace_secs=0) == 0
+    assert q._processing_qsize() == 1
+
+
+def test_lease_renewal_and_completion_belong_to_the_lease_holder(server, monkeypatch):
+    q = _queue(server, monkeypatch)
+    other = _queue(server, monkeypatch)
+    q.put(['item'])
+    item = q.lease(block=False)
+    lease_key = q._lease_key_prefix + q._itemkey(item)
+
+    assert q.renew_lease(item, 60)
+    assert not other.renew_lease(item, 60)
+
+    # The lease expired and the item was handed to the other worker
+    q._db.set(lease_key, other.sessionID())
+    assert not q.renew_lease(item, 60)
+    q.complete(item)
+
+    assert q._db.get(lease_key) == other.sessionID().encode()
+    assert q._processing_qsize() == 0
+
+
+def test_lease_blocks_until_an_item_is_pushed(server, monkeypatch):
+    q = _queue(server, monkeypatch)
+
+    assert q.lease(block=True, timeout=1) is None
+
+    q._db.lpush('jobs', b'main')
+    assert q.lease(block=True, timeout=1) == b'main'
+    assert q._lease_exists(b'main')
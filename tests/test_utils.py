@@ -0,0 +1,44 @@
+import io
+import os
+import sys
+import zipfile
+from concurrent.futures import Future
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from utils import upload_shapefile  # noqa: E402
+
+
+class _UploadRecorder:
+    """Records the contents of the objects uploaded, read as the S3 client would."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_fileobj_async(self, fileobj, bucket, destination):
+        self.objects[(bucket, destination)] = fileobj.read()
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+def test_upload_shapefile_uploads_every_file_of_the_shapefile(tmp_path):
+    for ext in ('.shp', '.shx', '.dbf', '.prj'):
+        (tmp_path / f"lines{ext}").write_bytes(f"contents of {ext}".encode())
+    (tmp_path / "other.shp").write_bytes(b"another shapefile")
+    ds = xr.Dataset(coords={'x': np.array([100.0, 130.0]), 'y': np.array([-200.0, -230.0])})
+    s3_client = _UploadRecorder()
+
+    upload_shapefile(s3_client, ds, str(tmp_path / "lines.shp"), 'shoreline', 'shoreline',
+                     '2019-01-01', '2019-12-31', 'EPSG:3460', bucket='bucket', prefix='prefix')
+
+    (bucket, key), contents = next(iter(s3_client.objects.items()))
+    name = 'shoreline_2019-01-01_2019-12-31_epsg3460_100.0_-200.0_130.0_-230.0_shoreline'
+    assert (bucket, key) == ('bucket', f"prefix/{name}.zip")
+    with zipfile.ZipFile(io.BytesIO(contents)) as archive:
+        assert sorted(archive.namelist()) == sorted(f"{name}{ext}" for ext in ('.dbf', '.prj', '.shp', '.shx'))
+        assert archive.read(f"{name}.prj") == b"contents of .prj"
+    assert sorted(os.listdir(tmp_path)) == ['other.shp']